@@ -4,18 +4,58 @@ import json
 import psutil
 import platform
 import subprocess
+import sys
+import signal
 import socket
 import time
 import os
 import shutil
+import sqlite3
 from pathlib import Path
 import base64
+import ctypes
+import ctypes.util
 import io
+import codecs
 import google.generativeai as genai
 import re
+import functools
+import bisect
+import heapq
+import hashlib
+import struct
+import threading
+import uuid
+import random
+from collections import deque
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+
+# Optional: tile diffing for live preview streams (falls back to a single dirty rectangle)
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Optional: PTY shell sessions (POSIX only)
+try:
+    import pty
+    import fcntl
+    import termios
+except ImportError:
+    pty = None
 
 # CONFIGURATION
 SERVER_URL = "wss://omni-backend-603531145334.asia-south1.run.app/ws/agent"
+# Largest message accepted from the server (upload chunks, legacy base64 uploads)
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+# Labels the server can select this agent by for fleet commands, e.g. ["web", "eu-west"]
+AGENT_TAGS = []
+
+try:
+    from config import AGENT_TAGS
+except ImportError:
+    pass
 
 # Try to load configuration
 try:
@@ -38,9 +78,101 @@ except Exception as e:
     print(f"❌ AI initialization failed: {e}")
     AI_ENABLED = False
 
+# Request dispatching: blocking handlers run on a bounded thread pool and each
+# request type gets its own concurrency limit so one slow call can't starve the rest
+MAX_WORKER_THREADS = 8
+DEFAULT_REQUEST_CONCURRENCY = 4
+REQUEST_CONCURRENCY_LIMITS = {
+    "execute": 8,
+    "search_files": 2,
+    "get_disk_usage": 2,
+    "get_system_context": 2,
+    "download_file": 2,
+    "upload_file": 2,
+    # Upload sessions mostly sit idle waiting for chunks and commit
+    "upload_open": 8,
+    "take_screenshot": 1,
+    "get_live_frame": 1,
+    "ai_analyze_system": 1,
+    "ai_generate_commands": 1,
+    "ai_security_analysis": 1,
+    "ai_performance_optimization": 1,
+}
+
+# Stats heartbeat cadence (seconds); the server can change it at runtime
+DEFAULT_STATS_INTERVAL = 3.0
+MIN_STATS_INTERVAL = 0.5
+MAX_STATS_INTERVAL = 60.0
+# Seconds between full stats keyframes; ticks in between only carry changed fields
+STATS_KEYFRAME_INTERVAL = 60.0
+
+worker_pool = ThreadPoolExecutor(max_workers=MAX_WORKER_THREADS, thread_name_prefix="omni-worker")
+
 # Global state for persistent session
 current_working_dir = os.getcwd()
 
+async def run_blocking(func, *args, **kwargs):
+    """Run a synchronous handler on the shared worker pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(worker_pool, functools.partial(func, *args, **kwargs))
+
+# Host facts that rarely change are cached instead of being re-read every tick
+HOST_FACTS_TTL = 300.0
+# Cheap-but-not-free values (frequency, sensors) are refreshed less often than stats
+SLOW_STATS_TTL = 10.0
+
+class HostFactsCache:
+    """Caches host facts per name and re-reads each one after its TTL expires."""
+
+    def __init__(self, ttl=HOST_FACTS_TTL):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, name, loader, ttl=None):
+        now = time.monotonic()
+        entry = self.entries.get(name)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        value = loader()
+        with self.lock:
+            self.entries[name] = (now + (self.ttl if ttl is None else ttl), value)
+        return value
+
+    def invalidate(self, name=None):
+        with self.lock:
+            if name is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(name, None)
+
+host_facts = HostFactsCache()
+
+def _read_cpu_freq():
+    freq = psutil.cpu_freq()
+    return freq._asdict() if freq else {}
+
+def _read_temperatures():
+    temps = {}
+    try:
+        temp_sensors = psutil.sensors_temperatures()
+        for name, entries in temp_sensors.items():
+            for entry in entries:
+                temps[f"{name}_{entry.label or 'temp'}"] = entry.current
+    except:
+        temps = {"cpu_temp": "N/A"}
+    return temps
+
+def _count_processes():
+    # Only the count is needed; on Linux avoid building the full pid list
+    if os.path.isdir("/proc"):
+        try:
+            with os.scandir("/proc") as it:
+                return sum(1 for entry in it if entry.name.isdigit())
+        except OSError:
+            pass
+    return len(psutil.pids())
+
 def get_system_stats():
     """Enhanced system metrics."""
     try:
@@ -55,25 +187,18 @@ def get_system_stats():
         net_io = psutil.net_io_counters()
         
         # CPU temperature (if available)
-        temps = {}
-        try:
-            temp_sensors = psutil.sensors_temperatures()
-            for name, entries in temp_sensors.items():
-                for entry in entries:
-                    temps[f"{name}_{entry.label or 'temp'}"] = entry.current
-        except:
-            temps = {"cpu_temp": "N/A"}
+        temps = host_facts.get("temperatures", _read_temperatures, SLOW_STATS_TTL)
         
         # Boot time
-        boot_time = psutil.boot_time()
+        boot_time = host_facts.get("boot_time", psutil.boot_time)
         
-        # Process count
-        process_count = len(psutil.pids())
+        # Process count (charted in history, so read fresh every tick)
+        process_count = _count_processes()
         
         return {
             "cpu_percent": cpu_percent,
-            "cpu_count": psutil.cpu_count(),
-            "cpu_freq": psutil.cpu_freq()._asdict() if psutil.cpu_freq() else {},
+            "cpu_count": host_facts.get("cpu_count", psutil.cpu_count),
+            "cpu_freq": host_facts.get("cpu_freq", _read_cpu_freq, SLOW_STATS_TTL),
             "ram_percent": memory.percent,
             "ram_total": memory.total,
             "ram_used": memory.used,
@@ -93,23 +218,236 @@ def get_system_stats():
             "process_count": process_count,
             "temperatures": temps,
             "boot_time": boot_time,
-            "platform": platform.platform(),
-            "hostname": socket.gethostname(),
+            "platform": host_facts.get("platform", platform.platform),
+            "hostname": host_facts.get("hostname", socket.gethostname),
             "uptime": time.time() - boot_time
         }
     except Exception as e:
         return {"error": str(e)}
 
-def get_processes():
-    """Get running processes."""
+# ============ PROCESS SAMPLER ============
+
+# Processes returned by get_processes unless the request asks for another limit
+PROCESS_TOP_N = 50
+MAX_PROCESS_TOP_N = 5000
+# Polls closer together than this share one sample
+PROCESS_MIN_SAMPLE_INTERVAL = 0.5
+# The very first sample is taken twice this far apart, so CPU usage has something to compare to
+PROCESS_PRIME_INTERVAL = 0.3
+# Earlier responses kept to diff later polls against
+PROCESS_DIFF_BASES = 16
+# Columns that move on every sample are only reported as changed once they have moved
+# this far from the value the client holds
+PROCESS_CHANGE_THRESHOLDS = {"cpu_percent": 1.0, "memory_percent": 0.1, "rss": 1024 * 1024}
+PROCESS_COLUMNS = ("pid", "ppid", "name", "username", "status", "cpu_percent", "memory_percent",
+                   "rss", "num_threads", "create_time")
+PROC_STATES = {
+    "R": "running", "S": "sleeping", "D": "disk-sleep", "Z": "zombie", "T": "stopped",
+    "t": "tracing-stop", "X": "dead", "x": "dead", "K": "wake-kill", "W": "waking",
+    "P": "parked", "I": "idle"
+}
+
+@functools.lru_cache(maxsize=1024)
+def _username(uid):
     try:
-        processes = []
-        for proc in psutil.process_iter(['pid', 'name', 'cpu_percent', 'memory_percent', 'status']):
-            try:
-                processes.append(proc.info)
-            except (psutil.NoSuchProcess, psutil.AccessDenied):
-                pass
-        return {"processes": sorted(processes, key=lambda x: x['memory_percent'], reverse=True)[:50]}
+        import pwd
+        return pwd.getpwuid(uid).pw_name
+    except (ImportError, KeyError):
+        return str(uid)
+
+class ProcessSampler:
+    """Process table sampler with CPU usage measured between consecutive samples.
+
+    On Linux each process costs one read of /proc/<pid>/stat and one stat() of its
+    directory (for the owner); elsewhere psutil's cached Process objects are used.
+    CPU time is remembered per (pid, start time) so cpu_percent is the usage since the
+    previous sample, and a reused pid is never compared against its predecessor.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.primed = threading.Event()
+        self.prime_lock = threading.Lock()
+        self.cpu_seconds = {}  # pid -> (create_time, cpu seconds) at the last sample
+        self.sampled_at = None
+        self.rows = []
+        self.bases = {}  # snapshot -> (query, {pid: row})
+        self.procfs = sys.platform.startswith("linux") and os.path.exists("/proc/self/stat")
+        if self.procfs:
+            self.ticks = os.sysconf("SC_CLK_TCK")
+            self.page_size = os.sysconf("SC_PAGE_SIZE")
+            self.boot_time = psutil.boot_time()
+
+    def _read_procfs(self):
+        ticks, page_size, boot_time = self.ticks, self.page_size, self.boot_time
+        with os.scandir("/proc") as it:
+            for entry in it:
+                if not entry.name.isdigit():
+                    continue
+                try:
+                    with open(f"/proc/{entry.name}/stat", "rb") as f:
+                        stat = f.read()
+                    uid = entry.stat().st_uid
+                except OSError:
+                    continue  # exited while listing
+                # The name is in parentheses and may itself contain spaces or ')'
+                head, _, tail = stat.rpartition(b")")
+                fields = tail.split()
+                yield (int(entry.name), int(fields[1]), head.partition(b"(")[2].decode(errors="replace"),
+                       _username(uid), PROC_STATES.get(fields[0].decode(), "unknown"),
+                       int(fields[21]) * page_size, int(fields[17]),
+                       boot_time + int(fields[19]) / ticks, (int(fields[11]) + int(fields[12])) / ticks)
+
+    def _read_psutil(self):
+        attrs = ["pid", "ppid", "name", "username", "status", "memory_info", "num_threads",
+                 "create_time", "cpu_times"]
+        for proc in psutil.process_iter(attrs, ad_value=None):
+            info = proc.info
+            if info["create_time"] is None:
+                continue
+            cpu_times = info["cpu_times"]
+            yield (info["pid"], info["ppid"], info["name"] or "", info["username"] or "",
+                   info["status"] or "unknown", info["memory_info"].rss if info["memory_info"] else 0,
+                   info["num_threads"] or 0, info["create_time"],
+                   cpu_times.user + cpu_times.system if cpu_times else 0.0)
+
+    def _take(self, now):
+        elapsed = now - self.sampled_at if self.sampled_at is not None else None
+        wall = time.time()
+        total_memory = psutil.virtual_memory().total
+        previous, current, rows = self.cpu_seconds, {}, []
+        for pid, ppid, name, username, status, rss, threads, started, cpu in (
+                self._read_procfs() if self.procfs else self._read_psutil()):
+            current[pid] = (started, cpu)
+            before = previous.get(pid)
+            if elapsed and before and before[0] == started:
+                cpu_percent = (cpu - before[1]) / elapsed * 100
+            else:
+                # Started since the last sample: its average over its short life so far
+                cpu_percent = cpu / max(wall - started, elapsed or PROCESS_PRIME_INTERVAL) * 100
+            rows.append({
+                "pid": pid,
+                "ppid": ppid,
+                "name": name,
+                "username": username,
+                "status": status,
+                "cpu_percent": round(max(cpu_percent, 0.0), 1),
+                "memory_percent": round(rss / total_memory * 100, 2),
+                "rss": rss,
+                "num_threads": threads,
+                "create_time": round(started, 2)
+            })
+        self.cpu_seconds = current
+        self.sampled_at = now
+        return rows
+
+    def _prime(self):
+        """The first sample: CPU times read twice, PROCESS_PRIME_INTERVAL apart. The
+        sampling lock is not held while waiting, so diff() calls carry on meanwhile."""
+        with self.prime_lock:
+            if self.primed.is_set():
+                return
+            with self.lock:
+                self._take(time.monotonic())
+            time.sleep(PROCESS_PRIME_INTERVAL)
+            with self.lock:
+                self.rows = self._take(time.monotonic())
+            self.primed.set()
+
+    def sample(self):
+        """Rows for every process, re-read unless the last sample is very recent."""
+        if not self.primed.is_set():
+            self._prime()
+            return self.rows
+        with self.lock:
+            now = time.monotonic()
+            if now - self.sampled_at >= PROCESS_MIN_SAMPLE_INTERVAL:
+                self.rows = self._take(now)
+            return self.rows
+
+    @staticmethod
+    def _changes(old, row):
+        """Fields of ``row`` the client holding ``old`` should update."""
+        changes = {}
+        for key, value in row.items():
+            previous = old.get(key)
+            threshold = PROCESS_CHANGE_THRESHOLDS.get(key)
+            if threshold is None or previous is None:
+                if previous != value:
+                    changes[key] = value
+            elif abs(value - previous) >= threshold:
+                changes[key] = value
+        return changes
+
+    def diff(self, query, top, since):
+        """Response for ``top``: everything, or only the changes since the snapshot
+        ``since`` when that snapshot is still known and was taken for the same query."""
+        current = {row["pid"]: row for row in top}
+        snapshot = uuid.uuid4().hex[:12]
+        with self.lock:
+            base = self.bases.get(since) if since else None
+        if base is not None and base[0] != query:
+            base = None
+
+        # Small moves in volatile columns are not sent, so the snapshot remembers the rows
+        # as the client will hold them, and later diffs measure from those
+        changed, held = [], current
+        if base is not None:
+            previous, held = base[1], {}
+            for pid, row in current.items():
+                old = previous.get(pid)
+                if old is None:
+                    held[pid] = row
+                    continue
+                changes = self._changes(old, row)
+                held[pid] = {**old, **changes} if changes else old
+                if changes:
+                    changed.append({"pid": pid, **changes})
+
+        with self.lock:
+            self.bases[snapshot] = (query, held)
+            while len(self.bases) > PROCESS_DIFF_BASES:
+                del self.bases[next(iter(self.bases))]
+
+        if base is None:
+            return {"snapshot": snapshot, "processes": top}
+        return {
+            "snapshot": snapshot,
+            "base": since,
+            "added": [row for pid, row in current.items() if pid not in previous],
+            "removed": [pid for pid in previous if pid not in current],
+            "changed": changed,
+            # Pids in sorted order, so the client can reorder what it already holds
+            "order": list(current)
+        }
+
+process_sampler = ProcessSampler()
+
+def get_processes(limit=PROCESS_TOP_N, sort_by="memory_percent", order="desc", user=None, name=None,
+                  since=None):
+    """Get the top running processes by any column, optionally filtered by owner and a
+    name regex. Passing an earlier response's ``snapshot`` as ``since`` returns only
+    the added, removed and changed rows."""
+    try:
+        if sort_by not in PROCESS_COLUMNS:
+            return {"error": f"Cannot sort processes by: {sort_by}"}
+        if order not in ("asc", "desc"):
+            return {"error": f"Invalid sort order: {order}"}
+        limit = max(1, min(int(limit), MAX_PROCESS_TOP_N))
+        rows = process_sampler.sample()
+        if user:
+            rows = [row for row in rows if row["username"] == user]
+        if name:
+            regex = _compile_search_regex(name)
+            rows = [row for row in rows if regex.search(row["name"])]
+
+        select = heapq.nlargest if order == "desc" else heapq.nsmallest
+        top = select(limit, rows, key=lambda row: row[sort_by])
+        result = process_sampler.diff((limit, sort_by, order, user, name), top, since)
+        result["total"] = len(rows)
+        return result
+    except re.error as e:
+        return {"error": f"Invalid name pattern: {e}"}
     except Exception as e:
         return {"error": str(e)}
 
@@ -199,7 +537,11 @@ def kill_process(pid):
     except Exception as e:
         return {"error": str(e)}
 
-def read_file_content(file_path, max_size=1024*1024):
+def encode_payload(data, binary=False):
+    """Raw bytes for binary frames, base64 text for JSON-only clients."""
+    return bytes(data) if binary else base64.b64encode(data).decode('utf-8')
+
+def read_file_content(file_path, max_size=1024*1024, binary=False):
     """Read file content for viewing."""
     try:
         path = Path(file_path)
@@ -238,8 +580,7 @@ def read_file_content(file_path, max_size=1024*1024):
         image_extensions = {'.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp', '.svg'}
         if file_ext in image_extensions:
             try:
-                import base64
-                content = base64.b64encode(path.read_bytes()).decode('utf-8')
+                content = encode_payload(path.read_bytes(), binary)
                 return {
                     "type": "image",
                     "content": content,
@@ -283,8 +624,11 @@ def open_file_with_system(file_path):
     except Exception as e:
         return {"error": str(e)}
 
-def download_file(file_path, chunk_size=8192):
-    """Prepare file for download by encoding in base64 chunks."""
+def download_file(file_path, chunk_size=8192, binary=False):
+    """Prepare file for download by encoding in base64 chunks.
+
+    Small files only; large files use the streaming transfer (``stream_download``).
+    """
     try:
         path = Path(file_path)
         if not path.exists() or not path.is_file():
@@ -294,8 +638,7 @@ def download_file(file_path, chunk_size=8192):
         if file_size > 10*1024*1024:  # 10MB limit
             return {"error": "File too large for download (max 10MB)"}
         
-        import base64
-        content = base64.b64encode(path.read_bytes()).decode('utf-8')
+        content = encode_payload(path.read_bytes(), binary)
         
         return {
             "content": content,
@@ -307,16 +650,49 @@ def download_file(file_path, chunk_size=8192):
     except Exception as e:
         return {"error": str(e)}
 
-def search_files(search_query, search_path=".", max_results=50):
-    """Search for files and directories matching the query."""
+def _search_matcher(query, mode):
+    if mode == "glob":
+        import fnmatch
+        pattern = query.lower()
+        return lambda name: fnmatch.fnmatchcase(name.lower(), pattern)
+    if mode == "regex":
+        regex = _compile_search_regex(query)
+        return lambda name: regex.search(name) is not None
+    needle = query.lower()
+    return lambda name: needle in name.lower()
+
+def search_files(search_query, search_path=".", max_results=50, mode="substring", offset=0):
+    """Search for files and directories matching the query.
+
+    Served from the filename index when it covers ``search_path``; otherwise (or while
+    the index is still being built) falls back to a shallow walk.
+    """
     global current_working_dir
     try:
         if search_path == ".":
             search_path = current_working_dir
+        if mode not in ("substring", "glob", "regex"):
+            return {"error": f"Unknown search mode: {mode}"}
+        max_results = max(1, min(int(max_results), MAX_SEARCH_RESULTS))
+        offset = max(0, int(offset))
+        started = time.perf_counter()
+
+        if file_index.ready.is_set() and file_index.covers(search_path):
+            results, next_offset = file_index.search(search_query, mode, search_path, max_results, offset)
+            return {
+                "results": results,
+                "query": search_query,
+                "mode": mode,
+                "search_path": str(search_path),
+                "offset": offset,
+                "next_offset": next_offset,
+                "indexed": True,
+                "elapsed_ms": round((time.perf_counter() - started) * 1000, 2)
+            }
         
         search_path = Path(search_path)
         results = []
-        search_query = search_query.lower()
+        matches = _search_matcher(search_query, mode)
         
         def search_recursive(path, depth=0):
             if depth > 3:  # Limit recursion depth
@@ -328,7 +704,7 @@ def search_files(search_query, search_path=".", max_results=50):
                         return
                     
                     try:
-                        if search_query in item.name.lower():
+                        if matches(item.name):
                             stat = item.stat()
                             results.append({
                                 "name": item.name,
@@ -352,9 +728,17 @@ def search_files(search_query, search_path=".", max_results=50):
         return {
             "results": results,
             "query": search_query,
-            "search_path": str(search_path)
+            "mode": mode,
+            "search_path": str(search_path),
+            "offset": 0,
+            "next_offset": None,
+            "indexed": False,
+            "index_status": file_index.status,
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 2)
         }
         
+    except re.error as e:
+        return {"error": f"Invalid regular expression: {e}"}
     except Exception as e:
         return {"error": str(e)}
 
@@ -451,8 +835,380 @@ def upload_file(file_path, content_base64):
     except Exception as e:
         return {"error": str(e)}
 
-def get_disk_usage(path_str="."):
-    """Get disk usage for a specific path."""
+# ============ DIRECTORY LISTINGS ============
+
+# Entries per page when a listing is requested page by page
+DIRECTORY_PAGE_SIZE = 500
+MAX_DIRECTORY_PAGE_SIZE = 5000
+# Listings kept in memory and reused while the directory's mtime is unchanged, but
+# never for longer than this (file sizes change without touching the directory mtime)
+DIRECTORY_CACHE_SIZE = 8
+DIRECTORY_CACHE_TTL = 30
+# Sorted/filtered orders kept per cached listing
+DIRECTORY_VIEWS_PER_LISTING = 4
+DIRECTORY_COLUMNS = ("name", "type", "size", "modified", "mode")
+DIRECTORY_SORT_KEYS = {
+    "name": lambda listing, i: (),
+    "size": lambda listing, i: (listing.size[i],),
+    "modified": lambda listing, i: (listing.modified[i] or 0,),
+    "type": lambda listing, i: (os.path.splitext(listing.name[i])[1].lower(),),
+}
+
+class DirectoryListing:
+    """One directory's entries, stored by column.
+
+    ``type`` is "d" for directories (symlinks to directories included), "l" for other
+    symlinks and "f" for everything else. ``modified`` and ``mode`` are None when an
+    entry cannot be stat'ed.
+    """
+
+    def __init__(self, path, mtime):
+        self.path = path
+        self.mtime = mtime
+        self.listed_at = time.monotonic()
+        # A directory changed within the mtime granularity of the listing could be
+        # missed without its mtime moving, so such a listing is not reused
+        self.settled = time.time() - mtime / 1e9 > 1
+        self.name, self.type, self.size, self.modified, self.mode = [], [], [], [], []
+        self.views = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def scan(cls, path, mtime):
+        listing = cls(path, mtime)
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    kind = "d" if entry.is_dir() else "l" if entry.is_symlink() else "f"
+                except OSError:
+                    kind = "f"
+                try:
+                    st = entry.stat()
+                except OSError:
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        st = None
+                listing.name.append(entry.name)
+                listing.type.append(kind)
+                listing.size.append(st.st_size if st and kind != "d" else 0)
+                listing.modified.append(int(st.st_mtime) if st else None)
+                listing.mode.append(st.st_mode & 0o7777 if st else None)
+        return listing
+
+    def view(self, sort, descending, dirs_first, pattern, show_hidden):
+        """Sort keys and entry indexes of the matching entries, in ascending key order."""
+        key = (sort, descending, dirs_first, pattern, show_hidden)
+        with self.lock:
+            view = self.views.pop(key, None)
+            if view is None:
+                view = self._build_view(sort, descending, dirs_first, pattern, show_hidden)
+                if len(self.views) >= DIRECTORY_VIEWS_PER_LISTING:
+                    del self.views[next(iter(self.views))]
+            self.views[key] = view
+        return view
+
+    def _build_view(self, sort, descending, dirs_first, pattern, show_hidden):
+        matches = _search_matcher(pattern, "glob" if re.search(r"[*?\[]", pattern) else "substring") \
+            if pattern else None
+        sort_key = DIRECTORY_SORT_KEYS[sort]
+        keyed = []
+        for i, name in enumerate(self.name):
+            if not show_hidden and name.startswith("."):
+                continue
+            if matches and not matches(name):
+                continue
+            # Directories stay on top whichever way the page is walked
+            group = (self.type[i] == "d") == descending if dirs_first else False
+            keyed.append(((group,) + sort_key(self, i) + (name.lower(), name), i))
+        keyed.sort()
+        return [k for k, _ in keyed], [i for _, i in keyed]
+
+class DirectoryListingCache:
+    """Recently listed directories, most recently used last."""
+
+    def __init__(self, size=DIRECTORY_CACHE_SIZE):
+        self.size = size
+        self.listings = {}
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        """The listing of ``path`` and whether it came from the cache."""
+        mtime = os.stat(path).st_mtime_ns
+        with self.lock:
+            listing = self.listings.pop(path, None)
+        cached = bool(listing and listing.settled and listing.mtime == mtime
+                      and time.monotonic() - listing.listed_at < DIRECTORY_CACHE_TTL)
+        if not cached:
+            listing = DirectoryListing.scan(path, mtime)
+        with self.lock:
+            self.listings[path] = listing
+            while len(self.listings) > self.size:
+                del self.listings[next(iter(self.listings))]
+        return listing, cached
+
+directory_cache = DirectoryListingCache()
+
+def _encode_cursor(sort, descending, key):
+    return base64.urlsafe_b64encode(json.dumps([sort, descending, key]).encode()).decode()
+
+def _decode_cursor(cursor, sort, descending):
+    try:
+        cursor_sort, cursor_descending, key = json.loads(base64.urlsafe_b64decode(cursor))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if cursor_sort != sort or cursor_descending != descending:
+        raise ValueError("Cursor belongs to a different sort order")
+    return tuple(key)
+
+def get_directory_page(path=".", cursor=None, limit=DIRECTORY_PAGE_SIZE, sort="name", order="asc",
+                       pattern=None, dirs_first=True, show_hidden=True):
+    """Get one page of a directory listing, sorted and filtered on the agent.
+
+    Entries come back by column (see DIRECTORY_COLUMNS). ``next_cursor`` is passed back
+    as ``cursor`` for the following page; it holds the sort key of the last entry sent
+    rather than an offset, so entries added or removed in between do not shift pages.
+    """
+    global current_working_dir
+    try:
+        if path == ".":
+            path = current_working_dir
+        
+        path = Path(path).resolve()
+        if not path.is_dir():
+            return {"error": f"Not a directory: {path}", "current_path": current_working_dir}
+        if sort not in DIRECTORY_SORT_KEYS:
+            return {"error": f"Unknown sort: {sort}"}
+        current_working_dir = str(path)
+
+        try:
+            listing, cached = directory_cache.get(str(path))
+        except PermissionError:
+            return {
+                "current_path": str(path),
+                "entries": {column: [] for column in DIRECTORY_COLUMNS},
+                "error": "Permission denied to read directory"
+            }
+
+        descending = order == "desc"
+        limit = max(1, min(int(limit), MAX_DIRECTORY_PAGE_SIZE))
+        keys, indexes = listing.view(sort, descending, bool(dirs_first), pattern or None, bool(show_hidden))
+        # Pages walk the ascending keys backwards for a descending order
+        if descending:
+            end = bisect.bisect_left(keys, _decode_cursor(cursor, sort, True)) if cursor else len(keys)
+            positions = range(end - 1, max(end - 1 - limit, -1), -1)
+            more = bool(positions) and positions[-1] > 0
+        else:
+            start = bisect.bisect_right(keys, _decode_cursor(cursor, sort, False)) if cursor else 0
+            positions = range(start, min(start + limit, len(keys)))
+            more = bool(positions) and positions[-1] < len(keys) - 1
+
+        rows = [indexes[p] for p in positions]
+        return {
+            "current_path": str(path),
+            "parent": str(path.parent) if path.parent != path else None,
+            "entries": {column: [getattr(listing, column)[i] for i in rows] for column in DIRECTORY_COLUMNS},
+            "total": len(keys),
+            "cursor": cursor,
+            "next_cursor": _encode_cursor(sort, descending, keys[positions[-1]]) if more else None,
+            "cached": cached
+        }
+    except Exception as e:
+        return {"error": str(e), "current_path": current_working_dir}
+
+# ============ DISK USAGE ============
+
+# Threads listing directories in parallel for a disk usage scan
+DU_SCAN_THREADS = 8
+# Largest children reported for a disk usage breakdown
+DU_TOP_CHILDREN = 20
+# Seconds between partial totals streamed while a scan runs
+DU_PROGRESS_INTERVAL = 0.5
+# A cached directory listing is reused while the directory's mtime is unchanged, but
+# never for longer than this (in-place file growth does not touch the directory mtime)
+DU_CACHE_TTL = 600
+DU_CACHE_MAX_DIRECTORIES = 200000
+
+du_pool = ThreadPoolExecutor(max_workers=DU_SCAN_THREADS, thread_name_prefix="du")
+
+class _DirectoryUsage:
+    """What one directory holds directly: its files (hard links kept apart) and subdirectories."""
+
+    __slots__ = ("mtime", "listed_at", "size", "disk", "files", "subdirs", "links")
+
+    def __init__(self, mtime, size, disk, files, subdirs, links):
+        self.mtime = mtime
+        self.listed_at = time.monotonic()
+        self.size = size
+        self.disk = disk
+        self.files = files
+        self.subdirs = subdirs
+        # (st_dev, st_ino) -> (size, disk) for files with more than one link, counted once per scan
+        self.links = links
+
+def _allocated(stat):
+    blocks = getattr(stat, "st_blocks", None)
+    return blocks * 512 if blocks is not None else stat.st_size
+
+class DiskUsageScanner:
+    """du built on os.scandir: DirEntry stat data, parallel listing, per-directory cache.
+
+    Directories are listed on du_pool; the scanning thread only hands out work and adds
+    up results, so no pool thread ever waits on another. Each directory's direct
+    contents are cached by its mtime, so a repeated scan only re-lists directories
+    where entries were added, removed or renamed. Hard links are counted once, symlinks
+    are not followed, and by default the scan stays on the starting filesystem.
+    """
+
+    def __init__(self):
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def _visit(self, path, device):
+        """Direct contents of one directory (cached when unchanged), or None if unreadable."""
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None, False
+        cached = self.cache.get(path)
+        if cached and cached.mtime == mtime and time.monotonic() - cached.listed_at < DU_CACHE_TTL:
+            return cached, True
+
+        size = disk = files = 0
+        subdirs, links = [], {}
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        stat = entry.stat(follow_symlinks=False)
+                        if entry.is_dir(follow_symlinks=False):
+                            if device is None or stat.st_dev == device:
+                                subdirs.append(entry.path)
+                            continue
+                    except OSError:
+                        continue
+                    if stat.st_nlink > 1 and not entry.is_symlink():
+                        links[(stat.st_dev, stat.st_ino)] = (stat.st_size, _allocated(stat))
+                    else:
+                        size += stat.st_size
+                        disk += _allocated(stat)
+                        files += 1
+        except OSError:
+            return None, False
+
+        usage = _DirectoryUsage(mtime, size, disk, files, subdirs, links)
+        with self.lock:
+            if len(self.cache) >= DU_CACHE_MAX_DIRECTORIES:
+                # Drop the oldest half; dicts keep insertion order
+                for key in list(self.cache)[:DU_CACHE_MAX_DIRECTORIES // 2]:
+                    del self.cache[key]
+            self.cache[path] = usage
+        return usage, False
+
+    def scan(self, root, progress=None, one_file_system=True):
+        """Walk ``root``; returns {directory: _DirectoryUsage} plus scan counters."""
+        device = os.stat(root).st_dev if one_file_system else None
+        found = {}
+        stats = {"scanned_directories": 0, "cached_directories": 0, "unreadable_directories": 0}
+        running = {"total_size": 0, "disk_usage": 0, "file_count": 0, "directory_count": 0}
+        seen_links = set()
+        next_report = time.monotonic() + DU_PROGRESS_INTERVAL
+
+        pending = {du_pool.submit(self._visit, root, device): root}
+        while pending:
+            done, _ = concurrent.futures.wait(pending, timeout=DU_PROGRESS_INTERVAL,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                usage, cached = future.result()
+                if usage is None:
+                    stats["unreadable_directories"] += 1
+                    continue
+                found[path] = usage
+                stats["cached_directories" if cached else "scanned_directories"] += 1
+                running["total_size"] += usage.size
+                running["disk_usage"] += usage.disk
+                running["file_count"] += usage.files
+                running["directory_count"] += len(usage.subdirs)
+                for key, (size, disk) in usage.links.items():
+                    if key not in seen_links:
+                        seen_links.add(key)
+                        running["total_size"] += size
+                        running["disk_usage"] += disk
+                        running["file_count"] += 1
+                for subdir in usage.subdirs:
+                    pending[du_pool.submit(self._visit, subdir, device)] = subdir
+
+            if progress and time.monotonic() >= next_report:
+                next_report = time.monotonic() + DU_PROGRESS_INTERVAL
+                progress({**running, "pending_directories": len(pending)})
+        return found, stats
+
+    def totals(self, found, root):
+        """Totals of the root and of each of its subdirectories, added up bottom-up from
+        the deepest directory; a hard link counts once per subtree."""
+        subtotals = {}
+        for path in sorted(found, key=lambda p: p.count(os.sep), reverse=True):
+            usage = found[path]
+            size, disk, files, dirs = usage.size, usage.disk, usage.files, len(usage.subdirs)
+            links = dict(usage.links)
+            for subdir in usage.subdirs:
+                # Deeper totals are needed once; the root's children stay for the breakdown
+                child = subtotals.get(subdir) if path == root else subtotals.pop(subdir, None)
+                if child:
+                    size, disk = size + child[0], disk + child[1]
+                    files, dirs = files + child[2], dirs + child[3]
+                    links.update(child[4])
+            subtotals[path] = (size, disk, files, dirs, links)
+
+        result = {}
+        for path in [root] + found[root].subdirs if root in found else []:
+            if path in subtotals:
+                size, disk, files, dirs, links = subtotals[path]
+                result[path] = (size + sum(s for s, _ in links.values()),
+                                disk + sum(d for _, d in links.values()),
+                                files + len(links), dirs)
+        return result
+
+disk_usage_scanner = DiskUsageScanner()
+
+class DiskUsageProgress:
+    """Progress callback for a scan running on a worker thread: streams partial totals
+    to the requesting dashboard, latest wins, tagged with the request's id.
+
+    ``close()`` (on the event loop, before the response is sent) withdraws an unsent
+    update and ignores any still on their way from the scan thread, so no progress
+    follows the final result.
+    """
+
+    def __init__(self, dispatcher, data):
+        self.loop = asyncio.get_running_loop()
+        self.dispatcher = dispatcher
+        self.request_id = data.get("request_id")
+        self.key = ("disk_usage", self.request_id)
+        self.path = data.get("path", ".")
+        self.closed = False
+
+    def __call__(self, partial):
+        message = {
+            "type": "disk_usage_progress",
+            "device_id": self.dispatcher.device_id,
+            "request_id": self.request_id,
+            "path": self.path,
+            **partial
+        }
+        self.loop.call_soon_threadsafe(self._post, message)
+
+    def _post(self, message):
+        if not self.closed:
+            self.dispatcher.sender.send_latest(self.key, message)
+
+    def close(self):
+        self.closed = True
+        self.dispatcher.sender.discard_latest(self.key)
+
+def get_disk_usage(path_str=".", top=DU_TOP_CHILDREN, progress=None, one_file_system=True):
+    """Get disk usage for a specific path, with a breakdown of its largest children."""
     global current_working_dir
     try:
         if path_str == ".":
@@ -463,193 +1219,1654 @@ def get_disk_usage(path_str="."):
         if path.is_file():
             return {"size": path.stat().st_size}
         elif path.is_dir():
-            total_size = 0
-            file_count = 0
-            dir_count = 0
-            
-            for item in path.rglob('*'):
-                try:
-                    if item.is_file():
-                        total_size += item.stat().st_size
-                        file_count += 1
-                    elif item.is_dir():
-                        dir_count += 1
-                except (PermissionError, OSError):
-                    continue
-            
+            started = time.perf_counter()
+            root = os.path.abspath(path_str)
+            found, stats = disk_usage_scanner.scan(root, progress, one_file_system)
+            totals = disk_usage_scanner.totals(found, root)
+            if root not in totals:
+                return {"error": f"Permission denied: {root}"}
+
+            children = []
+            for child in found[root].subdirs:
+                if child in totals:
+                    size, disk, files, dirs = totals[child]
+                    children.append({
+                        "name": os.path.basename(child),
+                        "path": child,
+                        "type": "directory",
+                        "size": size,
+                        "disk_usage": disk,
+                        "file_count": files,
+                        "directory_count": dirs
+                    })
+            # Files directly in the root compete for the top spots too
+            with os.scandir(root) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            continue
+                        stat = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    children.append({
+                        "name": entry.name,
+                        "path": entry.path,
+                        "type": "file",
+                        "size": stat.st_size,
+                        "disk_usage": _allocated(stat)
+                    })
+            children.sort(key=lambda item: item["disk_usage"], reverse=True)
+            rest = children[top:]
+
+            total_size, disk_usage, file_count, dir_count = totals[root]
             return {
+                "path": root,
                 "total_size": total_size,
+                "disk_usage": disk_usage,
                 "file_count": file_count,
-                "directory_count": dir_count
+                "directory_count": dir_count,
+                "children": children[:top],
+                "other": {
+                    "count": len(rest),
+                    "size": sum(item["size"] for item in rest),
+                    "disk_usage": sum(item["disk_usage"] for item in rest)
+                },
+                **stats,
+                "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)
             }
+        else:
+            return {"error": f"Path not found: {path_str}"}
+    except Exception as e:
+        return {"error": str(e)}
+
+# ============ FILENAME INDEX ============
+
+# Directories indexed for search_files, and where the index lives
+FILE_INDEX_ROOTS = [str(Path.home())]
+FILE_INDEX_PATH = os.path.join(str(Path.home()), ".omni-agent", "file_index.sqlite3")
+# Pseudo filesystems that are never walked
+FILE_INDEX_EXCLUDE = {"/proc", "/sys", "/dev", "/run"}
+# Without inotify (or once its watch limit is reached) directories are re-checked by mtime this often
+FILE_INDEX_RESCAN_INTERVAL = 300
+# Filesystem events are collected this long before the affected directories are re-listed
+FILE_INDEX_DEBOUNCE = 0.5
+MAX_SEARCH_RESULTS = 500
+
+try:
+    from config import FILE_INDEX_ROOTS
+except ImportError:
+    pass
+
+def _subtree_bounds(path):
+    """Key range of everything below ``path``: the separator sorts just before its successor."""
+    base = path.rstrip(os.sep)
+    return base + os.sep, base + chr(ord(os.sep) + 1)
+
+@functools.lru_cache(maxsize=64)
+def _compile_search_regex(pattern):
+    return re.compile(pattern, re.IGNORECASE)
+
+def _sqlite_regexp(pattern, value):
+    return value is not None and _compile_search_regex(pattern).search(value) is not None
+
+def _sqlite_glob(pattern):
+    """Translate an fnmatch pattern to SQLite GLOB; also returns the longest literal run
+    outside wildcards and bracket expressions (for the trigram prefilter)."""
+    parts, literals, literal = [], [], ""
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c in "*?":
+            parts.append(c)
+            literals.append(literal)
+            literal = ""
+        elif c == "[":
+            # Same bracket parsing as fnmatch: "!" negates, a leading "]" is a member
+            j = i
+            if j < n and pattern[j] == "!":
+                j += 1
+            if j < n and pattern[j] == "]":
+                j += 1
+            while j < n and pattern[j] != "]":
+                j += 1
+            if j >= n:
+                # Unclosed: fnmatch takes the "[" literally
+                parts.append("[[]")
+                literal += c
+                continue
+            body = pattern[i:j]
+            i = j + 1
+            if body.startswith("!"):
+                body = "^" + body[1:]
+            elif body.startswith("^"):
+                # A literal "^" for fnmatch; SQLite would read it as negation
+                body = body[1:] + "^" if len(body) > 1 else ""
+            parts.append("[" + body + "]" if body else "^")
+            literals.append(literal)
+            literal = ""
+        else:
+            parts.append(c)
+            literal += c
+    literals.append(literal)
+    return "".join(parts), max(literals, key=len)
+
+class _Inotify:
+    """Minimal inotify binding (ctypes) reporting which watched directories changed."""
+
+    MASK = (0x00000004 | 0x00000008 | 0x00000040 | 0x00000080 | 0x00000100 | 0x00000200
+            | 0x00000400 | 0x00000800)  # ATTRIB CLOSE_WRITE MOVED_FROM MOVED_TO CREATE DELETE DELETE_SELF MOVE_SELF
+    ONLYDIR_FLAGS = 0x01000000 | 0x02000000 | 0x04000000  # ONLYDIR DONT_FOLLOW EXCL_UNLINK
+    Q_OVERFLOW = 0x00004000
+    IGNORED = 0x00008000
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self):
+        self.libc = libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(0o2000000)  # IN_CLOEXEC
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}  # wd -> directory
+        self.wds = {}  # directory -> wd
+        # Watched directories in sorted order, so a subtree is one contiguous slice; built
+        # on the first removal (the initial walk only adds) and kept in order after that
+        self.ordered = None
+        self.exhausted = False
+
+    def add(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK | self.ONLYDIR_FLAGS)
+        if wd < 0:
+            if ctypes.get_errno() == 28:  # ENOSPC: out of watches (fs.inotify.max_user_watches)
+                self.exhausted = True
+            return False
+        previous = self.watches.get(wd)
+        if previous is not None and previous != directory:
+            # The same directory under a new name (it was moved): the old name is gone
+            self._unindex(previous, wd)
+        self.watches[wd] = directory
+        if directory not in self.wds and self.ordered is not None:
+            bisect.insort(self.ordered, directory)
+        self.wds[directory] = wd
+        return True
+
+    def _unindex(self, directory, wd):
+        if self.wds.get(directory) != wd:
+            return
+        del self.wds[directory]
+        if self.ordered is not None:
+            i = bisect.bisect_left(self.ordered, directory)
+            if i < len(self.ordered) and self.ordered[i] == directory:
+                del self.ordered[i]
+
+    def remove_subtree(self, directory):
+        if self.ordered is None:
+            self.ordered = sorted(self.wds)
+        low, high = _subtree_bounds(directory)
+        start, end = bisect.bisect_left(self.ordered, low), bisect.bisect_left(self.ordered, high)
+        removed = self.ordered[start:end]
+        del self.ordered[start:end]
+        if directory in self.wds:
+            # Not part of the slice: names like "dir-x" sort between "dir" and "dir/"
+            del self.ordered[bisect.bisect_left(self.ordered, directory)]
+            removed.append(directory)
+        for path in removed:
+            wd = self.wds.pop(path, None)
+            if wd is not None and self.watches.get(wd) == path:
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def read(self, timeout):
+        """Directories with changes (None means events were lost), or an empty set on timeout."""
+        import select
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        data = os.read(self.fd, 256 * 1024)
+        changed, offset = set(), 0
+        while offset < len(data):
+            wd, mask, _, name_length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size + name_length
+            if mask & self.Q_OVERFLOW:
+                return None
+            if mask & self.IGNORED:
+                directory = self.watches.pop(wd, None)
+                if directory is not None:
+                    self._unindex(directory, wd)
+            elif wd in self.watches:
+                changed.add(self.watches[wd])
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+class FileIndex:
+    """Filename index over FILE_INDEX_ROOTS, kept in SQLite and updated in the background.
+
+    The first walk lists every directory; afterwards a directory is only re-listed
+    when inotify reports a change in it, or (without inotify) when its mtime differs
+    from the one recorded when it was last listed. Names are searched through an FTS5
+    trigram table, so substring and glob queries do not scan the whole index.
+    """
+
+    def __init__(self, db_path=FILE_INDEX_PATH, roots=None):
+        self.db_path = db_path
+        self.roots = [os.path.abspath(os.path.expanduser(root)) for root in (roots or FILE_INDEX_ROOTS)]
+        self.local = threading.local()
+        self.ready = threading.Event()
+        self.thread = None
+        self.inotify = None
+        self.fts = False
+        self.status = "stopped"
+
+    def _connect(self):
+        """One connection per thread; WAL lets searches run while the walker writes."""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.create_function("regexp", 2, _sqlite_regexp, deterministic=True)
+            self.local.conn = conn
+        return conn
+
+    def _create_schema(self):
+        conn = self._connect()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                path TEXT PRIMARY KEY,
+                parent TEXT NOT NULL,
+                name TEXT NOT NULL,
+                name_lower TEXT NOT NULL,
+                is_dir INTEGER NOT NULL,
+                size INTEGER,
+                mtime REAL,
+                depth INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_parent ON entries(parent);
+        """)
+        try:
+            conn.executescript("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(
+                    name_lower, content='entries', content_rowid='rowid', tokenize='trigram');
+                CREATE TRIGGER IF NOT EXISTS entries_fts_insert AFTER INSERT ON entries BEGIN
+                    INSERT INTO entries_fts(rowid, name_lower) VALUES (new.rowid, new.name_lower);
+                END;
+                CREATE TRIGGER IF NOT EXISTS entries_fts_delete AFTER DELETE ON entries BEGIN
+                    INSERT INTO entries_fts(entries_fts, rowid, name_lower) VALUES ('delete', old.rowid, old.name_lower);
+                END;
+            """)
+            self.fts = True
+        except sqlite3.OperationalError:
+            # SQLite without FTS5 trigrams (< 3.34): queries scan the name column instead
+            self.fts = False
+        conn.commit()
+
+    def start(self):
+        """Build (or catch up) the index in a background thread, then keep it current."""
+        if self.thread:
+            return
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self._create_schema()
+        self.thread = threading.Thread(target=self._run, name="file-index", daemon=True)
+        self.thread.start()
+
+    def covers(self, path):
+        path = os.path.abspath(path)
+        return any(path == root or path.startswith(root.rstrip(os.sep) + os.sep) for root in self.roots)
+
+    # --- maintenance (index thread only) ---
+
+    def _run(self):
+        try:
+            if platform.system() == "Linux":
+                try:
+                    self.inotify = _Inotify()
+                except Exception as e:
+                    print(f"File index: inotify unavailable ({e}), using mtime rescans")
+            self.status = "building"
+            started = time.time()
+            self._scan()
+            self.ready.set()
+            print(f"File index ready in {time.time() - started:.1f}s")
+
+            while True:
+                if self.inotify and not self.inotify.exhausted:
+                    self.status = "watching"
+                    changed = self.inotify.read(FILE_INDEX_RESCAN_INTERVAL)
+                    if changed is None:
+                        # Kernel queue overflowed: events were lost
+                        self._scan()
+                        continue
+                    if changed:
+                        deadline = time.monotonic() + FILE_INDEX_DEBOUNCE
+                        while changed is not None and time.monotonic() < deadline:
+                            more = self.inotify.read(max(0.0, deadline - time.monotonic()))
+                            changed = None if more is None else changed | more
+                        if changed is None:
+                            self._scan()
+                            continue
+                        for directory in sorted(changed):
+                            self._sync_directory(directory)
+                else:
+                    self.status = "polling"
+                    time.sleep(FILE_INDEX_RESCAN_INTERVAL)
+                    self._scan()
+        except Exception as e:
+            self.status = f"error: {e}"
+            print(f"File index stopped: {e}")
+
+    def _scan(self):
+        """Walk all roots, re-listing only directories whose mtime changed since last listed."""
+        conn = self._connect()
+        for root in self.roots:
+            if not os.path.isdir(root):
+                continue
+            if conn.execute("SELECT 1 FROM entries WHERE path = ?", (root,)).fetchone() is None:
+                self._upsert(conn, [self._row(root, os.path.basename(root) or root, True, None, None)])
+            pending = [root]
+            while pending:
+                directory = pending.pop()
+                try:
+                    mtime = os.stat(directory).st_mtime
+                except OSError:
+                    continue
+                if self.inotify and not self.inotify.exhausted:
+                    self.inotify.add(directory)
+                stored = conn.execute("SELECT mtime FROM entries WHERE path = ?", (directory,)).fetchone()
+                if stored and stored[0] == mtime:
+                    pending.extend(row[0] for row in conn.execute(
+                        "SELECT path FROM entries WHERE parent = ? AND is_dir = 1", (directory,)))
+                else:
+                    pending.extend(self._sync_directory(directory, recurse=False))
+        conn.commit()
+
+    def _row(self, path, name, is_dir, size, mtime):
+        return (path, os.path.dirname(path), name, name.lower(), int(is_dir), size, mtime, path.count(os.sep))
+
+    def _upsert(self, conn, rows):
+        # A directory's mtime is only recorded by listing it (see _sync_directory)
+        conn.executemany("""
+            INSERT INTO entries (path, parent, name, name_lower, is_dir, size, mtime, depth)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(path) DO UPDATE SET size = excluded.size,
+                mtime = CASE WHEN entries.is_dir THEN entries.mtime ELSE excluded.mtime END
+        """, rows)
+
+    def _delete_subtree(self, conn, path):
+        low, high = _subtree_bounds(path)
+        conn.execute("DELETE FROM entries WHERE path = ? OR (path >= ? AND path < ?)", (path, low, high))
+        if self.inotify:
+            self.inotify.remove_subtree(path)
+
+    def _sync_directory(self, directory, recurse=True):
+        """Re-list one directory against the index. Returns its subdirectories that still
+        need walking (new ones, or all of them when ``recurse`` is False)."""
+        conn = self._connect()
+        try:
+            mtime = os.stat(directory).st_mtime
+            listing = {}
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.path in FILE_INDEX_EXCLUDE:
+                        continue
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                        stat = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    listing[entry.path] = self._row(entry.path, entry.name, is_dir,
+                                                    0 if is_dir else stat.st_size,
+                                                    None if is_dir else stat.st_mtime)
+        except FileNotFoundError:
+            self._delete_subtree(conn, directory)
+            conn.commit()
+            return []
+        except (PermissionError, NotADirectoryError, OSError):
+            return []
+
+        known = {path: is_dir for path, is_dir in conn.execute(
+            "SELECT path, is_dir FROM entries WHERE parent = ?", (directory,))}
+        for path, is_dir in list(known.items()):
+            if path not in listing or bool(is_dir) != bool(listing[path][4]):
+                # Gone, or replaced by an entry of the other kind
+                self._delete_subtree(conn, path)
+                del known[path]
+        self._upsert(conn, listing.values())
+        conn.execute("UPDATE entries SET mtime = ? WHERE path = ?", (mtime, directory))
+        conn.commit()
+
+        subdirectories = [path for path, row in listing.items() if row[4]]
+        if not recurse:
+            return subdirectories
+
+        # Walk directories that appeared (created, or moved in) right away
+        new = [path for path in subdirectories if path not in known]
+        pending = list(new)
+        while pending:
+            path = pending.pop()
+            if self.inotify and not self.inotify.exhausted:
+                self.inotify.add(path)
+            pending.extend(self._sync_directory(path, recurse=False))
+        return new
+
+    # --- queries (any thread) ---
+
+    def search(self, query, mode="substring", scope=None, limit=50, offset=0):
+        """Ranked, paginated name search. ``mode`` is substring, glob or regex."""
+        conn = self._connect()
+        needle = query.lower()
+        where, params = [], []
+
+        if scope:
+            scope = os.path.abspath(scope)
+            low, high = _subtree_bounds(scope)
+            where.append("path >= ? AND path < ?")
+            params += [low, high]
+
+        literal = needle
+        if mode == "glob":
+            # The longest run without wildcards narrows the candidates through the trigram index
+            pattern, literal = _sqlite_glob(needle)
+            where.append("name_lower GLOB ?")
+            params.append(pattern)
+        elif mode == "regex":
+            _compile_search_regex(query)  # raises re.error for a bad pattern
+            where.append("regexp(?, name)")
+            params.append(query)
+            literal = ""
+        else:
+            where.append("instr(name_lower, ?) > 0")
+            params.append(needle)
+
+        if self.fts and len(literal) >= 3:
+            where.append("rowid IN (SELECT rowid FROM entries_fts WHERE entries_fts MATCH ?)")
+            params.append('"' + literal.replace('"', '""') + '"')
+
+        # Exact names first, then prefixes, then shallower and shorter paths
+        order = "depth, length(name), path"
+        order_params = []
+        if mode == "substring":
+            order = "(name_lower = ?) DESC, (substr(name_lower, 1, ?) = ?) DESC, " + order
+            order_params = [needle, len(needle), needle]
+
+        rows = conn.execute(
+            f"SELECT path, parent, name, is_dir, size, mtime FROM entries WHERE {' AND '.join(where)} "
+            f"ORDER BY {order} LIMIT ? OFFSET ?",
+            params + order_params + [limit + 1, offset]).fetchall()
+
+        results = [{
+            "name": name,
+            "type": "directory" if is_dir else "file",
+            "size": size or 0,
+            "modified": time.ctime(mtime) if mtime else None,
+            "path": path,
+            "parent": parent
+        } for path, parent, name, is_dir, size, mtime in rows[:limit]]
+        return results, (offset + limit if len(rows) > limit else None)
+
+file_index = FileIndex()
+
+# ============ STREAMING FILE TRANSFER ============
+
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+MAX_DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+# Unacknowledged chunks allowed in flight per transfer
+DOWNLOAD_WINDOW = 8
+# A transfer whose receiver sends no ack for this long is abandoned
+TRANSFER_ACK_TIMEOUT = 60.0
+
+def encode_frame(header, payload=b""):
+    """Binary WebSocket frame: 4-byte big-endian header length, JSON header, raw payload."""
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    return struct.pack("!I", len(header_bytes)) + header_bytes + payload
+
+def decode_frame(frame):
+    """Split a binary frame into its header dict and a zero-copy view of the payload."""
+    view = memoryview(frame)
+    (header_length,) = struct.unpack_from("!I", view)
+    header = json.loads(bytes(view[4:4 + header_length]))
+    return header, view[4 + header_length:]
+
+class DownloadTransfer:
+    """Flow-control state for one streaming download."""
+
+    def __init__(self, transfer_id):
+        self.transfer_id = transfer_id
+        self.acked_seq = -1
+        self.ack_event = asyncio.Event()
+        self.cancelled = False
+
+    def ack(self, seq):
+        if seq is not None and seq > self.acked_seq:
+            self.acked_seq = seq
+            self.ack_event.set()
+
+    def cancel(self):
+        self.cancelled = True
+        self.ack_event.set()
+
+    async def wait_for_window(self, seq, window):
+        while seq - self.acked_seq > window and not self.cancelled:
+            self.ack_event.clear()
+            await asyncio.wait_for(self.ack_event.wait(), timeout=TRANSFER_ACK_TIMEOUT)
+
+active_transfers = {}
+
+def _read_chunk(handle, size):
+    data = handle.read(size)
+    return data, hashlib.sha256(data).hexdigest()
+
+async def stream_download(dispatcher, data):
+    """Stream a file as binary chunk frames, resuming from ``offset`` if given.
+
+    Sends a ``download_start`` message, then ``download_chunk`` frames carrying
+    offset, sequence number and a SHA-256 of the chunk. At most ``window`` chunks
+    are sent ahead of the receiver's ``transfer_ack`` messages. The returned result
+    is sent as the final response.
+    """
+    try:
+        path = Path(data["file_path"])
+        if not path.exists() or not path.is_file():
+            return {"error": "File not found or is not a file"}
+
+        file_size = path.stat().st_size
+        offset = max(0, int(data.get("offset", 0)))
+        if offset > file_size:
+            return {"error": f"Offset {offset} is past end of file ({file_size} bytes)"}
+        chunk_size = max(1024, min(MAX_DOWNLOAD_CHUNK_SIZE, int(data.get("chunk_size", DOWNLOAD_CHUNK_SIZE))))
+        window = max(1, int(data.get("window", DOWNLOAD_WINDOW)))
+    except (KeyError, TypeError, ValueError, OSError) as e:
+        return {"error": str(e)}
+
+    request_id = data.get("request_id")
+    transfer = DownloadTransfer(data.get("transfer_id") or uuid.uuid4().hex)
+    active_transfers[transfer.transfer_id] = transfer
+    try:
+        await dispatcher.send({
+            "type": "download_start",
+            "device_id": dispatcher.device_id,
+            "request_id": request_id,
+            "transfer_id": transfer.transfer_id,
+            "filename": path.name,
+            "size": file_size,
+            "offset": offset,
+            "chunk_size": chunk_size,
+            "mime_type": "application/octet-stream"
+        })
+
+        handle = await run_blocking(open, path, "rb")
+        try:
+            await run_blocking(handle.seek, offset)
+            seq = 0
+            position = offset
+            while position < file_size:
+                await transfer.wait_for_window(seq, window)
+                if transfer.cancelled:
+                    return {"error": "Transfer cancelled", "transfer_id": transfer.transfer_id, "offset": position}
+
+                chunk, digest = await run_blocking(_read_chunk, handle, chunk_size)
+                if not chunk:
+                    break
+                await dispatcher.sender.send(encode_frame({
+                    "type": "download_chunk",
+                    "device_id": dispatcher.device_id,
+                    "request_id": request_id,
+                    "transfer_id": transfer.transfer_id,
+                    "seq": seq,
+                    "offset": position,
+                    "length": len(chunk),
+                    "sha256": digest
+                }, chunk))
+                position += len(chunk)
+                seq += 1
+
+            # Complete means received: the response must not overtake the last chunks
+            await transfer.wait_for_window(seq - 1, 0)
+            if transfer.cancelled:
+                return {"error": "Transfer cancelled", "transfer_id": transfer.transfer_id, "offset": position}
+        finally:
+            await run_blocking(handle.close)
+
+        return {
+            "transfer_id": transfer.transfer_id,
+            "filename": path.name,
+            "size": file_size,
+            "offset": offset,
+            "bytes_sent": position - offset,
+            "chunks": seq,
+            "complete": position >= file_size
+        }
+    except asyncio.TimeoutError:
+        return {"error": "Transfer stalled: no acknowledgement from receiver", "transfer_id": transfer.transfer_id}
     except Exception as e:
+        return {"error": str(e), "transfer_id": transfer.transfer_id}
+    finally:
+        active_transfers.pop(transfer.transfer_id, None)
+
+def handle_transfer_control(data):
+    """Apply an ack or cancel from the receiving side of a transfer."""
+    transfer = active_transfers.get(data.get("transfer_id"))
+    if not transfer:
+        return
+    if data.get("type") == "transfer_ack":
+        transfer.ack(data.get("seq"))
+    elif data.get("type") == "transfer_cancel":
+        transfer.cancel()
+
+UPLOAD_CHUNK_SIZE = 256 * 1024
+# Unfinished upload sessions (and their temp files) are kept this long for resume
+UPLOAD_SESSION_TTL = 3600.0
+# Seconds between sweeps for upload sessions past their TTL
+UPLOAD_REAP_INTERVAL = 60
+
+def _add_range(ranges, start, end):
+    """Merge [start, end) into a sorted list of disjoint [start, end) ranges."""
+    merged = []
+    for range_start, range_end in ranges:
+        if range_end < start or range_start > end:
+            merged.append([range_start, range_end])
+        else:
+            start, end = min(start, range_start), max(end, range_end)
+    merged.append([start, end])
+    merged.sort()
+    return merged
+
+def _fsync_directory(path):
+    # Makes the rename durable; not supported on Windows
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class UploadSession:
+    """A multi-part upload written into a temp file beside its destination.
+
+    Chunks may arrive in any order (or in parallel); the session tracks which byte
+    ranges have been written so an interrupted upload can resume. Committing fsyncs
+    the temp file and renames it over the destination atomically.
+    """
+
+    def __init__(self, upload_id, path, size, overwrite=False):
+        self.upload_id = upload_id
+        self.path = path
+        self.temp_path = path.with_name(f".{path.name}.{upload_id}.part")
+        self.size = size
+        self.overwrite = overwrite
+        self.ranges = []
+        self.lock = threading.Lock()
+        self.handle = open(self.temp_path, "w+b")
+        self.last_activity = time.monotonic()
+        # The request currently driving this session, and how it will finish
+        self.dispatcher = None
+        self.request_id = None
+        self.finish = None
+
+    @property
+    def bytes_received(self):
+        return sum(end - start for start, end in self.ranges)
+
+    def is_complete(self):
+        return self.size == 0 or self.ranges == [[0, self.size]]
+
+    def attach(self, dispatcher, request_id):
+        if self.finish and not self.finish.done():
+            self.finish.set_result("superseded")
+        self.dispatcher = dispatcher
+        self.request_id = request_id
+        self.finish = asyncio.get_running_loop().create_future()
+        return self.finish
+
+    def resolve(self, action):
+        if self.finish and not self.finish.done():
+            self.finish.set_result(action)
+
+    def write_chunk(self, offset, payload, sha256=None):
+        if sha256 and hashlib.sha256(payload).hexdigest() != sha256:
+            raise ValueError("Chunk failed integrity check")
+        if offset < 0 or offset + len(payload) > self.size:
+            raise ValueError(f"Chunk at {offset} (+{len(payload)}) is outside the {self.size}-byte file")
+        with self.lock:
+            self.handle.seek(offset)
+            self.handle.write(payload)
+            self.ranges = _add_range(self.ranges, offset, offset + len(payload))
+        self.last_activity = time.monotonic()
+
+    def commit(self):
+        with self.lock:
+            self.handle.flush()
+            os.fsync(self.handle.fileno())
+            self.handle.close()
+        if self.path.exists() and not self.overwrite:
+            raise FileExistsError("File already exists")
+        os.replace(self.temp_path, self.path)
+        _fsync_directory(self.path.parent)
+
+    def discard(self):
+        with self.lock:
+            if not self.handle.closed:
+                self.handle.close()
+        try:
+            self.temp_path.unlink()
+        except FileNotFoundError:
+            pass
+
+upload_sessions = {}
+
+def _expired_upload_sessions():
+    """Remove and return the sessions idle past UPLOAD_SESSION_TTL."""
+    now = time.monotonic()
+    expired = []
+    for upload_id, session in list(upload_sessions.items()):
+        idle = session.finish is None or session.finish.done()
+        if idle and now - session.last_activity > UPLOAD_SESSION_TTL:
+            del upload_sessions[upload_id]
+            expired.append(session)
+    return expired
+
+def _reap_upload_sessions():
+    for session in _expired_upload_sessions():
+        session.discard()
+
+async def reap_upload_sessions():
+    """Discard abandoned uploads (open handle and temp file) even when no new upload starts."""
+    while True:
+        await asyncio.sleep(UPLOAD_REAP_INTERVAL)
+        for session in _expired_upload_sessions():
+            await run_blocking(session.discard)
+
+async def stream_upload(dispatcher, data):
+    """Open (or resume) an upload session and wait for it to be committed or aborted.
+
+    Replies with an ``upload_ready`` message listing the byte ranges already
+    received; the client then sends ``upload_chunk`` binary frames (acked with
+    ``upload_ack``) and finally ``upload_commit``. Passing the ``upload_id`` of an
+    existing session resumes it; a new one may be given to name the session.
+    """
+    _reap_upload_sessions()
+    request_id = data.get("request_id")
+    session = upload_sessions.get(data.get("upload_id"))
+    try:
+        if session is None:
+            path = Path(data["file_path"])
+            size = int(data["size"])
+            overwrite = bool(data.get("overwrite", False))
+            if size < 0:
+                return {"error": f"Invalid size: {size}"}
+            if path.exists() and not overwrite:
+                return {"error": "File already exists"}
+            # Clients may pick the id up front so they can resume without waiting for a reply
+            upload_id = data.get("upload_id") or uuid.uuid4().hex
+            if not re.fullmatch(r"[A-Za-z0-9_-]{1,64}", upload_id):
+                return {"error": f"Invalid upload_id: {upload_id}"}
+            session = await run_blocking(UploadSession, upload_id, path, size, overwrite)
+            upload_sessions[session.upload_id] = session
+    except (KeyError, TypeError, ValueError, OSError) as e:
         return {"error": str(e)}
 
+    finish = session.attach(dispatcher, request_id)
+    await dispatcher.send({
+        "type": "upload_ready",
+        "device_id": dispatcher.device_id,
+        "request_id": request_id,
+        "upload_id": session.upload_id,
+        "file_path": str(session.path),
+        "size": session.size,
+        "chunk_size": UPLOAD_CHUNK_SIZE,
+        "received": session.ranges
+    })
+
+    # Cancellation (connection lost) leaves the session in place for resume
+    action = await finish
+    if action == "superseded":
+        return {"error": "Upload resumed by another request", "upload_id": session.upload_id}
+    if action == "abort":
+        upload_sessions.pop(session.upload_id, None)
+        await run_blocking(session.discard)
+        return {"error": "Upload aborted", "upload_id": session.upload_id}
+    if not session.is_complete():
+        return {
+            "error": "Upload incomplete",
+            "upload_id": session.upload_id,
+            "received": session.ranges,
+            "size": session.size
+        }
+
+    upload_sessions.pop(session.upload_id, None)
+    try:
+        await run_blocking(session.commit)
+    except Exception as e:
+        await run_blocking(session.discard)
+        return {"error": str(e), "upload_id": session.upload_id}
+    return {"success": f"File {session.path.name} uploaded successfully", "size": session.size, "upload_id": session.upload_id}
+
+async def handle_upload_chunk(dispatcher, header, payload):
+    """Write one ``upload_chunk`` frame and acknowledge it."""
+    session = upload_sessions.get(header.get("upload_id"))
+    if session is None:
+        print(f"Dropping chunk for unknown upload {header.get('upload_id')}")
+        return
+
+    offset = header.get("offset", 0)
+    ack = {
+        "type": "upload_ack",
+        "device_id": dispatcher.device_id,
+        "request_id": session.request_id,
+        "upload_id": session.upload_id,
+        "offset": offset,
+        "length": len(payload)
+    }
+    try:
+        await run_blocking(session.write_chunk, offset, payload, header.get("sha256"))
+        ack["ok"] = True
+    except Exception as e:
+        ack["ok"] = False
+        ack["error"] = str(e)
+    ack["received"] = session.bytes_received
+    await dispatcher.send(ack)
+
+def handle_upload_control(data):
+    session = upload_sessions.get(data.get("upload_id"))
+    if session:
+        session.resolve("commit" if data.get("type") == "upload_commit" else "abort")
+
+# ============ SCREEN CAPTURE BACKENDS ============
+
+class CaptureBackend:
+    """Grabs the whole screen as a PIL image; chosen once by detect_capture_backend()."""
+
+    name = "none"
+
+    def open(self):
+        """Prepare the backend; raise if it cannot work on this machine."""
+
+    def grab(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class PILGrabCapture(CaptureBackend):
+    """PIL's ImageGrab, which captures in memory on Windows and macOS."""
+
+    name = "pil"
+
+    def open(self):
+        from PIL import ImageGrab
+        self.ImageGrab = ImageGrab
+        # Fails here rather than on the first frame if there is no usable display
+        self.ImageGrab.grab()
+
+    def grab(self):
+        return self.ImageGrab.grab()
+
+class _XImage(ctypes.Structure):
+    # Leading fields of Xlib's XImage, enough to read the pixels in place
+    _fields_ = [
+        ("width", ctypes.c_int),
+        ("height", ctypes.c_int),
+        ("xoffset", ctypes.c_int),
+        ("format", ctypes.c_int),
+        ("data", ctypes.c_void_p),
+        ("byte_order", ctypes.c_int),
+        ("bitmap_unit", ctypes.c_int),
+        ("bitmap_bit_order", ctypes.c_int),
+        ("bitmap_pad", ctypes.c_int),
+        ("depth", ctypes.c_int),
+        ("bytes_per_line", ctypes.c_int),
+        ("bits_per_pixel", ctypes.c_int),
+        ("red_mask", ctypes.c_ulong),
+        ("green_mask", ctypes.c_ulong),
+        ("blue_mask", ctypes.c_ulong),
+    ]
+
+class _XShmSegmentInfo(ctypes.Structure):
+    _fields_ = [
+        ("shmseg", ctypes.c_ulong),
+        ("shmid", ctypes.c_int),
+        ("shmaddr", ctypes.c_void_p),
+        ("readOnly", ctypes.c_int),
+    ]
+
+_X_ERROR_HANDLER = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p)
+_Z_PIXMAP = 2
+_ALL_PLANES = 0xFFFFFFFFFFFFFFFF if ctypes.sizeof(ctypes.c_ulong) == 8 else 0xFFFFFFFF
+_IPC_PRIVATE = 0
+_IPC_CREAT = 0o1000
+_IPC_RMID = 0
+
+class XGetImageCapture(CaptureBackend):
+    """In-memory X11 capture with XGetImage, for displays without the MIT-SHM extension."""
+
+    name = "x11"
+
+    def open(self):
+        from PIL import Image
+        self.Image = Image
+        self.lock = threading.Lock()
+        self.x_error = None
+
+        display_name = os.environ.get("DISPLAY")
+        if not display_name:
+            raise RuntimeError("DISPLAY is not set")
+        library = ctypes.util.find_library("X11")
+        if not library:
+            raise RuntimeError("libX11 not found")
+        self.xlib = xlib = ctypes.cdll.LoadLibrary(library)
+        xlib.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        xlib.XOpenDisplay.restype = ctypes.c_void_p
+        xlib.XCloseDisplay.argtypes = [ctypes.c_void_p]
+        xlib.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+        xlib.XDefaultRootWindow.restype = ctypes.c_ulong
+        xlib.XDefaultScreen.argtypes = [ctypes.c_void_p]
+        xlib.XDefaultVisual.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XDefaultVisual.restype = ctypes.c_void_p
+        xlib.XDefaultDepth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XGetGeometry.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(ctypes.c_ulong),
+                                      ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int),
+                                      ctypes.POINTER(ctypes.c_uint), ctypes.POINTER(ctypes.c_uint),
+                                      ctypes.POINTER(ctypes.c_uint), ctypes.POINTER(ctypes.c_uint)]
+        xlib.XGetImage.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.c_int, ctypes.c_int,
+                                   ctypes.c_uint, ctypes.c_uint, ctypes.c_ulong, ctypes.c_int]
+        xlib.XGetImage.restype = ctypes.POINTER(_XImage)
+        xlib.XDestroyImage.argtypes = [ctypes.POINTER(_XImage)]
+        xlib.XSync.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XSetErrorHandler.argtypes = [_X_ERROR_HANDLER]
+        xlib.XSetErrorHandler.restype = ctypes.c_void_p
+
+        # Xlib's default error handler exits the process; record errors instead
+        self._error_handler = _X_ERROR_HANDLER(self._on_x_error)
+        xlib.XSetErrorHandler(self._error_handler)
+
+        self.display = xlib.XOpenDisplay(display_name.encode())
+        if not self.display:
+            raise RuntimeError(f"Cannot open display {display_name}")
+        self.root = xlib.XDefaultRootWindow(self.display)
+        screen = xlib.XDefaultScreen(self.display)
+        self.visual = xlib.XDefaultVisual(self.display, screen)
+        self.depth = xlib.XDefaultDepth(self.display, screen)
+        if self.depth not in (24, 32):
+            self.close()
+            raise RuntimeError(f"Unsupported display depth {self.depth}")
+
+    def _on_x_error(self, display, event):
+        self.x_error = "X protocol error"
+        return 0
+
+    def _screen_size(self):
+        root, x, y = ctypes.c_ulong(), ctypes.c_int(), ctypes.c_int()
+        width, height, border, depth = ctypes.c_uint(), ctypes.c_uint(), ctypes.c_uint(), ctypes.c_uint()
+        self.xlib.XGetGeometry(self.display, self.root, ctypes.byref(root), ctypes.byref(x), ctypes.byref(y),
+                               ctypes.byref(width), ctypes.byref(height), ctypes.byref(border), ctypes.byref(depth))
+        return width.value, height.value
+
+    def _to_pil(self, ximage):
+        image = ximage.contents
+        if image.bits_per_pixel != 32 or image.red_mask != 0xFF0000 or image.blue_mask != 0xFF:
+            raise RuntimeError("Unsupported X11 pixel format")
+        size = image.bytes_per_line * image.height
+        pixels = (ctypes.c_char * size).from_address(image.data)
+        # BGRX -> RGB conversion copies, so the X buffer can be reused right away
+        return self.Image.frombuffer("RGB", (image.width, image.height), pixels,
+                                     "raw", "BGRX", image.bytes_per_line, 1)
+
+    def grab(self):
+        with self.lock:
+            width, height = self._screen_size()
+            ximage = self.xlib.XGetImage(self.display, self.root, 0, 0, width, height, _ALL_PLANES, _Z_PIXMAP)
+            if not ximage:
+                raise RuntimeError(self.x_error or "XGetImage failed")
+            try:
+                return self._to_pil(ximage)
+            finally:
+                self.xlib.XDestroyImage(ximage)
+
+    def close(self):
+        if getattr(self, "display", None):
+            self.xlib.XCloseDisplay(self.display)
+            self.display = None
+
+class XShmCapture(XGetImageCapture):
+    """In-memory X11 capture through a MIT-SHM segment shared with the X server.
+
+    The server writes each frame straight into the segment, which is allocated once
+    and reused for every grab (re-created only when the screen size changes).
+    """
+
+    name = "xshm"
+
+    def open(self):
+        super().open()
+        library = ctypes.util.find_library("Xext")
+        if not library:
+            self.close()
+            raise RuntimeError("libXext not found")
+        self.xext = xext = ctypes.cdll.LoadLibrary(library)
+        xext.XShmQueryExtension.argtypes = [ctypes.c_void_p]
+        xext.XShmCreateImage.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int,
+                                         ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo),
+                                         ctypes.c_uint, ctypes.c_uint]
+        xext.XShmCreateImage.restype = ctypes.POINTER(_XImage)
+        xext.XShmAttach.argtypes = [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]
+        xext.XShmDetach.argtypes = [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]
+        xext.XShmGetImage.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(_XImage),
+                                      ctypes.c_int, ctypes.c_int, ctypes.c_ulong]
+        self.libc = libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+        libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+        libc.shmat.restype = ctypes.c_void_p
+        libc.shmdt.argtypes = [ctypes.c_void_p]
+        libc.shmctl.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+
+        if not xext.XShmQueryExtension(self.display):
+            self.close()
+            raise RuntimeError("MIT-SHM extension not available")
+        self.ximage = None
+        self.shminfo = None
+        try:
+            # Attaching fails on remote displays even when the extension is advertised
+            self._allocate(*self._screen_size())
+        except Exception:
+            self.close()
+            raise
+
+    def _allocate(self, width, height):
+        self._release()
+        shminfo = _XShmSegmentInfo()
+        ximage = self.xext.XShmCreateImage(self.display, self.visual, self.depth, _Z_PIXMAP,
+                                           None, ctypes.byref(shminfo), width, height)
+        if not ximage:
+            raise RuntimeError("XShmCreateImage failed")
+        size = ximage.contents.bytes_per_line * ximage.contents.height
+        shminfo.shmid = self.libc.shmget(_IPC_PRIVATE, size, _IPC_CREAT | 0o600)
+        if shminfo.shmid < 0:
+            self.xlib.XDestroyImage(ximage)
+            raise OSError(ctypes.get_errno(), "shmget failed")
+        address = self.libc.shmat(shminfo.shmid, None, 0)
+        if address in (None, ctypes.c_void_p(-1).value):
+            self.libc.shmctl(shminfo.shmid, _IPC_RMID, None)
+            self.xlib.XDestroyImage(ximage)
+            raise OSError(ctypes.get_errno(), "shmat failed")
+        shminfo.shmaddr = address
+        shminfo.readOnly = 0
+        ximage.contents.data = address
+        self.ximage, self.shminfo = ximage, shminfo
+
+        self.x_error = None
+        self.xext.XShmAttach(self.display, ctypes.byref(shminfo))
+        self.xlib.XSync(self.display, 0)
+        # Marked for removal now; the kernel frees it once both sides have detached
+        self.libc.shmctl(shminfo.shmid, _IPC_RMID, None)
+        if self.x_error:
+            self.xlib.XDestroyImage(ximage)
+            self.libc.shmdt(address)
+            self.ximage = self.shminfo = None
+            raise RuntimeError(f"XShmAttach failed: {self.x_error}")
+
+    def _release(self):
+        if self.ximage:
+            self.xext.XShmDetach(self.display, ctypes.byref(self.shminfo))
+            self.xlib.XSync(self.display, 0)
+            self.xlib.XDestroyImage(self.ximage)
+            self.libc.shmdt(self.shminfo.shmaddr)
+            self.ximage = self.shminfo = None
+
+    def grab(self):
+        with self.lock:
+            width, height = self._screen_size()
+            if (width, height) != (self.ximage.contents.width, self.ximage.contents.height):
+                self._allocate(width, height)
+            if not self.xext.XShmGetImage(self.display, self.root, self.ximage, 0, 0, _ALL_PLANES):
+                raise RuntimeError(self.x_error or "XShmGetImage failed")
+            return self._to_pil(self.ximage)
+
+    def close(self):
+        if getattr(self, "display", None) and getattr(self, "ximage", None):
+            self._release()
+        super().close()
+
+class CommandCapture(CaptureBackend):
+    """External screenshot tool, for desktops where X11 cannot be read directly (e.g. Wayland).
+
+    Tools that can write the image to stdout are preferred so no file is involved.
+    """
+
+    # (tool, arguments); "{file}" marks tools that can only write to a file
+    TOOLS = [
+        ('maim', ['maim', '--format', 'png']),
+        ('import', ['import', '-window', 'root', 'png:-']),
+        ('grim', ['grim', '-t', 'png', '-']),
+        ('gnome-screenshot', ['gnome-screenshot', '-f', '{file}']),
+        ('scrot', ['scrot', '-o', '{file}']),
+    ]
+
+    def __init__(self, tool, command):
+        self.tool = tool
+        self.command = command
+        self.name = f"command:{tool}"
+
+    @classmethod
+    def detect(cls):
+        return [cls(tool, command) for tool, command in cls.TOOLS if shutil.which(tool)]
+
+    def open(self):
+        self.grab()
+
+    def grab(self):
+        if '{file}' not in self.command:
+            result = subprocess.run(self.command, capture_output=True, timeout=10)
+            data = result.stdout if result.returncode == 0 else None
+        else:
+            import tempfile
+            fd, path = tempfile.mkstemp(suffix='.png', prefix='omni_screenshot_')
+            os.close(fd)
+            try:
+                command = [path if arg == '{file}' else arg for arg in self.command]
+                result = subprocess.run(command, capture_output=True, timeout=10)
+                data = Path(path).read_bytes() if result.returncode == 0 else None
+            finally:
+                os.remove(path)
+        if not data:
+            raise RuntimeError(f"{self.tool} failed: {result.stderr.decode(errors='replace').strip()}")
+        try:
+            from PIL import Image
+        except ImportError:
+            # Without PIL the tool's PNG is passed through as is
+            return data
+        return Image.open(io.BytesIO(data))
+
+# Seconds before detection is retried when no backend worked (e.g. no display yet)
+CAPTURE_REDETECT_INTERVAL = 60
+
+_capture_backend = None
+_capture_detected_at = None
+_capture_backend_lock = threading.Lock()
+
+def detect_capture_backend():
+    """Pick the fastest screen capture backend that works here, once, and keep it."""
+    global _capture_backend, _capture_detected_at
+    with _capture_backend_lock:
+        if _capture_backend is not None:
+            return _capture_backend
+        if _capture_detected_at and time.monotonic() - _capture_detected_at < CAPTURE_REDETECT_INTERVAL:
+            return None
+        _capture_detected_at = time.monotonic()
+
+        if platform.system() == "Linux":
+            candidates = [XShmCapture(), XGetImageCapture()] + CommandCapture.detect()
+        else:
+            candidates = [PILGrabCapture()]
+        for backend in candidates:
+            try:
+                backend.open()
+            except Exception as e:
+                print(f"Screen capture backend {backend.name} unavailable: {e}")
+                continue
+            print(f"Screen capture backend: {backend.name}")
+            _capture_backend = backend
+            break
+        return _capture_backend
+
+def reset_capture_backend():
+    """Drop the cached backend (e.g. the display went away) so the next capture re-detects."""
+    global _capture_backend, _capture_detected_at
+    with _capture_backend_lock:
+        _capture_detected_at = None
+        if _capture_backend is not None:
+            try:
+                _capture_backend.close()
+            except Exception:
+                pass
+        _capture_backend = None
+
 # ============ REMOTE DESKTOP & MEDIA FEATURES ============
 
-def take_screenshot(quality='medium'):
+# Encoder presets per purpose and quality level. Only still/high is lossless (PNG); the
+# default still is a lossy WebP, since a downscaled PNG is both slower and larger than a
+# full-size one. Streams favour encode time and size. "options" are passed to PIL's save
+# for the format.
+ENCODER_PRESETS = {
+    'still': {
+        'low': {'format': 'JPEG', 'scale': 0.7, 'resample': 'BILINEAR', 'options': {'quality': 60, 'optimize': True}},
+        'medium': {'format': 'WEBP', 'scale': 0.85, 'resample': 'BILINEAR', 'reducing_gap': 2.0,
+                   'options': {'quality': 75, 'method': 0}},
+        'high': {'format': 'PNG', 'scale': 1.0, 'resample': 'LANCZOS', 'options': {}}
+    },
+    'stream': {
+        'low': {'format': 'JPEG', 'scale': 0.5, 'resample': 'BILINEAR', 'reducing_gap': 2.0,
+                'options': {'quality': 50}},
+        'medium': {'format': 'WEBP', 'scale': 0.75, 'resample': 'BILINEAR', 'reducing_gap': 2.0,
+                   'options': {'quality': 60, 'method': 0}},
+        'high': {'format': 'WEBP', 'scale': 1.0, 'resample': 'BILINEAR',
+                 'options': {'quality': 80, 'method': 0}}
+    }
+}
+
+# Presets may be overridden per purpose/quality from config.py
+try:
+    from config import ENCODER_PRESETS as _preset_overrides
+    for _purpose, _presets in _preset_overrides.items():
+        ENCODER_PRESETS.setdefault(_purpose, {}).update(_presets)
+except ImportError:
+    pass
+
+@functools.lru_cache(maxsize=None)
+def _format_supported(image_format):
+    if image_format != 'WEBP':
+        return True
+    try:
+        from PIL import features
+    except ImportError:
+        return False
+    return bool(features.check('webp'))
+
+def encoder_preset(purpose='still', quality='medium'):
+    """Preset for a purpose ('still' or 'stream') and quality level, falling back to JPEG
+    where Pillow was built without the preset's format."""
+    presets = ENCODER_PRESETS.get(purpose, ENCODER_PRESETS['still'])
+    preset = presets.get(quality, presets['medium'])
+    if not _format_supported(preset['format']):
+        preset = {**preset, 'format': 'JPEG', 'options': {'quality': preset['options'].get('quality', 75)}}
+    return preset
+
+def capture_screen(quality='medium', purpose='still'):
+    """Grab the screen through the capture backend, scaled for an encoder preset.
+
+    Returns (image, backend). The image is PNG bytes instead of a PIL image when only
+    a command backend is available and PIL is not installed.
+    """
+    preset = encoder_preset(purpose, quality)
+    backend = detect_capture_backend()
+    if backend is None:
+        raise RuntimeError("No screen capture available. Run the agent inside an X11 session or install one of: maim, imagemagick, grim, gnome-screenshot, scrot")
+    try:
+        screenshot = backend.grab()
+    except Exception as e:
+        # The display may have gone away; detect again on the next capture
+        reset_capture_backend()
+        raise RuntimeError(f"Screen capture failed ({backend.name}): {e}")
+
+    if not isinstance(screenshot, bytes) and preset['scale'] != 1.0:
+        from PIL import Image
+        new_size = (int(screenshot.width * preset['scale']), 
+                    int(screenshot.height * preset['scale']))
+        screenshot = screenshot.resize(new_size, Image.Resampling[preset['resample']],
+                                       reducing_gap=preset.get('reducing_gap'))
+    return screenshot, backend
+
+# One encode buffer per worker thread, reused for every frame; it keeps the capacity
+# of the largest frame so steady-state encodes do not reallocate
+_encode_buffers = threading.local()
+
+def encode_image(image, quality='medium', purpose='still'):
+    """Compress a PIL image with the format and options of an encoder preset."""
+    preset = encoder_preset(purpose, quality)
+    if preset['format'] in ('JPEG', 'WEBP') and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    buffer = getattr(_encode_buffers, 'buffer', None)
+    if buffer is None:
+        buffer = _encode_buffers.buffer = io.BytesIO()
+    buffer.seek(0)
+    image.save(buffer, format=preset['format'], **preset['options'])
+    size = buffer.tell()
+    with buffer.getbuffer() as view:
+        return bytes(view[:size])
+
+def take_screenshot(quality='medium', binary=False, purpose='still'):
     """Capture screenshot of the screen with quality options."""
-    import subprocess  # Import subprocess at the top
     try:
-        # Quality settings - affects compression and size
-        quality_settings = {
-            'low': {'format': 'JPEG', 'quality': 60, 'scale': 0.7},
-            'medium': {'format': 'PNG', 'quality': 80, 'scale': 0.85}, 
-            'high': {'format': 'PNG', 'quality': 95, 'scale': 1.0}
+        if detect_capture_backend() is None and platform.system() == "Windows":
+            # Fallback method
+            subprocess.run(['powershell', '-Command', 'Add-Type -AssemblyName System.Windows.Forms; [System.Windows.Forms.SendKeys]::SendWait("{PRTSC}")'], timeout=5)
+            return {"success": "Screenshot taken to clipboard"}
+
+        screenshot, backend = capture_screen(quality, purpose)
+        if isinstance(screenshot, bytes):
+            # Command backend without PIL: the tool's PNG as is
+            return {
+                "image": encode_payload(screenshot, binary),
+                "format": "PNG",
+                "quality": quality
+            }
+
+        return {
+            "image": encode_payload(encode_image(screenshot, quality, purpose), binary),
+            "width": screenshot.width,
+            "height": screenshot.height,
+            "format": encoder_preset(purpose, quality)['format'],
+            "quality": quality,
+            "backend": backend.name
         }
-        
-        settings = quality_settings.get(quality, quality_settings['medium'])
-        
-        if platform.system() == "Windows":
-            # Windows screenshot using PIL and win32
-            try:
-                from PIL import ImageGrab, Image
-                screenshot = ImageGrab.grab()
-                
-                # Scale image based on quality setting
-                if settings['scale'] != 1.0:
-                    new_size = (int(screenshot.width * settings['scale']), 
-                                int(screenshot.height * settings['scale']))
-                    screenshot = screenshot.resize(new_size, Image.Resampling.LANCZOS)
-                
-                buffer = io.BytesIO()
-                save_kwargs = {'format': settings['format']}
-                if settings['format'] == 'JPEG':
-                    save_kwargs['quality'] = settings['quality']
-                    save_kwargs['optimize'] = True
-                    
-                screenshot.save(buffer, **save_kwargs)
-                img_base64 = base64.b64encode(buffer.getvalue()).decode()
-                
-                return {
-                    "image": img_base64,
-                    "width": screenshot.width,
-                    "height": screenshot.height,
-                    "format": settings['format'],
-                    "quality": quality
-                }
-            except ImportError:
-                # Fallback method
-                subprocess.run(['powershell', '-Command', 'Add-Type -AssemblyName System.Windows.Forms; [System.Windows.Forms.SendKeys]::SendWait("{PRTSC}")'], timeout=5)
-                return {"success": "Screenshot taken to clipboard"}
+    except Exception as e:
+        return {"error": str(e)}
+
+# ============ LIVE PREVIEW STREAMS ============
+
+LIVE_PREVIEW_QUALITIES = ('low', 'medium', 'high')
+DEFAULT_LIVE_FPS = 5.0
+MIN_LIVE_FPS = 0.5
+MAX_LIVE_FPS = 30.0
+# Below this rate the stream gives up quality before frame rate
+LIVE_FPS_FLOOR = 2.0
+# A stream stops unless the dashboard renews it this often, in case it has gone away
+LIVE_PREVIEW_LEASE = 30
+# Seconds of frames picked up promptly (at least 3 frames) before the stream tries a
+# higher rate or quality
+LIVE_PREVIEW_RAMP_UP = 1.5
+# Streams send changed tiles between full keyframes
+LIVE_TILE_SIZE = 64
+LIVE_KEYFRAME_INTERVAL = 10.0
+# Past this share of the screen changed, a keyframe is cheaper than tiles
+LIVE_TILE_MAX_COVERAGE = 0.5
+
+class TileDiffEncoder:
+    """Encodes successive frames of a stream as full keyframes or changed tiles.
+
+    Frames are compared tile by tile with NumPy against the previous one, and runs of
+    changed tiles in a row are encoded as small images with their position. Without
+    NumPy a single dirty rectangle is found with PIL instead. A keyframe is sent
+    periodically, on request, when the frame size changes, or when most of the
+    screen changed anyway.
+    """
+
+    def __init__(self, tile_size=LIVE_TILE_SIZE, keyframe_interval=LIVE_KEYFRAME_INTERVAL):
+        self.tile_size = tile_size
+        self.keyframe_interval = keyframe_interval
+        self.previous = None
+        self.previous_pixels = None
+        # Comparison buffers, reused while the frame size stays the same
+        self.difference = None
+        self.changed = None
+        self.last_keyframe = 0.0
+        self.force_keyframe = True
+
+    def request_keyframe(self):
+        self.force_keyframe = True
+
+    def _changed_rects(self, image, pixels):
+        if pixels is None:
+            from PIL import ImageChops
+            bbox = ImageChops.difference(image, self.previous).getbbox()
+            return [] if bbox is None else [(bbox[0], bbox[1], bbox[2] - bbox[0], bbox[3] - bbox[1])]
+
+        tile = self.tile_size
+        height, width = pixels.shape[:2]
+        rows, cols = -(-height // tile), -(-width // tile)
+        if self.difference is None or self.difference.shape != pixels.shape:
+            self.difference = np.empty(pixels.shape, dtype=bool)
+            # Padded to whole tiles; the padding is never written and stays False
+            self.changed = np.zeros((rows * tile, cols * tile), dtype=bool)
+        np.not_equal(pixels, self.previous_pixels, out=self.difference)
+        np.any(self.difference, axis=2, out=self.changed[:height, :width])
+        grid = self.changed.reshape(rows, tile, cols, tile).any(axis=(1, 3))
+
+        rects = []
+        for row, col in zip(*np.nonzero(grid)):
+            x, y = int(col) * tile, int(row) * tile
+            w, h = min(tile, width - x), min(tile, height - y)
+            # Merge with the tile to the left when it belongs to the same run
+            if rects and rects[-1][1] == y and rects[-1][0] + rects[-1][2] == x:
+                left = rects.pop()
+                x, w = left[0], left[2] + w
+            rects.append((x, y, w, h))
+        return rects
+
+    def encode(self, image, quality):
+        """Return (header fields, payload) for a frame, or None when nothing changed."""
+        now = time.monotonic()
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        pixels = np.asarray(image) if np is not None else None
+
+        rects = None
+        if not (self.force_keyframe or self.previous is None or image.size != self.previous.size
+                or now - self.last_keyframe >= self.keyframe_interval):
+            rects = self._changed_rects(image, pixels)
+            if sum(w * h for _, _, w, h in rects) > LIVE_TILE_MAX_COVERAGE * image.width * image.height:
+                rects = None
+        self.previous, self.previous_pixels = image, pixels
+
+        if rects is None:
+            self.force_keyframe = False
+            self.last_keyframe = now
+            return {"keyframe": True}, encode_image(image, quality, 'stream')
+        if not rects:
+            return None
+
+        tiles, chunks = [], []
+        for x, y, w, h in rects:
+            data = encode_image(image.crop((x, y, x + w, y + h)), quality, 'stream')
+            tiles.append([x, y, w, h, len(data)])
+            chunks.append(data)
+        return {"keyframe": False, "tiles": tiles}, b"".join(chunks)
+
+class LivePreviewStream:
+    """Pushes screen frames at a target rate, adapting to how fast the socket drains.
+
+    Frames after the first keyframe usually carry only changed tiles, so each one
+    builds on the frame before it and none may be lost. When the socket has not taken
+    the previous frame by the next tick, that tick is skipped rather than queued
+    behind: the link is behind, so the stream lowers its frame rate, then its quality.
+    A run of frames picked up promptly raises them again, up to what was asked for.
+    """
+
+    def __init__(self, stream_id, sender, device_id, quality='medium', fps=DEFAULT_LIVE_FPS):
+        self.stream_id = stream_id
+        self.sender = sender
+        self.device_id = device_id
+        self.max_quality = 'medium'
+        self.target_fps = DEFAULT_LIVE_FPS
+        self.encoder = TileDiffEncoder()
+        self.update(quality, fps)
+        self.seq = 0
+        self.sent = 0
+        self.skipped = 0
+        self.on_time = 0
+        self.pending = False
+        self.last_pickup = None
+        self.bytes_per_second = 0.0
+        self.expires = time.monotonic() + LIVE_PREVIEW_LEASE
+        self.reason = "stopped"
+        self.task = None
+
+    def update(self, quality=None, fps=None):
+        """Change the requested quality/rate; the stream restarts from them."""
+        if quality in LIVE_PREVIEW_QUALITIES:
+            self.max_quality = quality
+        if fps is not None:
+            self.target_fps = max(MIN_LIVE_FPS, min(MAX_LIVE_FPS, float(fps)))
+        self.quality = self.max_quality
+        self.fps = self.target_fps
+        self.encoder.request_keyframe()
+
+    def renew(self):
+        self.expires = time.monotonic() + LIVE_PREVIEW_LEASE
+
+    def info(self):
+        return {
+            "stream_id": self.stream_id,
+            "quality": self.quality,
+            "fps": round(self.fps, 2),
+            "target_fps": self.target_fps,
+            "sent": self.sent,
+            "skipped": self.skipped,
+            "bytes_per_second": int(self.bytes_per_second)
+        }
+
+    def _slow_down(self):
+        self.on_time = 0
+        level = LIVE_PREVIEW_QUALITIES.index(self.quality)
+        floor = min(LIVE_FPS_FLOOR, self.target_fps)
+        if self.fps > floor:
+            self.fps = max(floor, self.fps * 0.7)
+        elif level > 0:
+            self.quality = LIVE_PREVIEW_QUALITIES[level - 1]
         else:
-            # Linux screenshot with multiple fallbacks
-            temp_file = f'/tmp/screenshot_{quality}.png'
-            screenshot_commands = [
-                ['gnome-screenshot', '-f', temp_file],
-                ['scrot', temp_file],
-                ['import', '-window', 'root', temp_file],  # ImageMagick
-                ['maim', temp_file],
-                ['xwd', '-root', '-out', temp_file.replace('.png', '.xwd')]  # X11 fallback
-            ]
-            
-            image_data = None
-            for cmd in screenshot_commands:
-                try:
-                    # Check if command exists before trying
-                    if subprocess.run(['which', cmd[0]], capture_output=True).returncode != 0:
-                        continue
-                        
-                    result = subprocess.run(cmd, capture_output=True, timeout=10)
-                    if result.returncode == 0:
-                        # Handle xwd format conversion if needed
-                        if cmd[0] == 'xwd':
-                            xwd_file = temp_file.replace('.png', '.xwd')
-                            # Convert xwd to png using ImageMagick
-                            convert_result = subprocess.run(['convert', xwd_file, temp_file], capture_output=True, timeout=10)
-                            if convert_result.returncode == 0:
-                                os.remove(xwd_file)  # Clean up xwd file
-                            else:
-                                continue
-                        
-                        if os.path.exists(temp_file):
-                            with open(temp_file, 'rb') as f:
-                                image_data = f.read()
-                            os.remove(temp_file)
-                            break
-                except Exception as e:
-                    print(f"Screenshot command {cmd[0]} failed: {e}")
-                    continue
-            
-            if image_data:
-                # Process image with quality adjustment if needed
-                if quality != 'high':
+            self.fps = max(MIN_LIVE_FPS, self.fps * 0.7)
+
+    def _speed_up(self):
+        self.on_time = 0
+        level = LIVE_PREVIEW_QUALITIES.index(self.quality)
+        floor = min(LIVE_FPS_FLOOR, self.target_fps)
+        if self.fps < floor:
+            self.fps = min(floor, self.fps * 1.25)
+        elif level < LIVE_PREVIEW_QUALITIES.index(self.max_quality):
+            self.quality = LIVE_PREVIEW_QUALITIES[level + 1]
+        elif self.fps < self.target_fps:
+            self.fps = min(self.target_fps, self.fps * 1.25)
+
+    def _frame(self, header, payload, offered):
+        """Built when the writer picks the frame up, which is what the rate adapts to."""
+        self.pending = False
+        now = time.monotonic()
+        if self.last_pickup is not None:
+            elapsed = max(now - self.last_pickup, 1e-3)
+            self.bytes_per_second = 0.8 * self.bytes_per_second + 0.2 * len(payload) / elapsed
+        self.last_pickup = now
+        self.sent += 1
+
+        if now - offered < 0.25 / self.fps:
+            self.on_time += 1
+            if self.on_time >= max(3, self.fps * LIVE_PREVIEW_RAMP_UP):
+                self._speed_up()
+        else:
+            self.on_time = 0
+        return encode_frame(header, payload)
+
+    def _capture(self, quality):
+        image, _ = capture_screen(quality, 'stream')
+        if isinstance(image, bytes):
+            raise RuntimeError("Live preview needs PIL (pip install pillow)")
+        return image.width, image.height, self.encoder.encode(image, quality)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        try:
+            while time.monotonic() < self.expires:
+                if self.pending:
+                    # The last frame is still waiting for the socket: skip this tick
+                    self.skipped += 1
+                    self._slow_down()
+                else:
+                    quality = self.quality
                     try:
-                        from PIL import Image
-                        img = Image.open(io.BytesIO(image_data))
-                        
-                        # Scale and compress based on quality
-                        if settings['scale'] != 1.0:
-                            new_size = (int(img.width * settings['scale']), 
-                                       int(img.height * settings['scale']))
-                            img = img.resize(new_size, Image.Resampling.LANCZOS)
-                        
-                        buffer = io.BytesIO()
-                        save_kwargs = {'format': settings['format']}
-                        if settings['format'] == 'JPEG':
-                            save_kwargs['quality'] = settings['quality']
-                            save_kwargs['optimize'] = True
-                            
-                        img.save(buffer, **save_kwargs)
-                        image_data = buffer.getvalue()
-                        
-                        return {
-                            "image": base64.b64encode(image_data).decode(),
-                            "width": img.width,
-                            "height": img.height,
-                            "format": settings['format'],
-                            "quality": quality
+                        width, height, frame = await run_blocking(self._capture, quality)
+                    except Exception as e:
+                        self.reason = str(e)
+                        break
+
+                    if frame is not None:
+                        fields, payload = frame
+                        header = {
+                            "type": "live_frame",
+                            "device_id": self.device_id,
+                            "stream_id": self.stream_id,
+                            "seq": self.seq + 1,
+                            "base_seq": self.seq,
+                            "width": width,
+                            "height": height,
+                            "format": encoder_preset('stream', quality)['format'],
+                            "quality": quality,
+                            "fps": round(self.fps, 2),
+                            **fields
                         }
-                    except ImportError:
-                        # PIL not available, return original
-                        pass
-                
-                return {
-                    "image": base64.b64encode(image_data).decode(),
-                    "format": "PNG",
-                    "quality": quality
-                }
+                        self.seq += 1
+                        self.pending = True
+                        self.sender.send_latest(("live_frame", self.stream_id),
+                                                functools.partial(self._frame, header, payload, time.monotonic()))
+
+                # Fixed-rate schedule; when capture runs long, missed ticks are skipped
+                interval = 1.0 / self.fps
+                next_tick += interval
+                now = loop.time()
+                if next_tick <= now:
+                    next_tick = now + interval - ((now - next_tick) % interval)
+                await asyncio.sleep(next_tick - now)
             else:
-                return {"error": "No screenshot tools available. Please install one of: gnome-screenshot, scrot, imagemagick, maim"}
-    except Exception as e:
-        return {"error": str(e)}
+                self.reason = "expired"
+
+            self.sender.send_latest(("live_preview", self.stream_id), {
+                "type": "live_preview_stopped",
+                "device_id": self.device_id,
+                "reason": self.reason,
+                **self.info()
+            })
+        finally:
+            if live_streams.get(self.stream_id) is self:
+                del live_streams[self.stream_id]
 
-# Global state for live preview
-live_preview_active = False
-live_preview_interval = 1
-live_preview_websocket = None
+# stream_id -> LivePreviewStream running on the current connection
+live_streams = {}
 
-def start_live_preview(quality='medium', interval=1):
-    """Start live preview streaming."""
-    global live_preview_active, live_preview_interval
+async def start_live_preview(dispatcher, data):
+    """Start a pushed live preview stream, or retune one that is already running."""
+    if dispatcher is None:
+        return {"error": "Live preview needs an agent connection"}
+    stream_id = str(data.get("stream_id") or "default")
+    quality = data.get("quality", 'medium')
+    fps = data.get("fps")
     try:
-        live_preview_active = True
-        live_preview_interval = interval
-        
-        return {"success": "Live preview started", "quality": quality, "interval": interval}
-    except Exception as e:
-        return {"error": str(e)}
+        if fps is None and data.get("interval"):
+            # Older dashboards ask for a poll interval in seconds
+            fps = 1.0 / float(data["interval"])
+        if fps is not None:
+            fps = float(fps)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return {"error": f"Invalid frame rate: {data.get('fps', data.get('interval'))}"}
 
-def stop_live_preview():
-    """Stop live preview streaming."""
-    global live_preview_active
+    stream = live_streams.get(stream_id)
+    if stream:
+        stream.update(quality, fps)
+        stream.renew()
+    else:
+        stream = LivePreviewStream(stream_id, dispatcher.sender, dispatcher.device_id, quality,
+                                   DEFAULT_LIVE_FPS if fps is None else fps)
+        live_streams[stream_id] = stream
+        stream.task = dispatcher.spawn(stream.run())
+    return {"success": "Live preview started", "lease": LIVE_PREVIEW_LEASE, **stream.info()}
+
+def stop_live_preview(stream_id=None):
+    """Stop one live preview stream, or all of them."""
     try:
-        live_preview_active = False
-        return {"success": "Live preview stopped"}
+        if stream_id is None:
+            streams = list(live_streams.values())
+        else:
+            streams = [live_streams[stream_id]] if stream_id in live_streams else []
+        for stream in streams:
+            stream.task.cancel()
+            live_streams.pop(stream.stream_id, None)
+        return {"success": "Live preview stopped", "stopped": [stream.stream_id for stream in streams]}
     except Exception as e:
         return {"error": str(e)}
 
-def get_live_frame(quality='medium'):
-    """Get a single frame for live preview."""
-    global live_preview_active
+def handle_live_preview_control(data):
+    stream = live_streams.get(data.get("stream_id"))
+    if not stream:
+        return
+    if data.get("type") == "live_preview_keyframe":
+        # A consumer lost track of the tiles; the next frame is sent in full
+        stream.encoder.request_keyframe()
+    else:
+        stream.renew()
+
+def get_live_frame(quality='medium', binary=False):
+    """Get a single frame for live preview (for clients that poll instead of streaming)."""
     try:
-        if live_preview_active:
-            return take_screenshot(quality)
+        if live_streams:
+            return take_screenshot(quality, binary, purpose='stream')
         else:
             return {"error": "Live preview not active"}
     except Exception as e:
         return {"error": str(e)}
 
+# ============ AUDIO ============
+
 def get_audio_info():
     """Get audio device information and volume levels."""
     try:
@@ -1283,28 +3500,563 @@ def extract_commands_from_text(text):
     
     return commands[:10]  # Limit to 10 commands
 
+def _read_static_system_info():
+    uname = platform.uname()
+    return {
+        "system": uname.system,
+        "node": uname.node,
+        "release": uname.release,
+        "version": uname.version,
+        "machine": uname.machine,
+        "processor": uname.processor,
+        "python_version": platform.python_version(),
+        "cpu_count_logical": psutil.cpu_count(logical=True),
+        "cpu_count_physical": psutil.cpu_count(logical=False),
+        "memory_total": psutil.virtual_memory().total
+    }
+
+def _read_disk_partitions():
+    return [{"device": p.device, "mountpoint": p.mountpoint, "fstype": p.fstype}
+            for p in psutil.disk_partitions()]
+
+def _read_network_interfaces():
+    return list(psutil.net_if_addrs().keys())
+
 def get_system_info():
     """Get detailed system information."""
     try:
-        uname = platform.uname()
+        info = dict(host_facts.get("system_info", _read_static_system_info))
+        # Mounts and interfaces can change (USB drives, VPNs) so they expire sooner
+        info["disk_partitions"] = host_facts.get("disk_partitions", _read_disk_partitions, SLOW_STATS_TTL * 6)
+        info["network_interfaces"] = host_facts.get("network_interfaces", _read_network_interfaces, SLOW_STATS_TTL * 6)
+        return info
+    except Exception as e:
+        return {"error": str(e)}
+
+# ============ PTY SESSIONS ============
+
+PTY_MAX_SESSIONS = 16
+PTY_READ_SIZE = 64 * 1024
+# Output waits this long for more to follow before it is sent, unless a chunk is already full
+PTY_COALESCE_INTERVAL = 0.005
+PTY_CHUNK_SIZE = 32 * 1024
+# Reading pauses (so the shell blocks on its terminal) while this much output is unsent
+PTY_MAX_PENDING = 1024 * 1024
+PTY_MAX_INPUT = 1024 * 1024
+# Recent output handed to a dashboard when it attaches
+PTY_SCROLLBACK = 64 * 1024
+# Sessions are reaped after this long without input or output, or without a dashboard
+PTY_IDLE_TIMEOUT = 3600
+PTY_DETACHED_TIMEOUT = 600
+PTY_REAP_INTERVAL = 30
+# Makes the pty the shell's controlling terminal (job control, Ctrl+C) and execs the
+# shell; done in a helper because preexec_fn is not safe in a threaded process
+PTY_SPAWN_HELPER = ("import fcntl, os, sys, termios; fcntl.ioctl(0, termios.TIOCSCTTY, 0); "
+                    "os.execvp(sys.argv[1], sys.argv[1:])")
+
+def _default_shell():
+    return os.environ.get("SHELL") or shutil.which("bash") or "/bin/sh"
+
+def _set_window_size(fd, rows, cols):
+    fcntl.ioctl(fd, termios.TIOCSWINSZ, struct.pack("HHHH", rows, cols, 0, 0))
+
+class PtySession:
+    """A long-lived shell on a pseudo-terminal, addressed by session id.
+
+    Output is held for PTY_COALESCE_INTERVAL so a keystroke echo goes out at once while
+    bulk output travels in large ``pty_output`` messages. Only the attached dashboard
+    is sent output; a detached session keeps PTY_SCROLLBACK bytes of it for the next
+    attach. Input is written without blocking, queued while the terminal is full.
+    """
+
+    def __init__(self, session_id, shell, rows, cols):
+        self.session_id = session_id
+        self.shell = shell
+        self.rows = rows
+        self.cols = cols
+        self.loop = asyncio.get_running_loop()
+        self.process = None
+        self.master = None
+        self.sender = None
+        self.device_id = None
+        self.pending = []
+        self.pending_bytes = 0
+        self.scrollback = deque()
+        self.scrollback_bytes = 0
+        self.input = bytearray()
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.seq = 0
+        self.reading = False
+        self.writing = False
+        self.eof = asyncio.Event()
+        self.flush_handle = None
+        self.flush_task = None
+        self.waiter = None
+        self.closed = False
+        self.created = time.time()
+        self.last_activity = time.monotonic()
+        self.detached_at = time.monotonic()
+
+    async def start(self, cwd):
+        master, slave = pty.openpty()
+        try:
+            _set_window_size(slave, self.rows, self.cols)
+            self.process = await asyncio.create_subprocess_exec(
+                sys.executable, "-I", "-S", "-c", PTY_SPAWN_HELPER, self.shell,
+                stdin=slave, stdout=slave, stderr=slave, cwd=cwd,
+                env=dict(os.environ, TERM="xterm-256color"),
+                start_new_session=True
+            )
+        except BaseException:
+            os.close(master)
+            raise
+        finally:
+            os.close(slave)
+        self.master = master
+        os.set_blocking(master, False)
+        self._resume_reading()
+        self.waiter = asyncio.create_task(self._wait())
+
+    def info(self):
         return {
-            "system": uname.system,
-            "node": uname.node,
-            "release": uname.release,
-            "version": uname.version,
-            "machine": uname.machine,
-            "processor": uname.processor,
-            "python_version": platform.python_version(),
-            "cpu_count_logical": psutil.cpu_count(logical=True),
-            "cpu_count_physical": psutil.cpu_count(logical=False),
-            "memory_total": psutil.virtual_memory().total,
-            "disk_partitions": [{"device": p.device, "mountpoint": p.mountpoint, "fstype": p.fstype} 
-                              for p in psutil.disk_partitions()],
-            "network_interfaces": list(psutil.net_if_addrs().keys())
+            "session_id": self.session_id,
+            "shell": self.shell,
+            "pid": self.process.pid if self.process else None,
+            "rows": self.rows,
+            "cols": self.cols,
+            "created": self.created,
+            "attached": self.sender is not None,
+            "idle": round(time.monotonic() - self.last_activity, 1)
         }
-    except Exception as e:
+
+    def attach(self, sender, device_id):
+        """Send output to a (new) dashboard; returns the scrollback it starts from."""
+        self.sender = sender
+        self.device_id = device_id
+        self.detached_at = None
+        # Whatever is still unsent is part of the scrollback handed over
+        self.pending.clear()
+        self.pending_bytes = 0
+        self._resume_reading()
+        self.decoder.reset()
+        return b"".join(self.scrollback).decode("utf-8", errors="replace")
+
+    def detach(self):
+        self.sender = None
+        self.detached_at = time.monotonic()
+        self.pending.clear()
+        self.pending_bytes = 0
+        self._resume_reading()
+
+    def write(self, text):
+        if self.closed:
+            return
+        self.last_activity = time.monotonic()
+        data = text.encode()
+        if len(self.input) + len(data) > PTY_MAX_INPUT:
+            print(f"PTY session {self.session_id}: input buffer full, dropping {len(data)} bytes")
+            return
+        self.input.extend(data)
+        self._drain_input()
+
+    def resize(self, rows, cols):
+        if self.closed:
+            return
+        self.rows, self.cols = rows, cols
+        # The kernel sends SIGWINCH to the terminal's foreground process group
+        _set_window_size(self.master, rows, cols)
+
+    def _drain_input(self):
+        try:
+            written = os.write(self.master, self.input)
+        except BlockingIOError:
+            written = 0
+        except OSError:
+            self.input.clear()
+            written = 0
+        del self.input[:written]
+        if self.input and not self.writing:
+            self.loop.add_writer(self.master, self._drain_input)
+            self.writing = True
+        elif not self.input and self.writing:
+            self.loop.remove_writer(self.master)
+            self.writing = False
+
+    def _resume_reading(self):
+        if not self.reading and self.master is not None and not self.eof.is_set() and not self.closed:
+            self.loop.add_reader(self.master, self._on_readable)
+            self.reading = True
+
+    def _pause_reading(self):
+        if self.reading:
+            self.loop.remove_reader(self.master)
+            self.reading = False
+
+    def _on_readable(self):
+        try:
+            data = os.read(self.master, PTY_READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            # EIO once nothing has the terminal open any more
+            data = b""
+        if not data:
+            self._pause_reading()
+            self.eof.set()
+            return
+
+        self.last_activity = time.monotonic()
+        self.scrollback.append(data)
+        self.scrollback_bytes += len(data)
+        while self.scrollback_bytes - len(self.scrollback[0]) >= PTY_SCROLLBACK:
+            self.scrollback_bytes -= len(self.scrollback.popleft())
+        if self.sender is None:
+            return
+
+        self.pending.append(data)
+        self.pending_bytes += len(data)
+        if self.pending_bytes >= PTY_MAX_PENDING:
+            self._pause_reading()
+        if self.flush_task is None:
+            if self.pending_bytes >= PTY_CHUNK_SIZE:
+                if self.flush_handle:
+                    self.flush_handle.cancel()
+                self._start_flush()
+            elif self.flush_handle is None:
+                self.flush_handle = self.loop.call_later(PTY_COALESCE_INTERVAL, self._start_flush)
+
+    def _start_flush(self):
+        self.flush_handle = None
+        self.flush_task = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        try:
+            while self.pending and self.sender:
+                sender = self.sender
+                data = b"".join(self.pending)
+                self.pending.clear()
+                self.pending_bytes = 0
+                self._resume_reading()
+                await sender.send({
+                    "type": "pty_output",
+                    "device_id": self.device_id,
+                    "session_id": self.session_id,
+                    "seq": self.seq,
+                    "data": self.decoder.decode(data)
+                })
+                self.seq += 1
+        except Exception as e:
+            print(f"PTY session {self.session_id}: output not delivered ({e}), detaching")
+            self.detach()
+        finally:
+            self.flush_task = None
+
+    async def _wait(self):
+        await self.process.wait()
+        # Background jobs can keep the terminal open; don't wait on them for the last output
+        try:
+            await asyncio.wait_for(self.eof.wait(), 1.0)
+        except asyncio.TimeoutError:
+            pass
+        await self.close("exited")
+
+    async def close(self, reason="closed"):
+        if self.closed:
+            return
+        self.closed = True
+        pty_sessions.pop(self.session_id, None)
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.flush_task:
+            await asyncio.gather(self.flush_task, return_exceptions=True)
+        if self.pending and self.sender:
+            self.flush_task = asyncio.create_task(self._flush())
+            await asyncio.gather(self.flush_task, return_exceptions=True)
+        self._pause_reading()
+        if self.writing:
+            self.loop.remove_writer(self.master)
+            self.writing = False
+        # Closing the terminal hangs up the shell, which passes SIGHUP on to its jobs
+        os.close(self.master)
+        if self.process.returncode is None:
+            try:
+                os.killpg(self.process.pid, signal.SIGHUP)
+            except OSError:
+                pass
+            try:
+                await asyncio.wait_for(self.process.wait(), COMMAND_KILL_GRACE)
+            except asyncio.TimeoutError:
+                _stop_process_group(self.process, force=True)
+                await self.process.wait()
+
+        if self.sender:
+            try:
+                await self.sender.send({
+                    "type": "pty_exit",
+                    "device_id": self.device_id,
+                    "session_id": self.session_id,
+                    "exit_code": self.process.returncode,
+                    "reason": reason
+                })
+            except Exception:
+                pass
+
+pty_sessions = {}
+
+async def open_pty_session(dispatcher, data):
+    """Start a shell session, or attach to ``session_id``; the result carries its scrollback."""
+    if pty is None:
+        return {"error": "PTY sessions are not supported on this platform"}
+    session_id = data.get("session_id")
+    try:
+        if session_id:
+            session = pty_sessions.get(session_id)
+            if session is None:
+                return {"error": f"Unknown session: {session_id}"}
+            if data.get("rows") and data.get("cols"):
+                session.resize(int(data["rows"]), int(data["cols"]))
+        else:
+            if len(pty_sessions) >= PTY_MAX_SESSIONS:
+                return {"error": f"Too many sessions (limit {PTY_MAX_SESSIONS})"}
+            session = PtySession(uuid.uuid4().hex, data.get("shell") or _default_shell(),
+                                 int(data.get("rows", 24)), int(data.get("cols", 80)))
+            await session.start(current_working_dir)
+            pty_sessions[session.session_id] = session
+    except (TypeError, ValueError, OSError) as e:
         return {"error": str(e)}
 
+    scrollback = session.attach(dispatcher.sender, dispatcher.device_id)
+    return {**session.info(), "scrollback": scrollback}
+
+async def close_pty_session(session_id):
+    session = pty_sessions.get(session_id)
+    if session is None:
+        return {"error": f"Unknown session: {session_id}"}
+    await session.close("closed")
+    return {"success": "Session closed", "session_id": session_id, "exit_code": session.process.returncode}
+
+def list_pty_sessions():
+    return {"sessions": [session.info() for session in pty_sessions.values()]}
+
+def handle_pty_control(data):
+    """Apply input, a resize or a detach from the dashboard that owns a session."""
+    session = pty_sessions.get(data.get("session_id"))
+    if not session:
+        return
+    try:
+        if data.get("type") == "pty_input":
+            session.write(data.get("data", ""))
+        elif data.get("type") == "pty_resize":
+            session.resize(int(data["rows"]), int(data["cols"]))
+        elif data.get("type") == "pty_detach":
+            session.detach()
+    except (KeyError, TypeError, ValueError, OSError) as e:
+        print(f"PTY session {session.session_id}: {data.get('type')} failed: {e}")
+
+async def reap_pty_sessions():
+    """Close sessions nobody has used, or attached to, for too long."""
+    while True:
+        await asyncio.sleep(PTY_REAP_INTERVAL)
+        now = time.monotonic()
+        for session in list(pty_sessions.values()):
+            if now - session.last_activity > PTY_IDLE_TIMEOUT:
+                print(f"Reaping idle PTY session {session.session_id}")
+                await session.close("idle")
+            elif session.detached_at is not None and now - session.detached_at > PTY_DETACHED_TIMEOUT:
+                print(f"Reaping detached PTY session {session.session_id}")
+                await session.close("detached")
+
+# ============ COMMAND EXECUTION ============
+
+# Streamed output is sent once this many bytes are buffered or this many seconds have passed
+COMMAND_CHUNK_SIZE = 64 * 1024
+COMMAND_CHUNK_INTERVAL = 0.1
+# Limits for a streamed command unless the request sets its own (timeout 0 = none)
+COMMAND_TIMEOUT = 3600
+COMMAND_MAX_OUTPUT = 32 * 1024 * 1024
+# Seconds between the polite and the forced stop of a command's process group
+COMMAND_KILL_GRACE = 3.0
+# A silent command still reports this often so the server does not expire the request
+COMMAND_KEEPALIVE_INTERVAL = 60.0
+
+def _stop_process_group(process, force=False):
+    """Signal a command started in its own process group, children included."""
+    try:
+        if os.name == "posix":
+            os.killpg(process.pid, signal.SIGKILL if force else signal.SIGTERM)
+        elif force:
+            subprocess.Popen(["taskkill", "/F", "/T", "/PID", str(process.pid)],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        else:
+            process.send_signal(signal.CTRL_BREAK_EVENT)
+    except (ProcessLookupError, PermissionError, OSError):
+        pass
+
+class StreamingCommand:
+    """A shell command whose stdout and stderr are forwarded as ``output_chunk`` messages.
+
+    The pipes are read as data arrives and batched by size and time. A reader that
+    fills a chunk waits for it to be sent, so a slow connection slows the command
+    down instead of growing a buffer. Output past ``max_output`` bytes, the timeout
+    or a ``command_cancel`` stops the whole process group: SIGTERM first, SIGKILL
+    after COMMAND_KILL_GRACE.
+    """
+
+    def __init__(self, command_id, dispatcher, request_id, max_output):
+        self.command_id = command_id
+        self.dispatcher = dispatcher
+        self.request_id = request_id
+        self.max_output = max_output
+        self.process = None
+        self.buffers = {"stdout": [], "stderr": []}
+        # Chunk boundaries may split a UTF-8 sequence; the decoders carry it over
+        self.decoders = {name: codecs.getincrementaldecoder("utf-8")(errors="replace") for name in self.buffers}
+        self.buffered = 0
+        self.total = 0
+        self.seq = 0
+        self.last_sent = time.monotonic()
+        self.send_lock = asyncio.Lock()
+        self.finished = asyncio.Event()
+        self.stop_reason = None
+        self.killer = None
+
+    def stop(self, reason, force=False):
+        if self.process is None or self.process.returncode is not None:
+            return
+        if self.stop_reason is None:
+            self.stop_reason = reason
+        _stop_process_group(self.process, force)
+        if not force and self.killer is None:
+            self.killer = asyncio.get_running_loop().call_later(COMMAND_KILL_GRACE, self.stop, reason, True)
+
+    async def flush(self, final=False):
+        async with self.send_lock:
+            chunk = {}
+            for name, parts in self.buffers.items():
+                text = self.decoders[name].decode(b"".join(parts), final=final)
+                parts.clear()
+                if text:
+                    chunk[name] = text
+            self.buffered = 0
+            if not chunk and time.monotonic() - self.last_sent < COMMAND_KEEPALIVE_INTERVAL:
+                return
+            self.last_sent = time.monotonic()
+            await self.dispatcher.send({
+                "type": "output_chunk",
+                "device_id": self.dispatcher.device_id,
+                "request_id": self.request_id,
+                "command_id": self.command_id,
+                "seq": self.seq,
+                **chunk
+            })
+            self.seq += 1
+
+    async def _pump(self, name, pipe):
+        while True:
+            data = await pipe.read(COMMAND_CHUNK_SIZE)
+            if not data:
+                return
+            if self.stop_reason:
+                # Keep draining so the command is never blocked on a full pipe
+                continue
+            room = self.max_output - self.total
+            if len(data) > room:
+                data = data[:room]
+                self.stop("output_limit")
+            self.total += len(data)
+            self.buffers[name].append(data)
+            self.buffered += len(data)
+            if self.buffered >= COMMAND_CHUNK_SIZE:
+                await self.flush()
+
+    async def _tick(self):
+        while not self.finished.is_set():
+            try:
+                await asyncio.wait_for(self.finished.wait(), COMMAND_CHUNK_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            if self.buffered or time.monotonic() - self.last_sent >= COMMAND_KEEPALIVE_INTERVAL:
+                await self.flush()
+
+    async def run(self, command, cwd, timeout):
+        started = time.monotonic()
+        if os.name == "posix":
+            group = {"start_new_session": True}
+        else:
+            group = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+        self.process = await asyncio.create_subprocess_shell(
+            command,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=cwd,
+            **group
+        )
+        pumps = [asyncio.create_task(self._pump("stdout", self.process.stdout)),
+                 asyncio.create_task(self._pump("stderr", self.process.stderr))]
+        ticker = asyncio.create_task(self._tick())
+        try:
+            try:
+                await asyncio.wait_for(self.process.wait(), timeout or None)
+            except asyncio.TimeoutError:
+                self.stop("timeout")
+                await self.process.wait()
+            # Children that left the process group can hold the pipes open indefinitely
+            await asyncio.wait(pumps, timeout=COMMAND_KILL_GRACE)
+            self.finished.set()
+            await ticker
+            await self.flush(final=True)
+        finally:
+            for task in pumps + [ticker]:
+                task.cancel()
+            if self.killer:
+                self.killer.cancel()
+            if self.process.returncode is None:
+                # The request itself was cancelled, e.g. the connection went away
+                _stop_process_group(self.process, force=True)
+
+        return {
+            "command_id": self.command_id,
+            "streamed": True,
+            "exit_code": self.process.returncode,
+            "working_dir": cwd,
+            "output_bytes": self.total,
+            "chunks": self.seq,
+            "truncated": self.stop_reason == "output_limit",
+            "stop_reason": self.stop_reason,
+            "elapsed_ms": round((time.monotonic() - started) * 1000, 1)
+        }
+
+running_commands = {}
+
+async def stream_command(dispatcher, data):
+    """Run ``data["cmd"]`` with its output streamed; the returned result is the final response."""
+    command = data["cmd"]
+    if command.strip().startswith('cd '):
+        return await execute_command(command)
+    try:
+        timeout = float(data.get("timeout", COMMAND_TIMEOUT))
+        max_output = max(0, int(data.get("max_output", COMMAND_MAX_OUTPUT)))
+    except (TypeError, ValueError) as e:
+        return {"error": str(e)}
+
+    run = StreamingCommand(data.get("command_id") or uuid.uuid4().hex, dispatcher, data.get("request_id"), max_output)
+    running_commands[run.command_id] = run
+    try:
+        return await run.run(command, current_working_dir, timeout)
+    except Exception as e:
+        return {"output": f"Error: {str(e)}", "exit_code": -1, "working_dir": current_working_dir,
+                "command_id": run.command_id}
+    finally:
+        running_commands.pop(run.command_id, None)
+
+def handle_command_control(data):
+    """Stop a streaming command on a ``command_cancel``; ``force`` skips the grace period."""
+    run = running_commands.get(data.get("command_id"))
+    if run:
+        run.stop("cancelled", force=bool(data.get("force")))
+
 async def execute_command(command):
     """Enhanced command execution with persistent working directory."""
     global current_working_dir
@@ -1363,164 +4115,788 @@ async def execute_command(command):
     except Exception as e:
         return {"output": f"Error: {str(e)}", "exit_code": -1, "working_dir": current_working_dir}
 
-async def handle_request(data):
-    """Handle different types of requests from the server."""
+async def handle_request(data, dispatcher=None):
+    """Handle different types of requests from the server.
+
+    Streaming handlers use ``dispatcher`` to send intermediate messages before the
+    final response.
+    """
     request_type = data.get("type")
     
     if request_type == "execute":
+        if data.get("stream") and dispatcher:
+            return await stream_command(dispatcher, data)
         return await execute_command(data["cmd"])
     elif request_type == "get_processes":
-        return get_processes()
+        return await run_blocking(get_processes, data.get("limit") or PROCESS_TOP_N,
+                                  data.get("sort_by", "memory_percent"), data.get("order", "desc"),
+                                  data.get("user"), data.get("name"), data.get("since"))
     elif request_type == "get_directory":
-        return get_directory_contents(data.get("path", "."))
+        # A limit or cursor asks for the paged listing; without one the whole listing is sent
+        if "limit" in data or data.get("cursor"):
+            return await run_blocking(get_directory_page, data.get("path", "."), data.get("cursor"),
+                                      data.get("limit") or DIRECTORY_PAGE_SIZE, data.get("sort", "name"),
+                                      data.get("order", "asc"), data.get("filter"),
+                                      data.get("dirs_first", True), data.get("show_hidden", True))
+        return await run_blocking(get_directory_contents, data.get("path", "."))
     elif request_type == "kill_process":
-        return kill_process(data["pid"])
+        return await run_blocking(kill_process, data["pid"])
     elif request_type == "get_system_info":
-        return get_system_info()
+        return await run_blocking(get_system_info)
     elif request_type == "read_file":
-        return read_file_content(data["file_path"])
+        return await run_blocking(read_file_content, data["file_path"], binary=bool(data.get("binary")))
     elif request_type == "open_file":
-        return open_file_with_system(data["file_path"])
+        return await run_blocking(open_file_with_system, data["file_path"])
     elif request_type == "download_file":
-        return download_file(data["file_path"])
+        if data.get("stream") and dispatcher:
+            return await stream_download(dispatcher, data)
+        return await run_blocking(download_file, data["file_path"], binary=bool(data.get("binary")))
     elif request_type == "search_files":
-        return search_files(data["query"], data.get("path", "."))
+        return await run_blocking(search_files, data["query"], data.get("path", "."),
+                                  data.get("limit", 50), data.get("mode", "substring"), data.get("offset", 0))
     elif request_type == "create_file":
-        return create_file(data["file_path"], data.get("content", ""))
+        return await run_blocking(create_file, data["file_path"], data.get("content", ""))
     elif request_type == "create_directory":
-        return create_directory(data["dir_path"])
+        return await run_blocking(create_directory, data["dir_path"])
     elif request_type == "delete_item":
-        return delete_file_or_directory(data["path"])
+        return await run_blocking(delete_file_or_directory, data["path"])
     elif request_type == "rename_item":
-        return rename_file_or_directory(data["old_path"], data["new_name"])
+        return await run_blocking(rename_file_or_directory, data["old_path"], data["new_name"])
     elif request_type == "copy_item":
-        return copy_file_or_directory(data["source_path"], data["dest_path"])
+        return await run_blocking(copy_file_or_directory, data["source_path"], data["dest_path"])
     
     # ========== REMOTE DESKTOP & MEDIA ==========
     elif request_type == "take_screenshot":
         quality = data.get("quality", "medium")
-        return take_screenshot(quality)
+        return await run_blocking(take_screenshot, quality, bool(data.get("binary")))
     elif request_type == "start_live_preview":
-        quality = data.get("quality", "medium")
-        interval = data.get("interval", 1)
-        return start_live_preview(quality, interval)
+        return await start_live_preview(dispatcher, data)
     elif request_type == "stop_live_preview":
-        return stop_live_preview()
+        return stop_live_preview(data.get("stream_id"))
     elif request_type == "get_live_frame":
         quality = data.get("quality", "medium")
-        return get_live_frame(quality)
+        return await run_blocking(get_live_frame, quality, bool(data.get("binary")))
     elif request_type == "get_audio_info":
-        return get_audio_info()
+        return await run_blocking(get_audio_info)
     elif request_type == "set_volume":
-        return set_volume(data.get("volume", 50))
+        return await run_blocking(set_volume, data.get("volume", 50))
     
     # ========== POWER MANAGEMENT ==========
     elif request_type == "power_operation":
-        return power_operation(data.get("operation", ""))
+        return await run_blocking(power_operation, data.get("operation", ""))
     
     # ========== NETWORK MONITORING ==========
     elif request_type == "get_network_info":
-        return get_network_info()
+        return await run_blocking(get_network_info)
     
     # ========== SERVICE MANAGEMENT ==========
     elif request_type == "get_services":
-        return get_services()
+        return await run_blocking(get_services)
     
     # ========== ENVIRONMENT VARIABLES ==========
     elif request_type == "get_environment_variables":
-        return get_environment_variables()
+        return await run_blocking(get_environment_variables)
     
     # ========== LOG VIEWER ==========
     elif request_type == "get_system_logs":
-        return get_system_logs(data.get("log_type", "system"), data.get("lines", 50))
+        return await run_blocking(get_system_logs, data.get("log_type", "system"), data.get("lines", 50))
     
     # ========== AI ASSISTANT ==========
     elif request_type == "ai_analyze_system":
-        return ai_analyze_system(data.get("query", ""), data.get("context_type", "general"))
+        return await run_blocking(ai_analyze_system, data.get("query", ""), data.get("context_type", "general"))
     elif request_type == "ai_generate_commands":
-        return ai_generate_commands(data.get("task_description", ""))
+        return await run_blocking(ai_generate_commands, data.get("task_description", ""))
     elif request_type == "ai_security_analysis":
-        return ai_security_analysis()
+        return await run_blocking(ai_security_analysis)
     elif request_type == "ai_performance_optimization":
-        return ai_performance_optimization()
+        return await run_blocking(ai_performance_optimization)
     elif request_type == "get_system_context":
-        return get_system_context()
+        return await run_blocking(get_system_context)
     
     elif request_type == "upload_file":
-        return upload_file(data["file_path"], data["content"])
+        return await run_blocking(upload_file, data["file_path"], data["content"])
+    elif request_type == "upload_open":
+        return await stream_upload(dispatcher, data)
     elif request_type == "get_disk_usage":
-        return get_disk_usage(data.get("path", "."))
+        progress = DiskUsageProgress(dispatcher, data) if dispatcher else None
+        try:
+            return await run_blocking(get_disk_usage, data.get("path", "."), data.get("top", DU_TOP_CHILDREN),
+                                      progress, data.get("one_file_system", True))
+        finally:
+            if progress:
+                progress.close()
+    elif request_type == "set_stats_interval":
+        return stats_scheduler.set_interval(data.get("interval", DEFAULT_STATS_INTERVAL))
+    elif request_type == "pty_open":
+        return await open_pty_session(dispatcher, data)
+    elif request_type == "pty_close":
+        return await close_pty_session(data.get("session_id"))
+    elif request_type == "pty_list":
+        return list_pty_sessions()
     else:
         return {"error": f"Unknown request type: {request_type}"}
 
-async def connect_to_server():
-    """Enhanced connection with multiple features."""
+class OutboundSender:
+    """Single writer for the agent socket.
+
+    Responses are queued and always delivered in order. Periodic samples such as
+    stats go into a "latest wins" slot per key, so when the socket is slow a stale
+    sample is replaced by the newer one instead of piling up behind it.
+    """
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.queue = deque()
+        self.latest = {}
+        self.wakeup = asyncio.Event()
+        self.dropped = 0
+        self.error = None
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._writer())
+        return self.task
+
+    async def send(self, message):
+        """Queue a must-deliver message and wait until it has been written."""
+        if self.error:
+            raise self.error
+        future = asyncio.get_running_loop().create_future()
+        self.queue.append((message, future))
+        self.wakeup.set()
+        await future
+
+    def send_latest(self, key, message):
+        """Offer a droppable message; an unsent older one under the same key is discarded.
+
+        ``message`` may be a callable, which is invoked only when the message is written.
+        """
+        if self.error:
+            return
+        if key in self.latest:
+            self.dropped += 1
+        self.latest[key] = message
+        self.wakeup.set()
+
+    def discard_latest(self, key):
+        """Withdraw an unsent droppable message."""
+        self.latest.pop(key, None)
+
+    async def _writer(self):
+        while True:
+            if not self.queue and not self.latest:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            if self.queue:
+                message, future = self.queue.popleft()
+            else:
+                key = next(iter(self.latest))
+                message, future = self.latest.pop(key), None
+
+            try:
+                # Droppable messages may be built lazily so they reflect what was
+                # actually sent before them (stats deltas depend on this)
+                if callable(message):
+                    message = message()
+                if not isinstance(message, (str, bytes)):
+                    message = json.dumps(message)
+            except Exception as e:
+                # A message that can't be built or serialized fails on its own; the
+                # connection is fine and everything queued behind it still goes out
+                if future:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    print(f"Dropping unsendable message: {e}")
+                continue
+
+            try:
+                await self.websocket.send(message)
+                if future and not future.done():
+                    future.set_result(True)
+            except Exception as e:
+                self.error = e
+                if future and not future.done():
+                    future.set_exception(e)
+                self._fail_pending(e)
+                return
+
+    def _fail_pending(self, error):
+        while self.queue:
+            _, future = self.queue.popleft()
+            if not future.done():
+                future.set_exception(error)
+        self.latest.clear()
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        # Anything still holding this sender fails fast instead of queueing forever
+        self.error = self.error or websockets.exceptions.ConnectionClosedOK(None, None)
+        self._fail_pending(self.error)
+
+_MISSING = object()
+
+def stats_delta(old, new):
+    """Return the fields of ``new`` that differ from ``old`` (recursing into dicts).
+
+    Returns None when a field present in ``old`` has disappeared, since a delta can
+    only add or change fields; the caller falls back to a keyframe then.
+    """
+    delta = {}
+    for key in old:
+        if key not in new:
+            return None
+    for key, value in new.items():
+        previous = old.get(key, _MISSING)
+        if isinstance(value, dict) and isinstance(previous, dict):
+            sub_delta = stats_delta(previous, value)
+            if sub_delta is None:
+                return None
+            if sub_delta:
+                delta[key] = sub_delta
+        elif value != previous:
+            delta[key] = value
+    return delta
+
+class StatsDeltaEncoder:
+    """Encodes stats samples as periodic full keyframes plus deltas of changed fields."""
+
+    def __init__(self, device_id, keyframe_interval=STATS_KEYFRAME_INTERVAL):
+        self.device_id = device_id
+        self.keyframe_interval = keyframe_interval
+        self.previous = None
+        self.seq = 0
+        self.last_keyframe = 0.0
+        self.force_keyframe = True
+
+    def request_keyframe(self):
+        self.force_keyframe = True
+
+    def encode(self, stats):
+        self.seq += 1
+        now = time.monotonic()
+
+        delta = None
+        if (not self.force_keyframe and self.previous is not None
+                and now - self.last_keyframe < self.keyframe_interval):
+            delta = stats_delta(self.previous, stats)
+        self.previous = stats
+
+        if delta is None:
+            self.force_keyframe = False
+            self.last_keyframe = now
+            return {
+                "type": "stats",
+                "device_id": self.device_id,
+                "seq": self.seq,
+                "keyframe": True,
+                "data": stats
+            }
+
+        return {
+            "type": "stats_delta",
+            "device_id": self.device_id,
+            "seq": self.seq,
+            "data": delta
+        }
+
+class StatsScheduler:
+    """Fixed-rate stats producer whose interval the server can adjust."""
+
+    def __init__(self, interval=DEFAULT_STATS_INTERVAL):
+        self.interval = interval
+        # Created inside run(), once per connection, on the running event loop
+        self.changed = None
+        self.encoder = None
+
+    def set_interval(self, interval):
+        try:
+            interval = float(interval)
+        except (TypeError, ValueError):
+            return {"error": f"Invalid stats interval: {interval}"}
+        self.interval = max(MIN_STATS_INTERVAL, min(MAX_STATS_INTERVAL, interval))
+        if self.changed:
+            self.changed.set()
+        return {"success": f"Stats interval set to {self.interval}s", "interval": self.interval}
+
+    def request_keyframe(self):
+        if self.encoder:
+            self.encoder.request_keyframe()
+
+    async def run(self, sender, device_id):
+        loop = asyncio.get_running_loop()
+        self.changed = asyncio.Event()
+        # Every connection starts with a keyframe
+        self.encoder = encoder = StatsDeltaEncoder(device_id)
+        next_tick = loop.time()
+        while True:
+            stats = await run_blocking(get_system_stats)
+            # Encoded when written, so a dropped sample never breaks the delta chain
+            sender.send_latest("stats", functools.partial(encoder.encode, stats))
+
+            # Ticks are scheduled from the start time, not from when sampling finished,
+            # so the cadence does not drift; missed ticks are skipped instead of bursting
+            next_tick += self.interval
+            now = loop.time()
+            if next_tick <= now:
+                next_tick = now + self.interval - ((now - next_tick) % self.interval)
+
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout=next_tick - now)
+                # Interval changed: restart the schedule from now
+                next_tick = loop.time()
+            except asyncio.TimeoutError:
+                pass
+
+stats_scheduler = StatsScheduler()
+
+# ============ OFFLINE STATS BUFFER ============
+
+# Stats sampled while disconnected are appended here and sent to the server after
+# reconnecting. The buffer is two append-only segments; when the active one reaches
+# half the limit it replaces the older one, so the oldest samples are dropped first.
+STATS_BUFFER_PATH = os.path.join(str(Path.home()), ".omni-agent", "stats_buffer.bin")
+STATS_BUFFER_MAX_BYTES = 4 * 1024 * 1024
+# Samples per backfill message, and seconds between messages
+STATS_BACKFILL_BATCH = 500
+STATS_BACKFILL_INTERVAL = 0.5
+
+try:
+    from config import STATS_BUFFER_PATH
+except ImportError:
+    pass
+
+class StatsBuffer:
+    """Bounded on-disk buffer of the stats sampled while the agent is offline.
+
+    A record is a fixed-size struct of the fields the server keeps history for; a
+    torn record at the end of a segment (power loss mid-write) is ignored on read.
+    """
+
+    MAGIC = b"OMNISB01"
+    FIELDS = ("timestamp", "cpu_percent", "ram_percent", "disk_percent", "process_count",
+              "network_sent", "network_recv")
+    RECORD = struct.Struct("<dfffIQQ")
+
+    def __init__(self, path):
+        self.path = path
+        self.old_path = path + ".old"
+        self.lock = threading.Lock()
+        # Set while a connection is up; the recorder only samples while it is clear
+        self.connected = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._record_offline, name="stats-buffer", daemon=True)
+        self.thread.start()
+
+    def _record_offline(self):
+        while True:
+            time.sleep(stats_scheduler.interval)
+            if not self.connected.is_set():
+                stats = get_system_stats()
+                if "error" not in stats:
+                    self.append(time.time(), stats)
+
+    def append(self, timestamp, stats):
+        record = self.RECORD.pack(timestamp, stats.get("cpu_percent") or 0.0, stats.get("ram_percent") or 0.0,
+                                  stats.get("disk_percent") or 0.0, stats.get("process_count") or 0,
+                                  stats.get("network_sent") or 0, stats.get("network_recv") or 0)
+        with self.lock:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+                if size >= STATS_BUFFER_MAX_BYTES // 2:
+                    os.replace(self.path, self.old_path)
+                    size = 0
+                with open(self.path, "ab") as f:
+                    if size == 0:
+                        f.write(self.MAGIC)
+                    elif (size - len(self.MAGIC)) % self.RECORD.size:
+                        # Cut off a torn record so later ones stay aligned
+                        f.truncate(size - (size - len(self.MAGIC)) % self.RECORD.size)
+                    f.write(record)
+            except OSError as e:
+                print(f"Stats buffer write failed: {e}")
+
+    def _read(self, path):
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        if not data.startswith(self.MAGIC):
+            return []
+        body = data[len(self.MAGIC):]
+        body = body[:len(body) - len(body) % self.RECORD.size]
+        return [list(record) for record in self.RECORD.iter_unpack(body)]
+
+    def drain(self):
+        """Take every buffered sample, oldest first, leaving the buffer empty."""
+        with self.lock:
+            samples = self._read(self.old_path) + self._read(self.path)
+            for path in (self.old_path, self.path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        return samples
+
+    def restore(self, samples):
+        """Put back samples that could not be sent, ahead of anything buffered since."""
+        if not samples:
+            return
+        with self.lock:
+            samples = samples + self._read(self.old_path) + self._read(self.path)
+            # Keep the newest samples that fit in one segment
+            samples = samples[-((STATS_BUFFER_MAX_BYTES // 2 - len(self.MAGIC)) // self.RECORD.size):]
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(self.path, "wb") as f:
+                    f.write(self.MAGIC + b"".join(self.RECORD.pack(*sample) for sample in samples))
+                if os.path.exists(self.old_path):
+                    os.remove(self.old_path)
+            except OSError as e:
+                print(f"Stats buffer write failed: {e}")
+
+    async def backfill(self, sender, device_id):
+        """Send what was buffered while offline in rate-limited batches; whatever is
+        unsent when the connection drops goes back into the buffer."""
+        samples = await run_blocking(self.drain)
+        if samples:
+            print(f"Backfilling {len(samples)} stats samples")
+        try:
+            while samples:
+                await sender.send({
+                    "type": "stats_backfill",
+                    "device_id": device_id,
+                    "fields": list(self.FIELDS),
+                    "samples": samples[:STATS_BACKFILL_BATCH]
+                })
+                del samples[:STATS_BACKFILL_BATCH]
+                if samples:
+                    await asyncio.sleep(STATS_BACKFILL_INTERVAL)
+        except (asyncio.CancelledError, Exception):
+            await asyncio.shield(run_blocking(self.restore, samples))
+            raise
+
+stats_buffer = StatsBuffer(STATS_BUFFER_PATH)
+
+class RequestDispatcher:
+    """Runs every incoming request as its own task and correlates responses by request_id.
+
+    A dispatcher outlives its connection: requests still running when the connection
+    drops send their responses over the next one, if it comes within
+    SESSION_RESUME_WINDOW seconds, and are cancelled otherwise.
+    """
+
+    def __init__(self, sender, device_id):
+        self.sender = sender
+        self.device_id = device_id
+        # Set when the next connection's sender replaces the current one
+        self.next_sender = asyncio.Event()
+        self.semaphores = {}
+        # request_id -> task for requests that are still running
+        self.in_flight = {}
+        self.requests = set()
+        # Tasks tied to the current connection (spawn), cancelled when it goes away
+        self.tasks = set()
+        self.expiry = None
+
+    def _semaphore(self, request_type):
+        if request_type not in self.semaphores:
+            limit = REQUEST_CONCURRENCY_LIMITS.get(request_type, DEFAULT_REQUEST_CONCURRENCY)
+            self.semaphores[request_type] = asyncio.Semaphore(limit)
+        return self.semaphores[request_type]
+
+    async def send(self, message):
+        """Send over the current connection; after a drop, wait for the next one."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + SESSION_RESUME_WINDOW
+        while True:
+            sender, next_sender = self.sender, self.next_sender
+            try:
+                return await sender.send(message)
+            except websockets.exceptions.ConnectionClosed:
+                pass
+            try:
+                await asyncio.wait_for(next_sender.wait(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                raise websockets.exceptions.ConnectionClosedError(None, None) from None
+
+    def attach(self, sender):
+        """Carry on over a new connection; sends waiting for one go out on it."""
+        if self.expiry:
+            self.expiry.cancel()
+            self.expiry = None
+        self.sender = sender
+        self.next_sender.set()
+        self.next_sender = asyncio.Event()
+
+    def abandon(self):
+        """Cancel the requests still running (the server no longer waits for them)."""
+        for task in list(self.requests):
+            task.cancel()
+
+    def spawn(self, coro):
+        """Run a coroutine tied to this connection's lifetime."""
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def dispatch(self, data):
+        """Schedule a request without blocking the receive loop."""
+        request_id = data.get("request_id")
+        if request_id is not None and request_id in self.in_flight:
+            print(f"Ignoring duplicate request {request_id}")
+            return
+
+        task = asyncio.create_task(self._run(data))
+        self.requests.add(task)
+        if request_id is not None:
+            self.in_flight[request_id] = task
+
+        def _done(t):
+            self.requests.discard(t)
+            if request_id is not None and self.in_flight.get(request_id) is t:
+                del self.in_flight[request_id]
+
+        task.add_done_callback(_done)
+
+    async def _run(self, data):
+        request_type = data.get("type")
+        async with self._semaphore(request_type):
+            try:
+                result = await handle_request(data, self)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                result = {"error": str(e)}
+
+        response = {
+            "type": "response",
+            "device_id": self.device_id,
+            "request_id": data.get("request_id"),
+            "request_type": request_type,
+            "result": result
+        }
+        try:
+            # Raw bytes in a result (requested with binary=true) travel as a binary
+            # frame: the response minus that field as header, the bytes as payload
+            payload_field = next((key for key, value in result.items() if isinstance(value, bytes)), None) \
+                if isinstance(result, dict) else None
+            if payload_field:
+                payload = result.pop(payload_field)
+                response["payload_field"] = payload_field
+                await self.send(encode_frame(response, payload))
+            else:
+                await self.send(response)
+        except websockets.exceptions.ConnectionClosed:
+            print(f"Connection closed before {request_type} response could be sent")
+        except Exception as e:
+            # The result couldn't be sent (e.g. not serializable); answer with the error
+            # so the server isn't left waiting for the request to time out
+            print(f"Failed to send {request_type} response: {e}")
+            response.pop("payload_field", None)
+            response["result"] = {"error": f"Failed to send response: {e}"}
+            try:
+                await self.send(response)
+            except Exception as e:
+                print(f"Failed to send {request_type} error response: {e}")
+
+    async def detach(self):
+        """The connection is gone: stop what was tied to it, and give running requests
+        SESSION_RESUME_WINDOW seconds for the next connection to pick them up."""
+        for task in list(self.tasks):
+            task.cancel()
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.expiry = asyncio.get_running_loop().call_later(SESSION_RESUME_WINDOW, self.abandon)
+
+# ============ RECONNECTION ============
+
+# Reconnect delays grow exponentially up to the cap; each is drawn uniformly from
+# [0, delay] so agents dropped together (server restart) don't return together
+RECONNECT_BASE_DELAY = 1.0
+RECONNECT_MAX_DELAY = 60.0
+# A connection that stayed up this long resets the backoff
+RECONNECT_STABLE_AFTER = 30.0
+# How long requests and shells wait for the next connection after a drop; the
+# server holds the agent's pending requests for as long
+SESSION_RESUME_WINDOW = 30.0
+# Keepalive: a link that doesn't answer a ping within PING_TIMEOUT is treated as dead
+PING_INTERVAL = 10.0
+PING_TIMEOUT = 10.0
+
+class ReconnectBackoff:
+    """Capped exponential backoff with full jitter."""
+
+    def __init__(self, base=RECONNECT_BASE_DELAY, cap=RECONNECT_MAX_DELAY):
+        self.base = base
+        self.cap = cap
+        self.attempt = 0
+
+    def reset(self):
+        self.attempt = 0
+
+    def next_delay(self):
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** self.attempt))
+        self.attempt = min(self.attempt + 1, 32)
+        return delay
+
+class AgentSession:
+    """What outlives one connection: the token the server resumes the agent by, the
+    dispatcher with its running requests, and the shells that were attached.
+
+    When the server answers a registration with resumed=true, shells attached at the
+    drop are attached to the new connection (output produced in between stays in
+    their scrollback). Otherwise the server has already failed the old requests and
+    told the dashboards the shells ended, so both are dropped here too.
+    """
+
+    def __init__(self):
+        self.session_id = uuid.uuid4().hex
+        self.registered = False
+        self.dispatcher = None
+        self.connected_at = None
+        self.detached_shells = []
+
+    def attach(self, sender, device_id):
+        if self.dispatcher is None:
+            self.dispatcher = RequestDispatcher(sender, device_id)
+        else:
+            self.dispatcher.attach(sender)
+        self.connected_at = time.monotonic()
+        return self.dispatcher
+
+    async def resume(self, resumed):
+        shells, self.detached_shells = self.detached_shells, []
+        if resumed:
+            for session in shells:
+                if not session.closed and session.detached_at is not None:
+                    session.attach(self.dispatcher.sender, self.dispatcher.device_id)
+            return
+        self.dispatcher.abandon()
+        await asyncio.gather(*(session.close("disconnected") for session in shells), return_exceptions=True)
+
+    async def detach(self):
+        self.detached_shells = [session for session in pty_sessions.values() if session.sender is not None]
+        for session in self.detached_shells:
+            session.detach()
+        await self.dispatcher.detach()
+
+async def connect_to_server(session=None):
+    """Enhanced connection with multiple features.
+
+    Registers under ``session``'s token so the server can resume it after a drop,
+    then serves requests until the connection goes away.
+    """
+    session = session or AgentSession()
     print(f"Attempting connection to {SERVER_URL}...")
-    async with websockets.connect(SERVER_URL) as websocket:
+    async with websockets.connect(SERVER_URL, max_size=MAX_MESSAGE_SIZE,
+                                  ping_interval=PING_INTERVAL, ping_timeout=PING_TIMEOUT) as websocket:
         print("Connected to Central Command!")
         
         hostname = socket.gethostname()
         
-        # 1. Register device with enhanced info
-        system_info = get_system_info()
-        await websocket.send(json.dumps({
+        # 1. Register device; full system details only the first time, a reconnect just resumes
+        registration = {
             "type": "register",
             "device_id": hostname,
             "platform": platform.system(),
-            "system_info": system_info
-        }))
-
-        receive_task = asyncio.create_task(websocket.recv())
-
-        while True:
-            # Send enhanced stats
-            stats = get_system_stats()
-            heartbeat_msg = {
-                "type": "stats",
-                "device_id": hostname,
-                "data": stats
-            }
-            
-            await websocket.send(json.dumps(heartbeat_msg))
+            "tags": list(AGENT_TAGS),
+            "session_id": session.session_id
+        }
+        if not session.registered:
+            registration["system_info"] = await run_blocking(get_system_info)
+        await websocket.send(json.dumps(registration))
+        session.registered = True
 
-            # Wait for commands
-            done, pending = await asyncio.wait(
-                [receive_task],
-                timeout=3.0,
-                return_when=asyncio.FIRST_COMPLETED
-            )
+        # 2. One writer owns the socket; stats are produced on their own schedule
+        sender = OutboundSender(websocket)
+        sender.start()
+        stats_task = asyncio.create_task(stats_scheduler.run(sender, hostname))
+        stats_buffer.connected.set()
+        dispatcher = session.attach(sender, hostname)
+        dispatcher.spawn(reap_pty_sessions())
+        dispatcher.spawn(reap_upload_sessions())
+        dispatcher.spawn(stats_buffer.backfill(sender, hostname))
 
-            if receive_task in done:
+        try:
+            async for message in websocket:
                 try:
-                    message = receive_task.result()
+                    # Binary frames carry upload chunks
+                    if isinstance(message, bytes):
+                        header, payload = decode_frame(message)
+                        if header.get("type") == "upload_chunk":
+                            dispatcher.spawn(handle_upload_chunk(dispatcher, header, payload))
+                        continue
+
                     data = json.loads(message)
-                    
+
+                    # Server control messages are handled inline and need no response
+                    if data.get("type") == "registered":
+                        await session.resume(data.get("resumed", False))
+                        continue
+                    if data.get("type") == "request_keyframe":
+                        stats_scheduler.request_keyframe()
+                        continue
+                    if data.get("type") in ("transfer_ack", "transfer_cancel"):
+                        handle_transfer_control(data)
+                        continue
+                    if data.get("type") in ("upload_commit", "upload_abort"):
+                        handle_upload_control(data)
+                        continue
+                    if data.get("type") in ("live_preview_keepalive", "live_preview_keyframe"):
+                        handle_live_preview_control(data)
+                        continue
+                    if data.get("type") == "command_cancel":
+                        handle_command_control(data)
+                        continue
+                    if data.get("type") in ("pty_input", "pty_resize", "pty_detach"):
+                        handle_pty_control(data)
+                        continue
+
                     print(f"Received request: {data.get('type', 'unknown')}")
-                    
-                    # Handle different request types
-                    result = await handle_request(data)
-                    
-                    # Send result back with request ID for tracking
-                    await websocket.send(json.dumps({
-                        "type": "response",
-                        "device_id": hostname,
-                        "request_id": data.get("request_id"),
-                        "request_type": data.get("type"),
-                        "result": result
-                    }))
-                    
-                    receive_task = asyncio.create_task(websocket.recv())
-                    
-                except websockets.exceptions.ConnectionClosed:
-                    print("Connection lost.")
-                    break
+
+                    # Each request runs as its own task; the response carries its request_id
+                    dispatcher.dispatch(data)
                 except Exception as e:
                     print(f"Error handling request: {e}")
+            print("Connection lost.")
+        finally:
+            stats_buffer.connected.clear()
+            stats_task.cancel()
+            await asyncio.gather(stats_task, return_exceptions=True)
+            # Running requests and shells wait a while for the next connection
+            await session.detach()
+            await sender.close()
 
-if __name__ == "__main__":
+async def run_agent():
+    """Stay connected: reconnect with backoff, resuming the session each time."""
+    session = AgentSession()
+    backoff = ReconnectBackoff()
     while True:
+        session.connected_at = None
         try:
-            asyncio.run(connect_to_server())
+            await connect_to_server(session)
         except Exception as e:
-            print(f"Connection error: {e}. Retrying in 5s...")
-            time.sleep(5)
+            print(f"Connection error: {e}")
+        if session.connected_at is not None and time.monotonic() - session.connected_at >= RECONNECT_STABLE_AFTER:
+            backoff.reset()
+        delay = backoff.next_delay()
+        print(f"Reconnecting in {delay:.1f}s...")
+        await asyncio.sleep(delay)
+
+if __name__ == "__main__":
+    # Screen capture is probed once up front rather than on the first screenshot
+    detect_capture_backend()
+    file_index.start()
+    stats_buffer.start()
+    asyncio.run(run_agent())
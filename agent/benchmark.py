@@ -0,0 +1,121 @@
+"""Microbenchmarks for the agent's hot paths.
+
+Usage:
+    python benchmark.py stats [iterations]
+    python benchmark.py encode [iterations]
+
+Reports wall and CPU time per call so the agent's own overhead can be compared
+between the cached sampling path and a cold read of every host fact, and the
+time and size per frame of each screenshot encoder preset.
+"""
+import random
+import sys
+import time
+
+import agent
+
+
+def _measure(func, iterations):
+    func()  # warm up (first cpu_percent call primes psutil)
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    for _ in range(iterations):
+        func()
+    wall = (time.perf_counter() - wall_start) / iterations * 1000
+    cpu = (time.process_time() - cpu_start) / iterations * 1000
+    return wall, cpu
+
+
+def _report(name, wall, cpu):
+    print(f"{name:<28} {wall:8.3f} ms/call wall  {cpu:8.3f} ms/call cpu")
+
+
+def bench_stats(iterations=200):
+    """Per-tick cost of get_system_stats and get_system_info, cached vs. cold."""
+    def cold_stats():
+        agent.host_facts.invalidate()
+        agent.get_system_stats()
+
+    def cold_info():
+        agent.host_facts.invalidate()
+        agent.get_system_info()
+
+    _report("get_system_stats (cold)", *_measure(cold_stats, iterations))
+    _report("get_system_stats (cached)", *_measure(agent.get_system_stats, iterations))
+    _report("get_system_info (cold)", *_measure(cold_info, iterations))
+    _report("get_system_info (cached)", *_measure(agent.get_system_info, iterations))
+
+
+def _sample_screen(width=1920, height=1080):
+    """A real capture when a display is available, otherwise a synthetic desktop."""
+    if agent.detect_capture_backend() is not None:
+        return agent.detect_capture_backend().grab().convert("RGB"), "captured"
+
+    from PIL import Image, ImageDraw
+    rng = random.Random(0)
+    image = Image.new("RGB", (width, height), (32, 36, 44))
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        # Windows with a title bar and lines of text
+        x, y = rng.randrange(0, width - 400), rng.randrange(0, height - 300)
+        w, h = rng.randrange(300, 900), rng.randrange(200, 600)
+        draw.rectangle([x, y, x + w, y + h], fill=(245, 245, 245), outline=(90, 90, 90))
+        draw.rectangle([x, y, x + w, y + 24], fill=(60, 90, 150))
+        for line in range(y + 36, y + h - 12, 16):
+            draw.text((x + 8, line), "".join(rng.choice("abcdefgh ijklmnop") for _ in range(w // 7)),
+                      fill=(20, 20, 20))
+    return image, "synthetic"
+
+
+def bench_encode(iterations=20):
+    """ms and bytes per frame for each encoder preset (scale + encode), and for tile deltas."""
+    screen, source = _sample_screen()
+    print(f"Source: {source} {screen.width}x{screen.height}")
+
+    from PIL import Image
+    for purpose, presets in agent.ENCODER_PRESETS.items():
+        for quality in presets:
+            preset = agent.encoder_preset(purpose, quality)
+            sizes = []
+
+            def frame():
+                image = screen
+                if preset["scale"] != 1.0:
+                    size = (int(screen.width * preset["scale"]), int(screen.height * preset["scale"]))
+                    image = screen.resize(size, Image.Resampling[preset["resample"]],
+                                          reducing_gap=preset.get("reducing_gap"))
+                sizes.append(len(agent.encode_image(image, quality, purpose)))
+
+            wall, cpu = _measure(frame, iterations)
+            name = f"{purpose}/{quality} ({preset['format']})"
+            print(f"{name:<28} {wall:8.3f} ms/frame wall  {cpu:8.3f} ms/frame cpu  {sizes[-1]:>9} bytes/frame")
+
+    # A stream frame where only a cursor-sized area changed since the last one
+    encoder = agent.TileDiffEncoder()
+    encoder.encode(screen, "medium")
+    frames = [screen.copy() for _ in range(2)]
+    for i, image in enumerate(frames):
+        image.paste((255, 0, 0), (400 + i * 8, 300, 416 + i * 8, 324))
+    sizes = []
+    step = iter(range(10 ** 9))
+
+    def delta():
+        result = encoder.encode(frames[next(step) % 2], "medium")
+        sizes.append(len(result[1]) if result else 0)
+
+    wall, cpu = _measure(delta, iterations)
+    print(f"{'stream/medium tile delta':<28} {wall:8.3f} ms/frame wall  {cpu:8.3f} ms/frame cpu  {sizes[-1]:>9} bytes/frame")
+
+
+BENCHMARKS = {
+    "stats": bench_stats,
+    "encode": bench_encode,
+}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(f"Usage: python benchmark.py {{{'|'.join(BENCHMARKS)}}} [iterations]")
+        sys.exit(1)
+    args = [int(arg) for arg in sys.argv[2:]]
+    BENCHMARKS[sys.argv[1]](*args)
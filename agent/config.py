@@ -20,4 +20,21 @@ DASHBOARD_PORT = 5173
 # Feature Toggles
 AI_ENABLED = True
 SCREENSHOT_ENABLED = True
-POWER_MANAGEMENT_ENABLED = True  # Set to False for safety in production
\ No newline at end of file
+POWER_MANAGEMENT_ENABLED = True  # Set to False for safety in production
+
+# Screenshot encoder presets (optional): override any purpose ('still' or 'stream')
+# and quality level, e.g. JPEG instead of WebP for the medium live preview quality
+# ENCODER_PRESETS = {
+#     'stream': {
+#         'medium': {'format': 'JPEG', 'scale': 0.75, 'resample': 'BILINEAR', 'options': {'quality': 70}}
+#     }
+# }
+
+# Directories covered by the search_files filename index (default: the home directory)
+# FILE_INDEX_ROOTS = ["/home", "/srv"]
+
+# Labels for selecting this agent in fleet commands run from the dashboard
+# AGENT_TAGS = ["web", "eu-west"]
+
+# Where stats sampled while disconnected are buffered until the server is reachable again
+# STATS_BUFFER_PATH = "/var/lib/omni-agent/stats_buffer.bin"
@@ -13,6 +13,21 @@ const formatBytes = (bytes) => {
   return parseFloat((bytes / Math.pow(k, i)).toFixed(1)) + ' ' + sizes[i];
 };
 
+// Buckets requested for the 24h history chart
+const STATS_HISTORY_POINTS = 240;
+
+// Applies a get_processes result: a full list, or the changes since the snapshot we hold
+const mergeProcesses = (current, result) => {
+  if (result.processes) return result.processes;
+  const byPid = new Map(current.map((proc) => [proc.pid, proc]));
+  for (const pid of result.removed || []) byPid.delete(pid);
+  for (const change of result.changed || []) {
+    if (byPid.has(change.pid)) byPid.set(change.pid, { ...byPid.get(change.pid), ...change });
+  }
+  for (const proc of result.added || []) byPid.set(proc.pid, proc);
+  return (result.order || []).map((pid) => byPid.get(pid)).filter(Boolean);
+};
+
 // Function to parse and render AI response in a structured format
 const renderAIResponse = (responseText) => {
   if (!responseText) return null;
@@ -262,12 +277,158 @@ const renderAIResponse = (responseText) => {
   );
 };
 
+// Stats deltas only carry changed fields (nested objects recursively)
+const mergeStats = (snapshot, delta) => {
+  const merged = { ...snapshot };
+  for (const [key, value] of Object.entries(delta || {})) {
+    const previous = merged[key];
+    if (value && typeof value === 'object' && !Array.isArray(value) &&
+        previous && typeof previous === 'object' && !Array.isArray(previous)) {
+      merged[key] = mergeStats(previous, value);
+    } else {
+      merged[key] = value;
+    }
+  }
+  return merged;
+};
+
+// Binary frames: 4-byte big-endian header length, JSON header, raw payload
+const parseFrame = (buffer) => {
+  const headerLength = new DataView(buffer).getUint32(0);
+  const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, headerLength)));
+  return { header, payload: new Uint8Array(buffer, 4 + headerLength) };
+};
+
+// Draws a live_frame onto the compositor canvas: a keyframe replaces it, a delta patches its tiles
+const composeLiveFrame = async (canvas, header, payload) => {
+  const type = `image/${(header.format || 'png').toLowerCase()}`;
+  const ctx = canvas.getContext('2d');
+  if (header.keyframe !== false) {
+    const bitmap = await createImageBitmap(new Blob([payload], { type }));
+    if (canvas.width !== header.width || canvas.height !== header.height) {
+      canvas.width = header.width;
+      canvas.height = header.height;
+    }
+    ctx.drawImage(bitmap, 0, 0);
+    bitmap.close();
+    return;
+  }
+
+  // tiles: [x, y, width, height, byteLength], payloads concatenated in the same order
+  let offset = 0;
+  const tiles = header.tiles.map(([x, y, , , length]) => {
+    const blob = new Blob([payload.subarray(offset, offset + length)], { type });
+    offset += length;
+    return createImageBitmap(blob).then(bitmap => ({ x, y, bitmap }));
+  });
+  for (const { x, y, bitmap } of await Promise.all(tiles)) {
+    ctx.drawImage(bitmap, x, y);
+    bitmap.close();
+  }
+};
+
+const encodeFrame = (header, payload) => {
+  const headerBytes = new TextEncoder().encode(JSON.stringify(header));
+  const frame = new Uint8Array(4 + headerBytes.length + payload.byteLength);
+  new DataView(frame.buffer).setUint32(0, headerBytes.length);
+  frame.set(headerBytes, 4);
+  frame.set(new Uint8Array(payload), 4 + headerBytes.length);
+  return frame.buffer;
+};
+
+// Upload chunks allowed in flight before waiting for the agent's acks
+const UPLOAD_WINDOW = 4;
+
+// SubtleCrypto is only available in secure contexts; without it chunks are not verified
+const sha256Hex = async (bytes) => {
+  if (!window.crypto?.subtle) return null;
+  const digest = await window.crypto.subtle.digest('SHA-256', bytes);
+  return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+};
+
+// Image results arrive either as an object URL (binary frames) or as base64 text (legacy JSON)
+const previewSrc = (preview) =>
+  preview?.image_url || (preview?.image ? `data:image/${(preview.format || 'png').toLowerCase()};base64,${preview.image}` : null);
+
+// Streamed command output kept per terminal entry; older text is dropped first
+const TERMINAL_ENTRY_LIMIT = 200000;
+
+// Appends an output_chunk to the terminal, continuing the command's last entry for that stream
+const appendCommandOutput = (entries, msg) => {
+  const next = [...entries];
+  for (const stream of ['stdout', 'stderr']) {
+    if (!msg[stream]) continue;
+    const last = next[next.length - 1];
+    if (last && last.commandId === msg.command_id && last.stream === stream) {
+      next[next.length - 1] = { ...last, text: (last.text + msg[stream]).slice(-TERMINAL_ENTRY_LIMIT) };
+    } else {
+      next.push({ source: msg.device_id, text: msg[stream], type: 'output', commandId: msg.command_id, stream });
+    }
+  }
+  return next;
+};
+
+// The terminal view is plain text: drop escape sequences (colours, cursor moves, titles)
+const stripAnsi = (text) => text
+  .replace(/\x1b\[[0-9;?]*[ -\/]*[@-~]|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)|\x1b[()#][0-9A-Za-z]|\x1b[=>]|\x07/g, '')
+  .replace(/\r+\n/g, '\n')
+  .replace(/\r/g, '');
+
+// PTY sessions open at this size; the shell sees it as its terminal size
+const SHELL_ROWS = 40;
+const SHELL_COLS = 120;
+
+// Entries per page of a directory listing; the agent sorts and pages it
+const DIRECTORY_PAGE_SIZE = 500;
+
+const permissionString = (type, mode) => {
+  if (mode === null || mode === undefined) return '?????????';
+  const bits = 'rwxrwxrwx';
+  return (type === 'd' ? 'd' : type === 'l' ? 'l' : '-') +
+    bits.split('').map((bit, i) => (mode & (0o400 >> i) ? bit : '-')).join('');
+};
+
+// A paged get_directory result carries its entries by column; turn them back into items
+const expandListing = (result) => {
+  const entries = result?.entries || {};
+  const base = result?.current_path === '/' ? '' : result?.current_path;
+  const items = (entries.name || []).map((name, i) => ({
+    name,
+    type: entries.type[i] === 'd' ? 'directory' : 'file',
+    size: entries.size[i],
+    modified: entries.modified[i] ? new Date(entries.modified[i] * 1000).toLocaleString() : 'Permission Denied',
+    path: `${base}/${name}`,
+    permissions: permissionString(entries.type[i], entries.mode[i]),
+    ...(entries.modified[i] ? {} : { error: 'stat failed' })
+  }));
+  if (!result?.cursor && result?.parent) {
+    items.unshift({ name: '..', type: 'directory', size: 0, modified: '', path: result.parent, permissions: 'drwxr-xr-x' });
+  }
+  return items;
+};
+
+const saveBlob = (blob, filename) => {
+  const url = URL.createObjectURL(blob);
+  const a = document.createElement('a');
+  a.href = url;
+  a.download = filename;
+  document.body.appendChild(a);
+  a.click();
+  document.body.removeChild(a);
+  URL.revokeObjectURL(url);
+};
+
 export default function App() {
   const [socket, setSocket] = useState(null);
   const [devices, setDevices] = useState({});
   const [selectedDevice, setSelectedDevice] = useState(null);
   const [terminalOutput, setTerminalOutput] = useState([]);
   const [commandInput, setCommandInput] = useState("");
+  const [runningCommand, setRunningCommand] = useState(null);
+  // Run terminal commands on every connected device at once (server-side fleet fan-out)
+  const [fleetMode, setFleetMode] = useState(false);
+  // An open PTY session: commands go to one long-lived shell instead of one process each
+  const [shellSession, setShellSession] = useState(null);
   const [isConnected, setIsConnected] = useState(false);
   const [activeTab, setActiveTab] = useState('terminal');
   const [processes, setProcesses] = useState([]);
@@ -280,10 +441,15 @@ export default function App() {
   const [networkHistory, setNetworkHistory] = useState([]);
   const [processCountHistory, setProcessCountHistory] = useState([]);
   const [diskUsageHistory, setDiskUsageHistory] = useState([]);
+  // Server-side history (last 24h, downsampled) for the selected device
+  const [statsHistory, setStatsHistory] = useState(null);
   const [fileViewerOpen, setFileViewerOpen] = useState(false);
   const [fileContent, setFileContent] = useState(null);
   const [searchQuery, setSearchQuery] = useState("");
   const [searchResults, setSearchResults] = useState([]);
+  const [searchNextOffset, setSearchNextOffset] = useState(null);
+  const [directoryCursor, setDirectoryCursor] = useState(null);
+  const [directoryTotal, setDirectoryTotal] = useState(0);
   const [showCreateModal, setShowCreateModal] = useState(false);
   const [createType, setCreateType] = useState("file"); // "file" or "folder"
   const [createName, setCreateName] = useState("");
@@ -294,13 +460,21 @@ export default function App() {
   const [sortOrder, setSortOrder] = useState("asc");
   const terminalEndRef = useRef(null);
   const fileInputRef = useRef(null);
+  const statsSnapshots = useRef({});
+  const transfersRef = useRef({});
+  const uploadsRef = useRef({});
+  const socketRef = useRef(null);
+  const processSnapshotRef = useRef(null);
+  const liveStreamRef = useRef(null);
+  const liveCompositorRef = useRef({ seq: null, painting: Promise.resolve(), canvas: null, resyncing: false });
+  const liveCanvasRef = useRef(null);
   
   // New feature states
   const [livePreview, setLivePreview] = useState(null);
   const [isLiveStreaming, setIsLiveStreaming] = useState(false);
   const [isCapturingScreen, setIsCapturingScreen] = useState(false);
   const [streamQuality, setStreamQuality] = useState('medium'); // low, medium, high
-  const [streamInterval, setStreamInterval] = useState(1); // seconds
+  const [streamFps, setStreamFps] = useState(5); // target frames per second
   const [lastFrameTime, setLastFrameTime] = useState(null);
   const [audioInfo, setAudioInfo] = useState({ volume: 50, muted: false, devices: [] });
   const [networkInfo, setNetworkInfo] = useState(null);
@@ -327,6 +501,7 @@ export default function App() {
     let ws;
     try {
       ws = new WebSocket(WS_URL);
+      ws.binaryType = "arraybuffer";
 
       ws.onopen = () => {
         setIsConnected(true);
@@ -341,11 +516,16 @@ export default function App() {
       };
 
       ws.onmessage = (event) => {
+        if (event.data instanceof ArrayBuffer) {
+          handleFrame(event.data, ws);
+          return;
+        }
         const msg = JSON.parse(event.data);
         handleMessage(msg);
       };
 
       setSocket(ws);
+      socketRef.current = ws;
     } catch (e) {
       setIsMock(true);
     }
@@ -355,6 +535,22 @@ export default function App() {
     };
   }, []);
 
+  // Subscribe to stats for every device (device cards) and to everything else only for the selected one
+  useEffect(() => {
+    if (!socket || !isConnected || socket.readyState !== WebSocket.OPEN) return;
+
+    socket.send(JSON.stringify({ type: "subscribe", devices: "*", topics: ["stats"] }));
+    if (selectedDevice) {
+      socket.send(JSON.stringify({ type: "subscribe", devices: [selectedDevice], topics: "*" }));
+    }
+
+    return () => {
+      if (selectedDevice && socket.readyState === WebSocket.OPEN) {
+        socket.send(JSON.stringify({ type: "unsubscribe", devices: [selectedDevice] }));
+      }
+    };
+  }, [socket, isConnected, selectedDevice]);
+
   // Mock Data Generator for Preview
   useEffect(() => {
     if (!isMock) return;
@@ -405,15 +601,20 @@ export default function App() {
     return () => clearInterval(interval);
   }, [isMock]);
 
-  // Auto-manage live preview with periodic frame requests
+  // The agent pushes live frames on its own; keep renewing the stream's lease while it is shown
   useEffect(() => {
     let interval;
     
     if (isLiveStreaming && selectedDevice && activeTab === 'desktop') {
-      // Start requesting frames at the specified interval
       interval = setInterval(() => {
-        sendRequest("get_live_frame", { quality: streamQuality });
-      }, streamInterval * 1000);
+        if (socket && socket.readyState === WebSocket.OPEN && liveStreamRef.current) {
+          socket.send(JSON.stringify({
+            type: "live_preview_keepalive",
+            target: selectedDevice,
+            stream_id: liveStreamRef.current
+          }));
+        }
+      }, 10000);
     }
     
     // Cleanup function
@@ -427,13 +628,115 @@ export default function App() {
         stopLivePreview();
       }
     };
-  }, [isLiveStreaming, selectedDevice, activeTab, streamInterval, streamQuality]);
+  }, [isLiveStreaming, selectedDevice, activeTab, socket]);
+
+
+  const handleFrame = async (buffer, ws) => {
+    const { header, payload } = parseFrame(buffer);
+
+    // Pushed live preview frame; anything from a stream we no longer show is dropped
+    if (header.type === "live_frame") {
+      if (header.stream_id !== liveStreamRef.current) return;
+      const compositor = liveCompositorRef.current;
+      if (header.keyframe === false && header.base_seq !== compositor.seq) {
+        // Missed the frame this delta builds on: drop deltas until a keyframe arrives
+        if (!compositor.resyncing) {
+          compositor.resyncing = true;
+          ws.send(JSON.stringify({ type: "live_preview_keyframe", target: header.device_id, stream_id: header.stream_id }));
+        }
+        return;
+      }
+      compositor.seq = header.seq;
+      if (header.keyframe !== false) compositor.resyncing = false;
+
+      // Decoding is asynchronous, but frames must be painted strictly in order
+      const { tiles, ...info } = header;
+      compositor.painting = compositor.painting
+        .then(() => composeLiveFrame(compositor.canvas, header, payload))
+        .then(() => {
+          paintLiveCanvas();
+          setLivePreview(prev => {
+            if (prev?.image_url) URL.revokeObjectURL(prev.image_url);
+            return { ...info, canvas: true };
+          });
+          setLastFrameTime(new Date());
+        })
+        .catch(err => console.error("Live frame decode failed:", err));
+      return;
+    }
+
+    // Binary response: the header is the JSON response minus one field, whose raw bytes are the payload
+    if (header.type === "response" && header.payload_field) {
+      const result = header.result || {};
+      const mimeType = result.mime_type || (result.format ? `image/${result.format.toLowerCase()}` : 'application/octet-stream');
+      const url = URL.createObjectURL(new Blob([payload], { type: mimeType }));
+      handleMessage({ ...header, result: { ...result, [`${header.payload_field}_url`]: url } });
+      return;
+    }
+
+    if (header.type === "download_chunk") {
+      const transfer = transfersRef.current[header.transfer_id];
+      if (!transfer || transfer.failed) return;
+
+      const stored = (async () => {
+        const digest = await sha256Hex(payload);
+        if (digest && digest !== header.sha256) {
+          console.error(`Chunk ${header.seq} of ${transfer.filename} failed its integrity check`);
+          transfer.failed = true;
+          ws.send(JSON.stringify({ type: "transfer_cancel", target: header.device_id, transfer_id: header.transfer_id }));
+          return;
+        }
+
+        transfer.chunks[header.seq] = payload;
+        transfer.received += payload.length;
+        ws.send(JSON.stringify({ type: "transfer_ack", target: header.device_id, transfer_id: header.transfer_id, seq: header.seq }));
+      })();
+      transfer.pending.add(stored);
+      await stored;
+      transfer.pending.delete(stored);
+    }
+  };
+
+  // Send upload chunks until the window is full; commit once everything is acked
+  const pumpUpload = async (upload) => {
+    const ws = socketRef.current;
+    if (!ws || ws.readyState !== WebSocket.OPEN || upload.failed) return;
 
+    while (upload.inFlight < UPLOAD_WINDOW && upload.nextOffset < upload.file.size) {
+      const offset = upload.nextOffset;
+      const end = Math.min(offset + upload.chunkSize, upload.file.size);
+      upload.nextOffset = end;
+      upload.inFlight += 1;
+
+      const payload = await upload.file.slice(offset, end).arrayBuffer();
+      const digest = await sha256Hex(payload);
+      ws.send(encodeFrame({
+        type: "upload_chunk",
+        target: upload.target,
+        upload_id: upload.uploadId,
+        offset,
+        ...(digest && { sha256: digest })
+      }, payload));
+    }
+
+    if (upload.inFlight === 0 && upload.nextOffset >= upload.file.size && !upload.committing) {
+      upload.committing = true;
+      ws.send(JSON.stringify({ type: "upload_commit", target: upload.target, upload_id: upload.uploadId }));
+    }
+  };
 
   const handleMessage = (msg) => {
     console.log("Received message:", msg);
     
+    // Rebuild the full snapshot from a delta; until a keyframe has arrived there is nothing to apply it to
+    if (msg.type === "stats_delta") {
+      const snapshot = statsSnapshots.current[msg.device_id];
+      if (!snapshot) return;
+      msg = { ...msg, type: "stats", data: mergeStats(snapshot, msg.data) };
+    }
+
     if (msg.type === "stats") {
+      statsSnapshots.current[msg.device_id] = msg.data;
       setDevices(prev => ({
         ...prev,
         [msg.device_id]: {
@@ -502,7 +805,40 @@ export default function App() {
     } else if (msg.type === "response") {
       console.log("Response received:", msg.request_type, msg.result);
       
-      if (msg.request_type === "execute") {
+      if (msg.request_type === "fleet_command") {
+        const result = msg.result || {};
+        const latency = result.latency_ms || {};
+        const text = result.error ? `Fleet error: ${result.error}` :
+          `[fleet ${result.cancelled ? 'cancelled' : 'done'}: ${result.completed}/${result.total} hosts in ${(result.elapsed_ms / 1000).toFixed(1)}s] ` +
+          Object.entries(result.by_status || {}).map(([status, count]) => `${status}=${count}`).join(' ') +
+          (latency.p50 !== null && latency.p50 !== undefined ? ` | latency p50 ${latency.p50}ms p90 ${latency.p90}ms p99 ${latency.p99}ms` : '');
+        setTerminalOutput(prev => [...prev, { source: 'fleet', text, type: 'output' }]);
+      } else if (msg.request_type === "pty_open") {
+        if (msg.result?.session_id) {
+          const sessionId = msg.result.session_id;
+          setShellSession({ id: sessionId, target: msg.device_id });
+          setTerminalOutput(prev => appendCommandOutput(prev, {
+            device_id: msg.device_id, command_id: `pty:${sessionId}`, stdout: stripAnsi(msg.result.scrollback || '')
+          }));
+        } else {
+          setTerminalOutput(prev => [...prev, { source: msg.device_id, text: `Error: ${msg.result?.error}`, type: 'output' }]);
+        }
+      } else if (msg.request_type === "execute" && msg.result?.streamed) {
+        // The output already arrived as output_chunk messages; only the outcome is left
+        setRunningCommand(prev => (prev?.id === msg.result.command_id ? null : prev));
+        const { exit_code: exitCode, stop_reason: stopReason } = msg.result;
+        if (exitCode !== 0 || stopReason) {
+          setTerminalOutput(prev => [...prev, {
+            source: msg.device_id,
+            text: stopReason ? `[stopped: ${stopReason.replace('_', ' ')}, exit code ${exitCode}]` : `[exit code ${exitCode}]`,
+            type: 'output'
+          }]);
+        }
+        if (msg.result.working_dir) {
+          setCurrentPath(msg.result.working_dir);
+        }
+      } else if (msg.request_type === "execute") {
+        setRunningCommand(null);
         // Handle execute response properly - extract text content
         let outputText = "";
         if (typeof msg.result === 'object' && msg.result !== null) {
@@ -528,18 +864,35 @@ export default function App() {
           setCurrentPath(msg.result.working_dir);
         }
       } else if (msg.request_type === "get_processes") {
-        console.log("Setting processes:", msg.result?.processes?.length);
-        setProcesses(msg.result?.processes || []);
+        if (msg.result?.snapshot) {
+          processSnapshotRef.current = msg.result.snapshot;
+          setProcesses((prev) => mergeProcesses(prev, msg.result));
+        } else {
+          processSnapshotRef.current = null;
+          setProcesses(msg.result?.processes || []);
+        }
       } else if (msg.request_type === "get_directory") {
         console.log("Setting directory:", msg.result?.current_path);
         setCurrentPath(msg.result?.current_path || '.');
-        setDirectoryContents(msg.result?.items || []);
+        if (msg.result?.entries) {
+          // A later page is appended to what is already shown
+          const items = expandListing(msg.result);
+          setDirectoryContents(prev => msg.result.cursor ? [...prev, ...items] : items);
+          setDirectoryCursor(msg.result.next_cursor ?? null);
+          setDirectoryTotal(msg.result.total || 0);
+        } else {
+          setDirectoryContents(msg.result?.items || []);
+          setDirectoryCursor(null);
+        }
       } else if (msg.request_type === "get_system_info") {
         console.log("Setting system info:", Object.keys(msg.result || {}));
         setSystemInfo(msg.result || {});
       } else if (msg.request_type === "read_file") {
         console.log("File content received:", msg.result?.type);
-        setFileContent(msg.result);
+        setFileContent(prev => {
+          if (prev?.content_url) URL.revokeObjectURL(prev.content_url);
+          return msg.result;
+        });
         setFileViewerOpen(true);
       } else if (msg.request_type === "open_file") {
         console.log("File opened with system:", msg.result?.success || msg.result?.error);
@@ -552,23 +905,32 @@ export default function App() {
             byteNumbers[i] = byteCharacters.charCodeAt(i);
           }
           const byteArray = new Uint8Array(byteNumbers);
-          const blob = new Blob([byteArray], { type: msg.result.mime_type });
-          const url = URL.createObjectURL(blob);
-          
-          const a = document.createElement('a');
-          a.href = url;
-          a.download = msg.result.filename;
-          document.body.appendChild(a);
-          a.click();
-          document.body.removeChild(a);
-          URL.revokeObjectURL(url);
+          saveBlob(new Blob([byteArray], { type: msg.result.mime_type }), msg.result.filename);
+        } else if (msg.result?.transfer_id) {
+          // Streaming transfer finished: assemble once every chunk still being checked is stored
+          const transfer = transfersRef.current[msg.result.transfer_id];
+          delete transfersRef.current[msg.result.transfer_id];
+          Promise.all(transfer ? [...transfer.pending] : []).then(() => {
+            if (transfer && msg.result.complete && !transfer.failed && transfer.received === transfer.expected) {
+              saveBlob(new Blob(transfer.chunks, { type: transfer.mimeType }), transfer.filename);
+            } else {
+              console.error("Download failed:", msg.result.error || "incomplete transfer");
+            }
+          });
         }
       } else if (msg.request_type === "search_files") {
-        console.log("Search results received:", msg.result?.results?.length);
-        setSearchResults(msg.result?.results || []);
+        console.log("Search results received:", msg.result?.results?.length, msg.result?.elapsed_ms, "ms");
+        const results = msg.result?.results || [];
+        // A later page is appended to what is already shown
+        setSearchResults(prev => msg.result?.offset ? [...prev, ...results] : results);
+        setSearchNextOffset(msg.result?.next_offset ?? null);
       } else if (msg.request_type === "create_file" || msg.request_type === "create_directory" || 
                  msg.request_type === "delete_item" || msg.request_type === "rename_item" || 
-                 msg.request_type === "copy_item" || msg.request_type === "upload_file") {
+                 msg.request_type === "copy_item" || msg.request_type === "upload_file" ||
+                 msg.request_type === "upload_open") {
+        if (msg.result?.upload_id) {
+          delete uploadsRef.current[msg.result.upload_id];
+        }
         console.log("File operation result:", msg.result?.success || msg.result?.error);
         // Refresh directory after file operations
         setTimeout(() => loadDirectory(currentPath), 500);
@@ -576,8 +938,11 @@ export default function App() {
         console.log("Live frame/Screenshot received:", msg.result?.width, msg.result?.height);
         
         // Only update live preview if we have valid image data
-        if (msg.result && msg.result.image && !msg.result.error) {
-          setLivePreview(msg.result);
+        if (msg.result && (msg.result.image || msg.result.image_url) && !msg.result.error) {
+          setLivePreview(prev => {
+            if (prev?.image_url) URL.revokeObjectURL(prev.image_url);
+            return msg.result;
+          });
           setLastFrameTime(new Date());
         } else if (msg.result && msg.result.error) {
           console.error("Live frame error:", msg.result.error);
@@ -623,6 +988,73 @@ export default function App() {
         console.log("System context received:", msg.result);
         setSystemContext(msg.result);
       }
+    } else if (msg.type === "stats_history") {
+      if (!msg.error) setStatsHistory(msg);
+    } else if (msg.type === "fleet_start") {
+      setTerminalOutput(prev => [...prev, { source: 'fleet', text: `[fleet: running on ${msg.devices.length} devices, ${msg.parallelism} at a time]`, type: 'output' }]);
+    } else if (msg.type === "fleet_progress") {
+      setTerminalOutput(prev => [...prev, ...msg.results.map(result => ({
+        source: result.device_id,
+        text: `[${result.device_id}] ${result.status}${result.exit_code !== undefined ? ` (exit ${result.exit_code})` : ''}` +
+          `${result.latency_ms !== null ? ` ${result.latency_ms}ms` : ''}\n` +
+          `${result.stdout || ''}${result.stderr || ''}${result.error || ''}${result.truncated ? '\n[output truncated]' : ''}`.trimEnd(),
+        type: 'output',
+        stream: result.status === 'ok' ? 'stdout' : 'stderr'
+      }))].slice(-500));
+    } else if (msg.type === "output_chunk") {
+      setTerminalOutput(prev => appendCommandOutput(prev, msg));
+    } else if (msg.type === "pty_output") {
+      setTerminalOutput(prev => appendCommandOutput(prev, {
+        device_id: msg.device_id, command_id: `pty:${msg.session_id}`, stdout: stripAnsi(msg.data)
+      }));
+    } else if (msg.type === "pty_exit") {
+      setShellSession(prev => (prev?.id === msg.session_id ? null : prev));
+      setTerminalOutput(prev => [...prev, {
+        source: msg.device_id,
+        text: `[shell session ended: ${msg.reason}${msg.exit_code !== null && msg.exit_code !== undefined ? `, exit code ${msg.exit_code}` : ''}]`,
+        type: 'output'
+      }]);
+    } else if (msg.type === "live_preview_stopped") {
+      if (msg.stream_id === liveStreamRef.current) {
+        console.log("Live preview stopped by agent:", msg.reason);
+        liveStreamRef.current = null;
+        setIsLiveStreaming(false);
+      }
+    } else if (msg.type === "upload_ready") {
+      const upload = uploadsRef.current[msg.upload_id];
+      if (upload) {
+        upload.chunkSize = msg.chunk_size || upload.chunkSize;
+        // Resuming: skip the prefix the agent already has
+        const first = msg.received?.[0];
+        if (first && first[0] === 0) {
+          upload.nextOffset = Math.max(upload.nextOffset, first[1]);
+        }
+        pumpUpload(upload);
+      }
+    } else if (msg.type === "upload_ack") {
+      const upload = uploadsRef.current[msg.upload_id];
+      if (upload) {
+        upload.inFlight -= 1;
+        if (!msg.ok) {
+          console.error(`Upload of ${upload.file.name} failed:`, msg.error);
+          upload.failed = true;
+          socketRef.current?.send(JSON.stringify({ type: "upload_abort", target: upload.target, upload_id: upload.uploadId }));
+        } else {
+          pumpUpload(upload);
+        }
+      }
+    } else if (msg.type === "download_start") {
+      transfersRef.current[msg.transfer_id] = {
+        filename: msg.filename,
+        mimeType: msg.mime_type,
+        size: msg.size,
+        expected: msg.size - (msg.offset || 0),
+        chunks: [],
+        // Chunks still being checked; the final response waits for them
+        pending: new Set(),
+        received: 0,
+        failed: false
+      };
     } else if (msg.type === "device_list") {
         msg.devices.forEach(d => {
             setDevices(prev => ({
@@ -638,6 +1070,24 @@ export default function App() {
     if (!commandInput.trim() || !selectedDevice) return;
 
     const cmd = commandInput;
+
+    if (fleetMode && !shellSession && !isMock && socket && socket.readyState === WebSocket.OPEN) {
+      const reqId = requestId;
+      setRequestId(prev => prev + 1);
+      setTerminalOutput(prev => [...prev, { source: "ME", text: `fleet:* $ ${cmd}`, type: 'input' }]);
+      socket.send(JSON.stringify({ type: "fleet_command", request_id: reqId, cmd, devices: "*" }));
+      setCommandHistory(prev => [cmd, ...prev.filter(c => c !== cmd)].slice(0, 10));
+      setCommandInput("");
+      return;
+    }
+
+    if (shellSession && socket && socket.readyState === WebSocket.OPEN) {
+      // The shell echoes the line itself
+      socket.send(JSON.stringify({ type: "pty_input", target: shellSession.target, session_id: shellSession.id, data: `${cmd}\r` }));
+      setCommandHistory(prev => [cmd, ...prev.filter(c => c !== cmd)].slice(0, 10));
+      setCommandInput("");
+      return;
+    }
     
     setTerminalOutput(prev => [...prev, { 
       source: "ME", 
@@ -662,31 +1112,94 @@ export default function App() {
     } else if (socket && socket.readyState === WebSocket.OPEN) {
       const reqId = requestId;
       setRequestId(prev => prev + 1);
+      const commandId = `cmd-${Date.now()}-${reqId}`;
+      setRunningCommand({ id: commandId, target: selectedDevice });
       
+      // Output streams back as output_chunk messages while the command runs
       socket.send(JSON.stringify({
         type: "command",
         target: selectedDevice,
         request_id: reqId,
-        cmd: cmd
+        cmd: cmd,
+        stream: true,
+        command_id: commandId
       }));
     }
 
     setCommandInput("");
   };
 
+  const openShell = () => {
+    console.log("Opening shell session on", selectedDevice);
+    sendRequest("pty_open", { rows: SHELL_ROWS, cols: SHELL_COLS });
+  };
+
+  const closeShell = () => {
+    if (!shellSession) return;
+    sendRequest("pty_close", { session_id: shellSession.id });
+  };
+
+  // Control keys for the shell session (Ctrl+C interrupts, Ctrl+D ends input)
+  const sendShellKey = (key) => {
+    if (!shellSession || !socket || socket.readyState !== WebSocket.OPEN) return;
+    socket.send(JSON.stringify({ type: "pty_input", target: shellSession.target, session_id: shellSession.id, data: key }));
+  };
+
+  const cancelCommand = (force = false) => {
+    if (!runningCommand || !socket || socket.readyState !== WebSocket.OPEN) return;
+    console.log("Stopping command:", runningCommand.id, force ? "(kill)" : "");
+    socket.send(JSON.stringify({
+      type: "command_cancel",
+      target: runningCommand.target,
+      command_id: runningCommand.id,
+      force
+    }));
+  };
+
+  // Copy the compositor canvas onto the visible one (also when the visible one mounts)
+  const paintLiveCanvas = () => {
+    const target = liveCanvasRef.current;
+    const source = liveCompositorRef.current.canvas;
+    if (!target || !source || !source.width) return;
+    if (target.width !== source.width || target.height !== source.height) {
+      target.width = source.width;
+      target.height = source.height;
+    }
+    target.getContext('2d').drawImage(source, 0, 0);
+  };
+
+  const attachLiveCanvas = (element) => {
+    liveCanvasRef.current = element;
+    paintLiveCanvas();
+  };
+
   const startLivePreview = () => {
     if (!selectedDevice || isLiveStreaming) return;
     
+    liveCompositorRef.current = { seq: null, painting: Promise.resolve(), canvas: document.createElement('canvas'), resyncing: false };
+    liveStreamRef.current = `live-${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 8)}`;
     setIsLiveStreaming(true);
     sendRequest("start_live_preview", { 
+      stream_id: liveStreamRef.current,
       quality: streamQuality,
-      interval: streamInterval
+      fps: streamFps
     });
   };
 
   const stopLivePreview = () => {
     setIsLiveStreaming(false);
-    sendRequest("stop_live_preview");
+    if (liveStreamRef.current) {
+      sendRequest("stop_live_preview", { stream_id: liveStreamRef.current });
+      liveStreamRef.current = null;
+    }
+  };
+
+  // Retune a running stream in place (same stream_id) when its settings change
+  const changeStreamQuality = (quality) => {
+    setStreamQuality(quality);
+    if (isLiveStreaming && liveStreamRef.current) {
+      sendRequest("start_live_preview", { stream_id: liveStreamRef.current, quality, fps: streamFps });
+    }
   };
 
   const toggleLivePreview = () => {
@@ -701,7 +1214,7 @@ export default function App() {
     if (!selectedDevice) return;
     
     setIsCapturingScreen(true);
-    sendRequest("take_screenshot", { quality: streamQuality });
+    sendRequest("take_screenshot", { quality: streamQuality, binary: true });
   };
 
   const sendRequest = (type, data = {}) => {
@@ -725,14 +1238,24 @@ export default function App() {
     socket.send(JSON.stringify(requestData));
   };
 
+  const loadStatsHistory = () => {
+    if (!socket || socket.readyState !== WebSocket.OPEN) return;
+    socket.send(JSON.stringify({
+      type: "stats_history",
+      device_id: selectedDevice,
+      points: STATS_HISTORY_POINTS,
+      series: ["cpu_percent", "ram_percent"]
+    }));
+  };
+
   const loadProcesses = () => {
-    console.log("Loading processes...");
-    sendRequest("get_processes");
+    // Later polls only ask for what changed since the last list we received
+    sendRequest("get_processes", processSnapshotRef.current ? { since: processSnapshotRef.current } : {});
   };
   
-  const loadDirectory = (path) => {
-    console.log("Loading directory:", path);
-    sendRequest("get_directory", { path });
+  const loadDirectory = (path, cursor = null) => {
+    console.log("Loading directory:", path, cursor ? "(next page)" : "");
+    sendRequest("get_directory", { path, limit: DIRECTORY_PAGE_SIZE, sort: sortBy, order: sortOrder, cursor });
   };
   
   const loadSystemInfo = () => {
@@ -747,7 +1270,7 @@ export default function App() {
 
   const openFile = (filePath, fileName) => {
     console.log("Opening file:", filePath);
-    sendRequest("read_file", { file_path: filePath });
+    sendRequest("read_file", { file_path: filePath, binary: true });
   };
 
   const openWithSystem = (filePath) => {
@@ -757,13 +1280,17 @@ export default function App() {
 
   const downloadFile = (filePath) => {
     console.log("Downloading file:", filePath);
-    sendRequest("download_file", { file_path: filePath });
+    sendRequest("download_file", { file_path: filePath, stream: true });
   };
 
-  const searchFiles = () => {
-    if (!searchQuery.trim()) return;
-    console.log("Searching files:", searchQuery, "in:", currentPath);
-    sendRequest("search_files", { query: searchQuery, path: currentPath });
+  const searchFiles = (offset = 0) => {
+    const query = searchQuery.trim();
+    if (!query) return;
+    // /pattern/ searches by regular expression, wildcards by glob, anything else by substring
+    const isRegex = query.length > 2 && query.startsWith('/') && query.endsWith('/');
+    const mode = isRegex ? 'regex' : /[*?[]/.test(query) ? 'glob' : 'substring';
+    console.log("Searching files:", query, "mode:", mode, "in:", currentPath);
+    sendRequest("search_files", { query: isRegex ? query.slice(1, -1) : query, mode, path: currentPath, offset });
   };
 
   const createNewItem = () => {
@@ -824,36 +1351,23 @@ export default function App() {
 
     Array.from(files).forEach(file => {
       console.log("Uploading file:", file.name, "size:", file.size);
-      
-      const reader = new FileReader();
-      reader.onload = (e) => {
-        try {
-          // Convert ArrayBuffer to base64
-          const arrayBuffer = e.target.result;
-          const uint8Array = new Uint8Array(arrayBuffer);
-          let binaryString = '';
-          for (let i = 0; i < uint8Array.length; i++) {
-            binaryString += String.fromCharCode(uint8Array[i]);
-          }
-          const base64Content = btoa(binaryString);
-          
-          const filePath = `${currentPath}/${file.name}`;
-          console.log("Sending upload request for:", filePath);
-          
-          sendRequest("upload_file", { file_path: filePath, content: base64Content });
-          
-        } catch (error) {
-          console.error("Upload error:", error);
-          alert(`Upload failed for ${file.name}: ${error.message}`);
-        }
-      };
-      
-      reader.onerror = () => {
-        console.error("File read error for:", file.name);
-        alert(`Failed to read file: ${file.name}`);
+
+      // Chunks are streamed from the File as the agent acks them, never read in full
+      const uploadId = `${Date.now().toString(36)}${Math.random().toString(36).slice(2, 10)}`;
+      uploadsRef.current[uploadId] = {
+        file,
+        uploadId,
+        target: selectedDevice,
+        chunkSize: 256 * 1024,
+        nextOffset: 0,
+        inFlight: 0,
+        committing: false,
+        failed: false
       };
-      
-      reader.readAsArrayBuffer(file);
+
+      const filePath = `${currentPath}/${file.name}`;
+      console.log("Sending upload request for:", filePath);
+      sendRequest("upload_open", { file_path: filePath, size: file.size, upload_id: uploadId });
     });
     
     event.target.value = ""; // Reset input
@@ -931,11 +1445,16 @@ export default function App() {
       setNetworkHistory([]);
       setProcessCountHistory([]);
       setDiskUsageHistory([]);
+      setStatsHistory(null);
       
       // Clear other data that might be device-specific
       setTerminalOutput([]);
+      setRunningCommand(null);
+      // A shell left behind keeps running, detached, until the agent reaps it
+      setShellSession(null);
       setSystemInfo({});
       setProcesses([]);
+      processSnapshotRef.current = null;
       setDirectoryContents([]);
       setServices([]);
       setEnvironmentVars([]);
@@ -970,6 +1489,7 @@ export default function App() {
       
       // Load fresh data for the new device
       loadSystemInfo();
+      loadStatsHistory();
     }
   }, [selectedDevice]);
 
@@ -1031,6 +1551,13 @@ export default function App() {
     }
   }, [selectedDevice, activeTab, currentPath, logType, isLiveStreaming]);
 
+  // The agent does the sorting, so a new sort order reloads the listing from the first page
+  useEffect(() => {
+    if (selectedDevice && !isMock && activeTab === 'files') {
+      loadDirectory(currentPath);
+    }
+  }, [sortBy, sortOrder]);
+
   // Auto-refresh data based on current tab
   useEffect(() => {
     if (selectedDevice && !isMock) {
@@ -1310,8 +1837,26 @@ export default function App() {
             <>
               {activeTab === 'terminal' && (
                 <div className="flex-1 bg-[#020617] rounded-2xl border border-slate-800 p-6 font-mono text-[13px] overflow-y-auto custom-scrollbar shadow-2xl relative group">
-                  <div className="absolute top-4 right-4 text-[10px] text-slate-700 font-bold uppercase tracking-widest opacity-0 group-hover:opacity-100 transition-opacity">
-                    Terminal Live Stream
+                  <div className="absolute top-4 right-4 flex items-center gap-2">
+                    <span className="text-[10px] text-slate-700 font-bold uppercase tracking-widest opacity-0 group-hover:opacity-100 transition-opacity">
+                      {shellSession ? 'Shell Session' : 'Terminal Live Stream'}
+                    </span>
+                    {shellSession ? (
+                      <>
+                        <button onClick={() => sendShellKey('\x03')} className="px-2 py-1 bg-slate-800 hover:bg-slate-700 text-slate-300 rounded text-[10px] font-bold">Ctrl+C</button>
+                        <button onClick={() => sendShellKey('\x04')} className="px-2 py-1 bg-slate-800 hover:bg-slate-700 text-slate-300 rounded text-[10px] font-bold">Ctrl+D</button>
+                        <button onClick={closeShell} className="px-2 py-1 bg-red-600/80 hover:bg-red-500 text-white rounded text-[10px] font-bold">Close Shell</button>
+                      </>
+                    ) : (
+                      <button
+                        onClick={openShell}
+                        disabled={!selectedDevice || isMock}
+                        title="Run commands in one persistent shell (cd, exports and venvs carry over)"
+                        className="px-2 py-1 bg-emerald-600/80 hover:bg-emerald-500 text-white rounded text-[10px] font-bold disabled:opacity-30"
+                      >
+                        Open Shell
+                      </button>
+                    )}
                   </div>
                   <div className="text-emerald-500/50 mb-6 flex items-start gap-3">
                     <Shield className="w-4 h-4 mt-1" />
@@ -1330,7 +1875,7 @@ export default function App() {
                             <span className="text-white font-medium">{log.text}</span>
                          </div>
                       ) : (
-                         <div className="pl-6 text-slate-400 leading-relaxed border-l-2 border-slate-800/50 ml-1.5 whitespace-pre-wrap">
+                         <div className={`pl-6 leading-relaxed border-l-2 border-slate-800/50 ml-1.5 whitespace-pre-wrap ${log.stream === 'stderr' ? 'text-red-400' : 'text-slate-400'}`}>
                             {typeof log.text === 'object' ? JSON.stringify(log.text, null, 2) : log.text}
                          </div>
                       )}
@@ -1419,7 +1964,7 @@ export default function App() {
                         />
                         {searchQuery && (
                           <button 
-                            onClick={() => { setSearchQuery(""); setSearchResults([]); }}
+                            onClick={() => { setSearchQuery(""); setSearchResults([]); setSearchNextOffset(null); }}
                             className="p-1 hover:bg-slate-800 rounded text-slate-400"
                           >
                             <X className="w-3 h-3" />
@@ -1526,27 +2071,21 @@ export default function App() {
                             </div>
                           ))}
                         </div>
+                        {searchNextOffset !== null && (
+                          <button
+                            onClick={() => searchFiles(searchNextOffset)}
+                            className="mt-3 w-full px-3 py-2 bg-slate-800 hover:bg-slate-700 text-slate-300 rounded-lg text-xs"
+                          >
+                            Load more results
+                          </button>
+                        )}
                       </div>
                     ) : (
                       /* Regular File Browser */
                       <div className="p-4">
                         <div className={viewMode === 'grid' ? 'grid grid-cols-4 gap-3' : 'space-y-1'}>
+                          {/* Sorted by the agent, page by page */}
                           {directoryContents
-                            .sort((a, b) => {
-                              let aVal = a[sortBy];
-                              let bVal = b[sortBy];
-                              
-                              if (sortBy === 'size') {
-                                aVal = a.size || 0;
-                                bVal = b.size || 0;
-                              }
-                              
-                              if (sortOrder === 'desc') {
-                                [aVal, bVal] = [bVal, aVal];
-                              }
-                              
-                              return aVal > bVal ? 1 : -1;
-                            })
                             .map((item, idx) => (
                               viewMode === 'grid' ? (
                                 /* Grid View */
@@ -1710,6 +2249,15 @@ export default function App() {
                             ))}
                         </div>
                         
+                        {directoryCursor !== null && (
+                          <button
+                            onClick={() => loadDirectory(currentPath, directoryCursor)}
+                            className="mt-3 w-full px-3 py-2 bg-slate-800 hover:bg-slate-700 text-slate-300 rounded-lg text-xs"
+                          >
+                            Load more ({directoryContents.filter(item => item.name !== '..').length} of {directoryTotal})
+                          </button>
+                        )}
+                        
                         {directoryContents.length === 0 && (
                           <div className="text-center py-8 text-slate-500">
                             <FolderOpen className="w-8 h-8 mx-auto mb-2 opacity-50" />
@@ -1933,6 +2481,42 @@ export default function App() {
                     </div>
                   </div>
 
+                  {/* Last 24 hours, from the server's stats history */}
+                  {statsHistory?.device_id === selectedDevice && statsHistory.timestamps.length > 1 && (
+                    <div className="bg-[#020617] rounded-2xl border border-slate-800 p-6">
+                      <div className="flex items-center gap-3 mb-4">
+                        <BarChart3 className="text-purple-400 w-5 h-5" />
+                        <span className="text-white font-medium">Last 24 Hours</span>
+                        <span className="text-emerald-400 text-sm">CPU</span>
+                        <span className="text-blue-400 text-sm">Memory</span>
+                        <span className="text-slate-500 text-sm ml-auto">
+                          ({Math.round(statsHistory.resolution / 60)} min average)
+                        </span>
+                      </div>
+                      <div className="h-40 bg-slate-900/30 rounded-lg p-3">
+                        <svg width="100%" height="100%" viewBox="0 0 100 100" preserveAspectRatio="none">
+                          {[0, 25, 50, 75, 100].map(y => (
+                            <line key={y} x1="0" y1={100 - y} x2="100" y2={100 - y} stroke="#334155" strokeWidth="0.5" strokeDasharray="2,2" vectorEffect="non-scaling-stroke" />
+                          ))}
+                          {[['cpu_percent', '#10b981'], ['ram_percent', '#3b82f6']].map(([name, color]) => (
+                            <polyline
+                              key={name}
+                              fill="none"
+                              stroke={color}
+                              strokeWidth="2"
+                              vectorEffect="non-scaling-stroke"
+                              points={statsHistory.timestamps.map((time, i) => {
+                                const value = statsHistory.series[name]?.avg[i];
+                                const x = ((time - statsHistory.start) / (statsHistory.end - statsHistory.start)) * 100;
+                                return value === null || value === undefined ? null : `${x},${100 - value}`;
+                              }).filter(Boolean).join(' ')}
+                            />
+                          ))}
+                        </svg>
+                      </div>
+                    </div>
+                  )}
+
                   {/* Network Activity & Process Count */}
                   <div className="grid grid-cols-2 gap-6">
                     <div className="bg-[#020617] rounded-2xl border border-slate-800 p-6">
@@ -2244,17 +2828,18 @@ export default function App() {
                     {/* Settings Controls */}
                     <div className="flex items-center gap-6 p-3 bg-slate-900/30 rounded-lg">
                       <div className="flex items-center gap-2">
-                        <label className="text-slate-400 text-sm">Stream Interval:</label>
+                        <label className="text-slate-400 text-sm">Frame Rate:</label>
                         <select 
-                          value={streamInterval}
-                          onChange={(e) => setStreamInterval(Number(e.target.value))}
+                          value={streamFps}
+                          onChange={(e) => setStreamFps(Number(e.target.value))}
                           className="bg-slate-800 text-white border border-slate-600 rounded px-2 py-1 text-xs"
                           disabled={isLiveStreaming}
                         >
-                          <option value={0.5}>0.5 seconds</option>
-                          <option value={1}>1 second</option>
-                          <option value={2}>2 seconds</option>
-                          <option value={3}>3 seconds</option>
+                          <option value={1}>1 fps</option>
+                          <option value={2}>2 fps</option>
+                          <option value={5}>5 fps</option>
+                          <option value={10}>10 fps</option>
+                          <option value={15}>15 fps</option>
                         </select>
                       </div>
                       
@@ -2262,7 +2847,7 @@ export default function App() {
                         <label className="text-slate-400 text-sm">Quality:</label>
                         <select 
                           value={streamQuality}
-                          onChange={(e) => setStreamQuality(e.target.value)}
+                          onChange={(e) => changeStreamQuality(e.target.value)}
                           className="bg-slate-800 text-white border border-slate-600 rounded px-2 py-1 text-xs"
                         >
                           <option value="low">Low (Fast)</option>
@@ -2280,7 +2865,7 @@ export default function App() {
                   </div>
                   
                   {/* Live Preview Display */}
-                  {livePreview && livePreview.image && !livePreview.error ? (
+                  {livePreview && (livePreview.canvas || previewSrc(livePreview)) && !livePreview.error ? (
                     <div className="space-y-4">
                       {/* Live Stream Image with Enhanced Display */}
                       <div className="bg-slate-900 rounded-lg border border-slate-700 overflow-hidden">
@@ -2314,18 +2899,28 @@ export default function App() {
                         
                         <div className="p-4">
                           <div className="relative group cursor-pointer">
-                            <img 
-                              id="live-preview"
-                              src={livePreview?.image ? `data:image/png;base64,${livePreview.image}` : 'data:image/svg+xml;base64,PHN2ZyB3aWR0aD0iMSIgaGVpZ2h0PSIxIiB2aWV3Qm94PSIwIDAgMSAxIiBmaWxsPSJub25lIiB4bWxucz0iaHR0cDovL3d3dy53My5vcmcvMjAwMC9zdmciPjxyZWN0IHdpZHRoPSIxIiBoZWlnaHQ9IjEiIGZpbGw9IiMzNzQxNTEiLz48L3N2Zz4='} 
-                              alt="Live Desktop Preview"
-                              className="max-w-full h-auto rounded border border-slate-600 transition-transform hover:scale-105"
-                              style={{ maxHeight: '70vh' }}
-                              onError={(e) => {
-                                console.error('Image load error:', e);
-                                // Fallback to a placeholder
-                                e.target.style.display = 'none';
-                              }}
-                            />
+                            {livePreview.canvas ? (
+                              // Streamed frames are composited from tiles onto a canvas
+                              <canvas 
+                                id="live-preview"
+                                ref={attachLiveCanvas}
+                                className="max-w-full h-auto rounded border border-slate-600 transition-transform hover:scale-105"
+                                style={{ maxHeight: '70vh' }}
+                              />
+                            ) : (
+                              <img 
+                                id="live-preview"
+                                src={previewSrc(livePreview) || 'data:image/svg+xml;base64,PHN2ZyB3aWR0aD0iMSIgaGVpZ2h0PSIxIiB2aWV3Qm94PSIwIDAgMSAxIiBmaWxsPSJub25lIiB4bWxucz0iaHR0cDovL3d3dy53My5vcmcvMjAwMC9zdmciPjxyZWN0IHdpZHRoPSIxIiBoZWlnaHQ9IjEiIGZpbGw9IiMzNzQxNTEiLz48L3N2Zz4='} 
+                                alt="Live Desktop Preview"
+                                className="max-w-full h-auto rounded border border-slate-600 transition-transform hover:scale-105"
+                                style={{ maxHeight: '70vh' }}
+                                onError={(e) => {
+                                  console.error('Image load error:', e);
+                                  // Fallback to a placeholder
+                                  e.target.style.display = 'none';
+                                }}
+                              />
+                            )}
                             
                             {/* Overlay with info on hover */}
                             <div className="absolute inset-0 bg-black bg-opacity-0 group-hover:bg-opacity-20 transition-all duration-200 rounded flex items-center justify-center">
@@ -2351,7 +2946,7 @@ export default function App() {
                         
                         <div className="bg-slate-900/50 rounded-lg p-3">
                           <div className="text-slate-400 text-xs mb-1">Quality</div>
-                          <div className="text-white text-sm font-medium capitalize">{streamQuality}</div>
+                          <div className="text-white text-sm font-medium capitalize">{livePreview.quality || streamQuality}</div>
                         </div>
                         
                         <div className="bg-slate-900/50 rounded-lg p-3">
@@ -2359,7 +2954,7 @@ export default function App() {
                           <div className={`text-sm font-medium ${
                             isLiveStreaming ? 'text-green-400' : 'text-slate-400'
                           }`}>
-                            {isLiveStreaming ? `Every ${streamInterval}s` : 'Stopped'}
+                            {isLiveStreaming ? `${livePreview.fps ?? streamFps} fps` : 'Stopped'}
                           </div>
                         </div>
                       </div>
@@ -2368,10 +2963,16 @@ export default function App() {
                       <div className="flex gap-2 justify-center pt-4">
                         <button 
                           onClick={() => {
-                            if (livePreview?.image) {
+                            const href = livePreview.canvas
+                              ? liveCanvasRef.current?.toDataURL('image/png')
+                              : previewSrc(livePreview);
+                            if (href) {
+                              // Canvas exports are PNG; other frames keep the format they were encoded in
+                              const format = livePreview.canvas ? 'png' : (livePreview.format || 'png').toLowerCase();
+                              const extension = format === 'jpeg' ? 'jpg' : format;
                               const link = document.createElement('a');
-                              link.href = `data:image/png;base64,${livePreview.image}`;
-                              link.download = `desktop-preview-${new Date().toISOString().slice(0, 19)}.png`;
+                              link.href = href;
+                              link.download = `desktop-preview-${new Date().toISOString().slice(0, 19)}.${extension}`;
                               link.click();
                             }
                           }}
@@ -3370,7 +3971,22 @@ export default function App() {
                 className="w-full bg-[#1e293b]/50 text-white py-5 pl-14 pr-32 rounded-2xl border-2 border-slate-800 focus:border-emerald-500/50 focus:bg-[#1e293b] outline-none transition-all duration-300 font-mono text-sm placeholder:text-slate-600 disabled:opacity-30 shadow-xl"
               />
               <div className="absolute right-3 top-1/2 -translate-y-1/2 flex items-center gap-2">
+                <label className="flex items-center gap-1 text-[10px] text-slate-500 font-bold uppercase mr-2 cursor-pointer" title="Run the command on every connected device">
+                  <input type="checkbox" checked={fleetMode} onChange={(e) => setFleetMode(e.target.checked)} disabled={!!shellSession} />
+                  All devices
+                </label>
                 <span className="text-[10px] text-slate-600 font-bold uppercase mr-2 hidden md:block">Press Enter</span>
+                {runningCommand && (
+                  <button
+                    type="button"
+                    onClick={() => cancelCommand(false)}
+                    onDoubleClick={() => cancelCommand(true)}
+                    title="Stop the running command (double-click to kill)"
+                    className="bg-red-600/80 hover:bg-red-500 text-white px-4 py-2.5 rounded-xl text-xs font-black uppercase tracking-widest transition-all duration-200 active:scale-95"
+                  >
+                    Stop
+                  </button>
+                )}
                 <button 
                     type="submit"
                     disabled={!selectedDevice || !commandInput}
@@ -3447,7 +4063,7 @@ export default function App() {
               ) : fileContent.type === 'image' ? (
                 <div className="text-center">
                   <img 
-                    src={`data:${fileContent.mime_type};base64,${fileContent.content}`}
+                    src={fileContent.content_url || `data:${fileContent.mime_type};base64,${fileContent.content}`}
                     alt="File preview"
                     className="max-w-full max-h-[400px] mx-auto rounded-lg border border-slate-700"
                   />
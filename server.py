@@ -1,7 +1,17 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+import asyncio
+import itertools
 import json
-from typing import Dict, List
+import math
+import os
+import sqlite3
+import struct
+import time
+import uuid
+from array import array
+from collections import Counter, defaultdict, deque
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
 
 app = FastAPI()
 
@@ -14,100 +24,1632 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+def merge_stats(snapshot: dict, delta: dict):
+    """Apply a stats delta (changed fields only, nested dicts recursively) in place."""
+    for key, value in delta.items():
+        if isinstance(value, dict) and isinstance(snapshot.get(key), dict):
+            merge_stats(snapshot[key], value)
+        else:
+            snapshot[key] = value
+
+# Must-deliver messages a dashboard may fall behind by before it is evicted
+DASHBOARD_QUEUE_SIZE = 512
+
+# Seconds a forwarded request may go without any agent activity before it is expired
+PENDING_REQUEST_TIMEOUT = 300.0
+PENDING_SWEEP_INTERVAL = 5.0
+
+# Dashboard -> agent flow-control messages for streaming transfers, live preview
+# streams and streamed commands, relayed without a response
+CONTROL_TYPES = ("transfer_ack", "transfer_cancel", "upload_commit", "upload_abort",
+                 "live_preview_keepalive", "live_preview_keyframe", "command_cancel")
+
+# Dashboard -> agent input for a PTY session, relayed only from the dashboard that owns it
+PTY_CONTROL_TYPES = ("pty_input", "pty_resize", "pty_detach")
+# Agent -> dashboard session output, routed to the session's owner
+PTY_MESSAGE_TYPES = ("pty_output", "pty_exit")
+
+# Options of a dashboard "command" passed on to the agent (output streaming and its limits)
+COMMAND_OPTIONS = ("stream", "command_id", "timeout", "max_output")
+
+# Seconds a dropped agent's pending requests and shell owners are held for it to
+# reconnect with the same session token
+AGENT_RESUME_WINDOW = 30.0
+
+# Seconds between keyframe requests for a stream a dashboard has lost track of
+STREAM_RESYNC_INTERVAL = 1.0
+
+# Fleet commands: hosts running at once unless the request asks otherwise, and the
+# per-host timeout; the server waits a little past it for the agent's own report
+FLEET_PARALLELISM = 50
+MAX_FLEET_PARALLELISM = 500
+FLEET_TIMEOUT = 60.0
+FLEET_TIMEOUT_GRACE = 5.0
+# Longer per-host timeouts are clamped so the run's own timeout (and command_cancel)
+# always fires before the pending-request sweeper would expire a silent host
+MAX_FLEET_TIMEOUT = PENDING_REQUEST_TIMEOUT - 2 * FLEET_TIMEOUT_GRACE
+# Output kept per host (and stream) in fleet results, and the most a host may produce
+FLEET_OUTPUT_LIMIT = 16 * 1024
+FLEET_MAX_OUTPUT = 1024 * 1024
+# Seconds between the batched fleet_progress messages of a run
+FLEET_REPORT_INTERVAL = 0.25
+
+# Stats history: the latest raw samples per device stay in memory; rollups at these
+# resolutions (seconds) are stored in SQLite and kept for the given number of days
+STATS_HISTORY_DB = os.environ.get(
+    "OMNI_STATS_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "stats_history.db"))
+STATS_RAW_POINTS = 1200
+STATS_ROLLUPS = {60: 7, 600: 30, 3600: 365}
+STATS_FLUSH_INTERVAL = 10.0
+STATS_PRUNE_INTERVAL = 3600.0
+# Rollup rows kept for a retry while the database can't be written; the oldest go first
+STATS_MAX_UNFLUSHED = 50000
+# Buckets returned by a history query unless it asks for another number
+STATS_HISTORY_POINTS = 300
+MAX_STATS_HISTORY_POINTS = 5000
+# Series recorded from each snapshot; byte counters are recorded as per-second rates
+STATS_GAUGES = ("cpu_percent", "ram_percent", "disk_percent", "process_count")
+STATS_COUNTERS = {"network_recv_rate": "network_recv", "network_sent_rate": "network_sent"}
+STATS_SERIES = STATS_GAUGES + tuple(STATS_COUNTERS)
+
+# Several server workers on one host (uvicorn --workers N) share agents and dashboards
+# over Unix sockets in this directory; unset, the server runs as a single process
+BUS_DIRECTORY = os.environ.get("OMNI_BUS_DIR")
+# Seconds between scans for workers that started (or reconnected) since
+BUS_DISCOVERY_INTERVAL = 5.0
+# Unsent bytes to one worker before it is disconnected as stuck
+BUS_MAX_BUFFER = 64 * 1024 * 1024
+BUS_CALL_TIMEOUT = 10.0
+# Worker ids are small slot numbers (they ride in the high bits of request ids, which
+# must stay exact as JSON numbers in the dashboard)
+MAX_BUS_WORKERS = 0xFFFF
+
+# Wildcard for subscriptions: any device / any message type
+ANY = "*"
+
+def message_topic(message: dict) -> str:
+    """Subscription topic of an agent message; stats deltas share the stats topic."""
+    msg_type = message.get("type", "unknown")
+    return "stats" if msg_type == "stats_delta" else msg_type
+
+def read_frame_header(frame: bytes) -> dict:
+    """Header of a binary frame (4-byte length, JSON header, payload); the payload is left alone."""
+    (header_length,) = struct.unpack_from("!I", frame)
+    return json.loads(frame[4:4 + header_length])
+
+def replace_frame_header(frame: bytes, header: dict) -> bytes:
+    """Re-emit a binary frame with a new header; the payload bytes are copied, never decoded."""
+    (header_length,) = struct.unpack_from("!I", frame)
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    return b"".join((struct.pack("!I", len(header_bytes)), header_bytes,
+                     memoryview(frame)[4 + header_length:]))
+
+def percentile(sorted_values: List[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return None
+    return sorted_values[max(1, math.ceil(q * len(sorted_values))) - 1]
+
+def _as_list(value) -> List[str]:
+    if value is None or value == ANY:
+        return [ANY]
+    if isinstance(value, str):
+        return [value]
+    return [str(v) for v in value]
+
+# --- Dashboard Connection ---
+class DashboardConnection:
+    """Outbound side of one dashboard socket.
+
+    Each dashboard has its own writer task so a slow browser tab only delays itself.
+    Responses go through a bounded must-deliver queue; periodic data such as stats
+    sits in a "latest wins" slot per key where a newer message replaces an unsent one.
+    """
+
+    def __init__(self, websocket: WebSocket, on_dead: Callable[[WebSocket], None]):
+        self.websocket = websocket
+        self.on_dead = on_dead
+        self.queue = deque()
+        self.latest: Dict[object, Union[dict, Callable[[], dict]]] = {}
+        self.wakeup = asyncio.Event()
+        self.dropped = 0
+        self.closed = False
+        # (device_id, topic) pairs this dashboard receives. Dashboards that never
+        # subscribe keep the legacy behaviour of receiving everything.
+        self.subscriptions: Set[Tuple[str, str]] = {(ANY, ANY)}
+        self.implicit_subscription = True
+        # Stream keys (topic, device_id, stream_id) whose tile deltas this dashboard can
+        # apply, i.e. it has been sent a keyframe and every frame since
+        self.synced_streams: Set[Tuple[str, str, str]] = set()
+        self.stream_resync_at: Dict[Tuple[str, str, str], float] = {}
+        self.task = asyncio.create_task(self._writer())
+
+    def send(self, message: Union[dict, bytes]) -> bool:
+        """Queue a must-deliver message (JSON or binary frame).
+
+        Returns False if the dashboard is too far behind.
+        """
+        if self.closed:
+            return False
+        if len(self.queue) >= DASHBOARD_QUEUE_SIZE:
+            print(f"Dashboard send queue full ({DASHBOARD_QUEUE_SIZE}), evicting slow consumer")
+            self._evict()
+            return False
+        self.queue.append(message)
+        self.wakeup.set()
+        return True
+
+    def send_latest(self, key, message: Union[dict, Callable[[], dict]]):
+        """Offer a droppable message; ``message`` may be a callable built at write time."""
+        if self.closed:
+            return
+        if key in self.latest:
+            self.dropped += 1
+        self.latest[key] = message
+        self.wakeup.set()
+
+    def has_pending(self, key) -> bool:
+        return key in self.latest
+
+    async def _writer(self):
+        try:
+            while True:
+                if not self.queue and not self.latest:
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                    continue
+
+                if self.queue:
+                    message = self.queue.popleft()
+                else:
+                    key = next(iter(self.latest))
+                    message = self.latest.pop(key)
+                    if callable(message):
+                        message = message()
+                        if message is None:
+                            continue
+
+                if isinstance(message, bytes):
+                    await self.websocket.send_bytes(message)
+                else:
+                    await self.websocket.send_json(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Dashboard write failed, evicting: {e}")
+            self._evict()
+
+    def _evict(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.clear()
+        self.latest.clear()
+        self.on_dead(self.websocket)
+        asyncio.create_task(self._close_socket())
+
+    async def _close_socket(self):
+        try:
+            # 1013: try again later
+            await self.websocket.close(code=1013)
+        except Exception:
+            pass
+
+    def close(self):
+        self.closed = True
+        self.task.cancel()
+
+# --- Pending Requests ---
+class PendingRequest:
+    """A request forwarded to an agent, remembered so its response goes back to its sender."""
+
+    def __init__(self, websocket: WebSocket, device_id: str, request_id, request_type: str,
+                 handler: Optional[Callable[[dict], None]] = None):
+        self.websocket = websocket
+        self.device_id = device_id
+        # The dashboard's own id; the agent sees a server-assigned one so ids never collide
+        self.request_id = request_id
+        self.request_type = request_type
+        # Requests made by the server itself (fleet runs) hand the agent's messages to
+        # this callback instead of forwarding them
+        self.handler = handler
+        self.created = time.monotonic()
+        self.last_activity = self.created
+
+# --- Fleet Execution ---
+class FleetRun:
+    """One shell command fanned out to many agents from a single dashboard request.
+
+    At most ``parallelism`` hosts run at a time. Each one is bounded by ``timeout``:
+    the agent stops the command itself, and the server gives up FLEET_TIMEOUT_GRACE
+    later. Host results are batched into fleet_progress messages with a running
+    summary. The final response summarizes the whole run: counts by status, an exit
+    code histogram and latency percentiles.
+    """
+
+    def __init__(self, manager: "ConnectionManager", websocket: WebSocket, request_id, command: str,
+                 devices: List[str], parallelism: int, timeout: float):
+        self.fleet_id = uuid.uuid4().hex[:12]
+        self.manager = manager
+        self.websocket = websocket
+        self.request_id = request_id
+        self.command = command
+        self.devices = devices
+        self.parallelism = parallelism
+        self.timeout = timeout
+        self.results: Dict[str, dict] = {}
+        self.unreported: List[dict] = []
+        self.host_tasks: List[asyncio.Task] = []
+        self.started = time.monotonic()
+        self.cancelled = False
+        self.task: Optional[asyncio.Task] = None
+
+    def cancel(self):
+        self.cancelled = True
+        for task in self.host_tasks:
+            task.cancel()
+
+    async def run(self):
+        await self.manager.send_to_dashboard(self.websocket, {
+            "type": "fleet_start",
+            "request_id": self.request_id,
+            "fleet_id": self.fleet_id,
+            "command": self.command,
+            "devices": self.devices,
+            "parallelism": self.parallelism,
+            "timeout": self.timeout
+        })
+        window = asyncio.Semaphore(self.parallelism)
+        self.host_tasks = [asyncio.create_task(self._run_host(device_id, window)) for device_id in self.devices]
+        reporter = asyncio.create_task(self._report_periodically())
+        try:
+            await asyncio.gather(*self.host_tasks, return_exceptions=True)
+        finally:
+            reporter.cancel()
+            for device_id in self.devices:
+                if device_id not in self.results:
+                    self._record(device_id, "cancelled", None)
+            self._report()
+            self.manager.fleet_runs.pop(self.fleet_id, None)
+
+        await self.manager.send_to_dashboard(self.websocket, {
+            "type": "response",
+            "device_id": None,
+            "request_id": self.request_id,
+            "request_type": "fleet_command",
+            "result": {
+                "fleet_id": self.fleet_id,
+                "cancelled": self.cancelled,
+                "elapsed_ms": round((time.monotonic() - self.started) * 1000, 1),
+                **self.summary()
+            }
+        })
+
+    async def _run_host(self, device_id: str, window: asyncio.Semaphore):
+        async with window:
+            started = time.monotonic()
+            if not self.manager.is_online(device_id):
+                self._record(device_id, "offline", None)
+                return
+
+            loop = asyncio.get_running_loop()
+            done = loop.create_future()
+            output = {"stdout": "", "stderr": ""}
+
+            def on_message(message: dict):
+                if message.get("type") == "response":
+                    if not done.done():
+                        done.set_result(message.get("result"))
+                elif message.get("type") == "output_chunk":
+                    for stream in output:
+                        if message.get(stream) and len(output[stream]) < FLEET_OUTPUT_LIMIT:
+                            output[stream] += message[stream]
+
+            server_req_id = self.manager.track_request(self.websocket, device_id, None, "execute", on_message)
+            command_id = f"fleet-{self.fleet_id}-{server_req_id}"
+            sent = await self.manager.send_command_with_id(device_id, self.command, server_req_id, {
+                "stream": True,
+                "command_id": command_id,
+                "timeout": self.timeout,
+                "max_output": FLEET_MAX_OUTPUT
+            })
+            if not sent:
+                self.manager.untrack_request(device_id, server_req_id)
+                self._record(device_id, "error", started, error="Failed to send command")
+                return
+
+            try:
+                result = await asyncio.wait_for(done, self.timeout + FLEET_TIMEOUT_GRACE)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                self.manager.untrack_request(device_id, server_req_id)
+                await self.manager.send_direct_request(
+                    device_id, {"type": "command_cancel", "command_id": command_id, "force": True}, quiet=True)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                self._record(device_id, "timeout", started)
+                return
+
+            result = result if isinstance(result, dict) else {"error": "Malformed result"}
+            if result.get("error"):
+                status = "error"
+            elif result.get("stop_reason") == "timeout":
+                status = "timeout"
+            else:
+                status = "ok" if result.get("exit_code") == 0 else "failed"
+            # Agents answer "cd" (and predate streaming) with the whole output in the result
+            if result.get("output") and not output["stdout"]:
+                output["stdout"] = result["output"]
+            self._record(device_id, status, started, exit_code=result.get("exit_code"),
+                         error=result.get("error"), **output)
+
+    def _record(self, device_id: str, status: str, started: Optional[float], **details):
+        truncated = any(len(details.get(stream) or "") > FLEET_OUTPUT_LIMIT for stream in ("stdout", "stderr"))
+        for stream in ("stdout", "stderr"):
+            if details.get(stream):
+                details[stream] = details[stream][:FLEET_OUTPUT_LIMIT]
+        result = {
+            "device_id": device_id,
+            "status": status,
+            "latency_ms": round((time.monotonic() - started) * 1000, 1) if started is not None else None,
+            "truncated": truncated,
+            **{key: value for key, value in details.items() if value is not None}
+        }
+        self.results[device_id] = result
+        self.unreported.append(result)
+
+    def summary(self) -> dict:
+        statuses = Counter(result["status"] for result in self.results.values())
+        exit_codes = Counter(str(result["exit_code"]) for result in self.results.values()
+                             if result.get("exit_code") is not None)
+        # Latency of the hosts that actually ran the command
+        latencies = sorted(result["latency_ms"] for result in self.results.values()
+                           if result["status"] in ("ok", "failed"))
+        return {
+            "total": len(self.devices),
+            "completed": len(self.results),
+            "by_status": dict(statuses),
+            "exit_codes": dict(exit_codes),
+            "latency_ms": {
+                "p50": percentile(latencies, 0.50),
+                "p90": percentile(latencies, 0.90),
+                "p99": percentile(latencies, 0.99),
+                "max": latencies[-1] if latencies else None
+            }
+        }
+
+    def _report(self):
+        if not self.unreported:
+            return
+        results, self.unreported = self.unreported, []
+        connection = self.manager.active_dashboards.get(self.websocket)
+        if connection:
+            connection.send({
+                "type": "fleet_progress",
+                "request_id": self.request_id,
+                "fleet_id": self.fleet_id,
+                "results": results,
+                "summary": self.summary()
+            })
+
+    async def _report_periodically(self):
+        while True:
+            await asyncio.sleep(FLEET_REPORT_INTERVAL)
+            self._report()
+
+# --- Stats History ---
+class _RawRing:
+    """Fixed-size ring of recent samples in flat float arrays (NaN where a value is missing)."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.times = array("d", [0.0]) * capacity
+        self.values = {name: array("d", [math.nan]) * capacity for name in STATS_SERIES}
+        self.next = 0
+        self.count = 0
+
+    def append(self, timestamp: float, sample: dict):
+        i = self.next
+        self.times[i] = timestamp
+        for name, values in self.values.items():
+            values[i] = sample.get(name, math.nan)
+        self.next = (i + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def insert(self, points: List[Tuple[float, dict]]):
+        """Add samples from any time, keeping the newest ``capacity`` in time order."""
+        merged = sorted(list(self.points(-math.inf, math.inf, STATS_SERIES)) +
+                        [(timestamp, {name: [1, value] for name, value in sample.items()})
+                         for timestamp, sample in points], key=lambda point: point[0])
+        self.next = self.count = 0
+        for timestamp, aggregates in merged[-self.capacity:]:
+            self.append(timestamp, {name: aggregate[1] for name, aggregate in aggregates.items()})
+
+    def oldest(self) -> Optional[float]:
+        return self.times[(self.next - self.count) % self.capacity] if self.count else None
+
+    def points(self, start: float, end: float, series: List[str]):
+        """(timestamp, {series: [count, sum, min, max]}) for the samples in [start, end]."""
+        first = self.next - self.count
+        for k in range(self.count):
+            i = (first + k) % self.capacity
+            timestamp = self.times[i]
+            if start <= timestamp <= end:
+                yield timestamp, {name: [1, value, value, value] for name in series
+                                  for value in (self.values[name][i],) if not math.isnan(value)}
+
+def _add_sample(aggregates: dict, sample: dict):
+    for name, value in sample.items():
+        aggregate = aggregates.get(name)
+        if aggregate is None:
+            aggregates[name] = [1, value, value, value]
+        else:
+            aggregate[0] += 1
+            aggregate[1] += value
+            aggregate[2] = min(aggregate[2], value)
+            aggregate[3] = max(aggregate[3], value)
+
+def _merge_aggregates(aggregates: dict, other: dict):
+    for name, (count, total, low, high) in other.items():
+        aggregate = aggregates.get(name)
+        if aggregate is None:
+            aggregates[name] = [count, total, low, high]
+        else:
+            aggregate[0] += count
+            aggregate[1] += total
+            aggregate[2] = min(aggregate[2], low)
+            aggregate[3] = max(aggregate[3], high)
+
+class _DeviceHistory:
+    def __init__(self):
+        self.raw = _RawRing(STATS_RAW_POINTS)
+        # (timestamp, {rate series: counter value}) of the previous snapshot, live and backfilled
+        self.counters: Optional[Tuple[float, dict]] = None
+        self.backfill_counters: Optional[Tuple[float, dict]] = None
+        # resolution -> (bucket start, {series: [count, sum, min, max]}) still being filled
+        self.open: Dict[int, Tuple[int, dict]] = {}
+
+class StatsHistory:
+    """Per-device stats history: recent samples in memory, rollups on disk.
+
+    Every snapshot goes into the device's raw ring and into its open bucket at each
+    rollup resolution. A bucket is closed by the first sample past its end and
+    written to SQLite by a background task. Buckets hold count, sum, min and max
+    per series and are merged into any row already stored for them, so samples
+    that arrive late (agent backfill, a partial bucket saved at shutdown) add up.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.devices: Dict[str, _DeviceHistory] = {}
+        # Buckets not yet on disk: (device, resolution, bucket, json)
+        self.unflushed: List[Tuple[str, int, int, str]] = []
+        self.db: Optional[sqlite3.Connection] = None
+        # Held across each disk write and each query, so a query never sees a
+        # bucket both on disk and in memory
+        self.io_lock = asyncio.Lock()
+        self.flush_task: Optional[asyncio.Task] = None
+        self.pruned_at = 0.0
+
+    def _history(self, device_id: str) -> _DeviceHistory:
+        history = self.devices.get(device_id)
+        if history is None:
+            history = self.devices[device_id] = _DeviceHistory()
+        return history
+
+    @staticmethod
+    def _sample(snapshot: dict, now: float, last_counters: Optional[Tuple[float, dict]]):
+        """Recorded series of a snapshot, with rates from the previous snapshot's counters."""
+        sample = {name: float(snapshot[name]) for name in STATS_GAUGES
+                  if isinstance(snapshot.get(name), (int, float))}
+        counters = {name: snapshot.get(field) for name, field in STATS_COUNTERS.items()}
+        if last_counters:
+            last_time, last = last_counters
+            for name, value in counters.items():
+                previous = last.get(name)
+                # A counter that went backwards was reset (agent or host restart)
+                if now > last_time and isinstance(value, (int, float)) \
+                        and isinstance(previous, (int, float)) and value >= previous:
+                    sample[name] = (value - previous) / (now - last_time)
+        return sample, (now, counters)
+
+    def record(self, device_id: str, snapshot: dict, timestamp: Optional[float] = None):
+        """Add a device's full stats snapshot at ``timestamp`` (default: now)."""
+        now = time.time() if timestamp is None else timestamp
+        history = self._history(device_id)
+        sample, history.counters = self._sample(snapshot, now, history.counters)
+
+        history.raw.append(now, sample)
+        for resolution in STATS_ROLLUPS:
+            bucket = int(now // resolution) * resolution
+            current = history.open.get(resolution)
+            if current is None or current[0] != bucket:
+                if current is not None:
+                    self.unflushed.append((device_id, resolution, current[0], json.dumps(current[1])))
+                current = history.open[resolution] = (bucket, {})
+            _add_sample(current[1], sample)
+        self._schedule_flush()
+
+    def backfill(self, device_id: str, fields: List[str], samples: List[list]):
+        """Add samples an agent buffered while it was offline, oldest first, each a
+        list of values in ``fields`` order (one of them "timestamp")."""
+        history = self._history(device_id)
+        points, rollups = [], defaultdict(dict)
+        for values in samples:
+            snapshot = dict(zip(fields, values))
+            timestamp = snapshot.get("timestamp")
+            if not isinstance(timestamp, (int, float)):
+                continue
+            if history.backfill_counters and history.backfill_counters[0] >= timestamp:
+                history.backfill_counters = None  # a new run of buffered samples
+            sample, history.backfill_counters = self._sample(snapshot, timestamp, history.backfill_counters)
+            points.append((timestamp, sample))
+            for resolution in STATS_ROLLUPS:
+                _add_sample(rollups[(resolution, int(timestamp // resolution) * resolution)], sample)
+        if not points:
+            return
+
+        history.raw.insert(points)
+        for (resolution, bucket), aggregates in rollups.items():
+            current = history.open.get(resolution)
+            if current is not None and current[0] == bucket:
+                _merge_aggregates(current[1], aggregates)
+            else:
+                self.unflushed.append((device_id, resolution, bucket, json.dumps(aggregates)))
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self._flush_periodically())
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.db is None:
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS rollups (
+                device_id TEXT NOT NULL,
+                resolution INTEGER NOT NULL,
+                bucket INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (device_id, resolution, bucket)
+            ) WITHOUT ROWID""")
+            self.db = db
+        return self.db
+
+    def _write(self, rows: list, prune: bool):
+        db = self._connect()
+        with db:
+            for device_id, resolution, bucket, data in rows:
+                stored = db.execute("SELECT data FROM rollups WHERE device_id = ? AND resolution = ? AND bucket = ?",
+                                    (device_id, resolution, bucket)).fetchone()
+                if stored:
+                    aggregates = json.loads(stored[0])
+                    _merge_aggregates(aggregates, json.loads(data))
+                    data = json.dumps(aggregates)
+                db.execute("INSERT OR REPLACE INTO rollups VALUES (?, ?, ?, ?)", (device_id, resolution, bucket, data))
+            if prune:
+                now = time.time()
+                for resolution, days in STATS_ROLLUPS.items():
+                    db.execute("DELETE FROM rollups WHERE resolution = ? AND bucket < ?",
+                               (resolution, now - days * 86400))
+
+    def _read(self, device_id: str, resolution: int, start: int, end: float) -> List[Tuple[int, str]]:
+        return self._connect().execute(
+            "SELECT bucket, data FROM rollups WHERE device_id = ? AND resolution = ?"
+            " AND bucket BETWEEN ? AND ? ORDER BY bucket",
+            (device_id, resolution, start, end)).fetchall()
+
+    async def flush(self, include_open: bool = False):
+        """Write closed buckets to disk; ``include_open`` also writes the partial ones (shutdown)."""
+        if include_open:
+            for device_id, history in self.devices.items():
+                for resolution, (bucket, aggregates) in history.open.items():
+                    self.unflushed.append((device_id, resolution, bucket, json.dumps(aggregates)))
+                history.open.clear()
+        async with self.io_lock:
+            prune = time.time() - self.pruned_at >= STATS_PRUNE_INTERVAL
+            if not self.unflushed and not prune:
+                return
+            rows, self.unflushed = self.unflushed, []
+            try:
+                await asyncio.to_thread(self._write, rows, prune)
+                if prune:
+                    self.pruned_at = time.time()
+            except sqlite3.Error as e:
+                # The write is one transaction, so the whole batch goes back for the next flush
+                self.unflushed[:0] = rows
+                dropped = len(self.unflushed) - STATS_MAX_UNFLUSHED
+                if dropped > 0:
+                    del self.unflushed[:dropped]
+                print(f"Stats history write failed ({len(self.unflushed)} rows kept for retry"
+                      f"{f', {dropped} dropped' if dropped > 0 else ''}): {e}")
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(STATS_FLUSH_INTERVAL)
+            await self.flush()
+
+    async def query(self, device_id: str, start: float, end: float, points: int = STATS_HISTORY_POINTS,
+                    series: Optional[List[str]] = None) -> dict:
+        """One device's series over [start, end] in buckets of at least (end - start) / points seconds.
+
+        Raw samples answer when they reach back to ``start`` and the buckets would be
+        finer than the smallest rollup; otherwise the coarsest rollup no wider than a
+        bucket is used (moving up while a tier's retention does not reach ``start``).
+        """
+        series = [name for name in series or STATS_SERIES if name in STATS_SERIES]
+        points = max(1, min(int(points), MAX_STATS_HISTORY_POINTS))
+        if end <= start:
+            raise ValueError("end must be after start")
+        step = (end - start) / points
+        history = self.devices.get(device_id)
+
+        tiers = sorted(STATS_ROLLUPS)
+        resolution = max((tier for tier in tiers if tier <= step), default=0)
+        if resolution == 0:
+            oldest = history.raw.oldest() if history else None
+            if oldest is None or oldest > start:
+                resolution = tiers[0]
+        while resolution and resolution != tiers[-1] \
+                and start < time.time() - STATS_ROLLUPS[resolution] * 86400:
+            resolution = tiers[tiers.index(resolution) + 1]
+        width = math.ceil(step / resolution) * resolution if resolution else step
+
+        if resolution == 0:
+            entries = list(history.raw.points(start, end, series))
+        else:
+            first = int(start // resolution) * resolution
+            rollups = defaultdict(dict)
+            async with self.io_lock:
+                try:
+                    for bucket, data in await asyncio.to_thread(self._read, device_id, resolution, first, end):
+                        _merge_aggregates(rollups[bucket], json.loads(data))
+                except sqlite3.Error as e:
+                    print(f"Stats history read failed: {e}")
+                # Buckets not yet on disk, including the one still open
+                for queued_device, queued_resolution, bucket, data in self.unflushed:
+                    if queued_device == device_id and queued_resolution == resolution and first <= bucket <= end:
+                        _merge_aggregates(rollups[bucket], json.loads(data))
+                if history and resolution in history.open:
+                    bucket, aggregates = history.open[resolution]
+                    if first <= bucket <= end:
+                        _merge_aggregates(rollups[bucket], aggregates)
+            entries = sorted(rollups.items())
+
+        buckets: Dict[float, dict] = {}
+        for timestamp, aggregates in entries:
+            key = math.floor(timestamp / width) * width
+            _merge_aggregates(buckets.setdefault(key, {}), {name: aggregates[name] for name in series
+                                                            if name in aggregates})
+        timestamps = sorted(buckets)
+        result = {name: {"avg": [], "min": [], "max": []} for name in series}
+        for key in timestamps:
+            for name in series:
+                aggregate = buckets[key].get(name)
+                values = result[name]
+                values["avg"].append(round(aggregate[1] / aggregate[0], 3) if aggregate else None)
+                values["min"].append(aggregate[2] if aggregate else None)
+                values["max"].append(aggregate[3] if aggregate else None)
+        return {
+            "device_id": device_id,
+            "start": start,
+            "end": end,
+            "resolution": width,
+            "source": "raw" if resolution == 0 else f"{resolution}s",
+            "timestamps": timestamps,
+            "series": result
+        }
+
+# --- Worker Bus ---
+class LocalBus:
+    """Bus of a single server process: every agent and dashboard is in this worker,
+    so there is nothing to forward. UnixSocketBus connects several workers."""
+
+    worker_id = 0
+
+    def __init__(self):
+        self.methods: Dict[str, Callable[[dict], Awaitable[dict]]] = {}
+
+    def register(self, method: str, handler: Callable[[dict], Awaitable[dict]]):
+        """Make ``handler`` callable by other workers as ``method``."""
+        self.methods[method] = handler
+
+    async def start(self, manager: "ConnectionManager"):
+        pass
+
+    async def close(self):
+        pass
+
+    def owner(self, device_id: str) -> Optional[int]:
+        """Worker holding an agent that is connected elsewhere, if any."""
+        return None
+
+    def remote_agents(self) -> Dict[str, dict]:
+        return {}
+
+    def send(self, worker_id: int, header: dict, payload: bytes = b"") -> bool:
+        return False
+
+    def broadcast(self, header: dict, payload: bytes = b"", dashboards_only: bool = False):
+        pass
+
+    def dashboards_changed(self, count: int):
+        pass
+
+    async def call(self, worker_id: int, method: str, args: dict) -> dict:
+        raise ConnectionError(f"No worker {worker_id}")
+
+class UnixSocketBus(LocalBus):
+    """Bus between the server workers of one host, over Unix sockets in ``directory``.
+
+    Each worker listens on worker-<id>.sock there, where the id is the lowest slot whose
+    worker-<id>.lock it could lock (or ``worker_id``, when given). Of each pair of
+    workers the higher-numbered one dials, and the connection carries both directions.
+    Workers announce the agents they hold, forward traffic for agents held elsewhere
+    and relay what those agents send back. A message is a 4-byte length followed by a
+    frame laid out like agent frames (header length, JSON header, payload), so agent
+    and dashboard frames ride along as payload without being decoded.
+    """
+
+    def __init__(self, directory: str, worker_id: Optional[int] = None):
+        super().__init__()
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock_fd: Optional[int] = None
+        if worker_id is not None and not 1 <= worker_id <= MAX_BUS_WORKERS:
+            raise ValueError(f"worker_id must be between 1 and {MAX_BUS_WORKERS}")
+        self.worker_id = self._claim_slot(worker_id)
+        self.path = self._socket_path(self.worker_id)
+        self.manager: Optional["ConnectionManager"] = None
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.peers: Dict[int, asyncio.StreamWriter] = {}
+        # Workers that have dashboards; the others are spared stats and published messages
+        self.peers_with_dashboards: Set[int] = set()
+        self.has_dashboards = False
+        # device_id -> (worker, registration details) for agents held by other workers
+        self.agents: Dict[str, Tuple[int, dict]] = {}
+        self.calls: Dict[int, asyncio.Future] = {}
+        self.call_ids = itertools.count(1)
+        self.tasks: Set[asyncio.Task] = set()
+
+    def _socket_path(self, worker_id: int) -> str:
+        return os.path.join(self.directory, f"worker-{worker_id}.sock")
+
+    def _lock_slot(self, worker_id: int) -> Optional[int]:
+        """Lock worker-<id>.lock; the lock goes away with the process holding it."""
+        import fcntl  # Unix sockets mean a Unix host
+        fd = os.open(os.path.join(self.directory, f"worker-{worker_id}.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return None
+        return fd
+
+    def _claim_slot(self, wanted: Optional[int]) -> int:
+        """Lock the ``wanted`` slot, or the lowest free one."""
+        for worker_id in [wanted] if wanted else range(1, MAX_BUS_WORKERS + 1):
+            fd = self._lock_slot(worker_id)
+            if fd is not None:
+                self.lock_fd = fd
+                # Whatever socket is there was left by a worker that is gone
+                try:
+                    os.unlink(self._socket_path(worker_id))
+                except OSError:
+                    pass
+                return worker_id
+        raise RuntimeError(f"Worker slot {wanted} is in use" if wanted else
+                           f"No free worker slot in {self.directory}")
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def start(self, manager: "ConnectionManager"):
+        self.manager = manager
+        self.server = await asyncio.start_unix_server(self._accept, self.path)
+        await self._discover()
+        self._spawn(self._discover_periodically())
+        print(f"Worker bus listening on {self.path}")
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+        for task in list(self.tasks):
+            task.cancel()
+        for writer in self.peers.values():
+            writer.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        if self.lock_fd is not None:
+            os.close(self.lock_fd)
+            self.lock_fd = None
+
+    async def _discover(self):
+        """Connect to the lower-numbered workers in the directory not connected yet
+        (higher-numbered ones connect to this worker)."""
+        for name in os.listdir(self.directory):
+            worker = name[len("worker-"):-len(".sock")]
+            if not (name.startswith("worker-") and name.endswith(".sock") and worker.isdigit()):
+                continue
+            worker_id = int(worker)
+            if worker_id >= self.worker_id or worker_id in self.peers:
+                continue
+            try:
+                reader, writer = await asyncio.open_unix_connection(self._socket_path(worker_id))
+            except OSError:
+                # Left behind by a worker that is gone, unless its slot is held (the
+                # worker may be about to listen)
+                fd = self._lock_slot(worker_id)
+                if fd is not None:
+                    try:
+                        os.unlink(self._socket_path(worker_id))
+                    except OSError:
+                        pass
+                    os.close(fd)
+                continue
+            self._add_peer(worker_id, writer)
+            self._spawn(self._read(worker_id, reader, writer))
+
+    async def _discover_periodically(self):
+        while True:
+            await asyncio.sleep(BUS_DISCOVERY_INTERVAL)
+            await self._discover()
+
+    def _hello(self) -> dict:
+        return {"op": "hello", "worker": self.worker_id, "dashboards": self.has_dashboards,
+                "agents": {device_id: self.manager.agent_info.get(device_id, {})
+                           for device_id in self.manager.active_agents}}
+
+    def _add_peer(self, worker_id: int, writer: asyncio.StreamWriter):
+        previous = self.peers.get(worker_id)
+        if previous is not None:
+            # The worker in that slot restarted: its old connection and agents are gone
+            previous.close()
+            self._forget_agents(worker_id)
+        self.peers[worker_id] = writer
+        self._write(worker_id, writer, self._hello())
+
+    def _forget_agents(self, worker_id: int) -> List[str]:
+        lost = [device_id for device_id, (owner, _) in self.agents.items() if owner == worker_id]
+        for device_id in lost:
+            del self.agents[device_id]
+            if not self.manager.is_online(device_id):
+                self.manager.expire_agent(device_id, relay=False)
+        return lost
+
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            header, _ = await self._receive(reader)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            writer.close()
+            return
+        worker_id = header.get("worker")
+        if not isinstance(worker_id, int) or worker_id == self.worker_id:
+            writer.close()
+            return
+        self._add_peer(worker_id, writer)
+        await self._handle(worker_id, header, b"")
+        await self._read(worker_id, reader, writer)
+
+    @staticmethod
+    async def _receive(reader: asyncio.StreamReader) -> Tuple[dict, bytes]:
+        (length,) = struct.unpack("!I", await reader.readexactly(4))
+        body = await reader.readexactly(length)
+        (header_length,) = struct.unpack_from("!I", body)
+        return json.loads(body[4:4 + header_length]), body[4 + header_length:]
+
+    async def _read(self, worker_id: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                header, payload = await self._receive(reader)
+                try:
+                    await self._handle(worker_id, header, payload)
+                except Exception as e:
+                    print(f"Worker bus: {header.get('op')} from {worker_id} failed: {e}")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            await self._drop_peer(worker_id, writer)
+
+    async def _drop_peer(self, worker_id: int, writer: asyncio.StreamWriter):
+        writer.close()
+        if self.peers.get(worker_id) is not writer:
+            return
+        del self.peers[worker_id]
+        self.peers_with_dashboards.discard(worker_id)
+        print(f"Worker bus: lost worker {worker_id}")
+        # Its agents' connections went with it
+        if self._forget_agents(worker_id):
+            await self.manager.broadcast_agent_list()
+
+    def _write(self, worker_id: int, writer: asyncio.StreamWriter, header: dict, payload: bytes = b"") -> bool:
+        if writer.is_closing():
+            return False
+        if writer.transport.get_write_buffer_size() > BUS_MAX_BUFFER:
+            # Rather than buffer without bound; discovery connects again later
+            print(f"Worker bus: worker {worker_id} is not keeping up, disconnecting")
+            writer.close()
+            return False
+        header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+        writer.write(struct.pack("!II", 4 + len(header_bytes) + len(payload), len(header_bytes)))
+        writer.write(header_bytes)
+        if payload:
+            writer.write(payload)
+        return True
+
+    def owner(self, device_id: str) -> Optional[int]:
+        entry = self.agents.get(device_id)
+        return entry[0] if entry else None
+
+    def remote_agents(self) -> Dict[str, dict]:
+        return {device_id: info for device_id, (_, info) in self.agents.items()}
+
+    def send(self, worker_id: int, header: dict, payload: bytes = b"") -> bool:
+        writer = self.peers.get(worker_id)
+        return writer is not None and self._write(worker_id, writer, header, payload)
+
+    def broadcast(self, header: dict, payload: bytes = b"", dashboards_only: bool = False):
+        for worker_id, writer in list(self.peers.items()):
+            if not dashboards_only or worker_id in self.peers_with_dashboards:
+                self._write(worker_id, writer, header, payload)
+
+    def dashboards_changed(self, count: int):
+        if (count > 0) != self.has_dashboards:
+            self.has_dashboards = count > 0
+            self.broadcast({"op": "dashboards", "present": self.has_dashboards})
+
+    async def call(self, worker_id: int, method: str, args: dict) -> dict:
+        call_id = next(self.call_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.calls[call_id] = future
+        try:
+            if not self.send(worker_id, {"op": "call", "call_id": call_id, "method": method, "args": args}):
+                raise ConnectionError(f"No worker {worker_id}")
+            return await asyncio.wait_for(future, BUS_CALL_TIMEOUT)
+        finally:
+            self.calls.pop(call_id, None)
+
+    async def _answer(self, worker_id: int, header: dict):
+        handler = self.methods.get(header.get("method"))
+        try:
+            result = await handler(header.get("args") or {}) if handler else \
+                {"error": f"Unknown method: {header.get('method')}"}
+        except Exception as e:
+            result = {"error": str(e)}
+        self.send(worker_id, {"op": "reply", "call_id": header.get("call_id"), "result": result})
+
+    async def _handle(self, worker_id: int, header: dict, payload: bytes):
+        op = header.get("op")
+        manager = self.manager
+        device_id = header.get("device_id")
+        if op == "hello":
+            if header.get("dashboards"):
+                self.peers_with_dashboards.add(worker_id)
+            for remote_id, info in (header.get("agents") or {}).items():
+                self.agents[remote_id] = (worker_id, info)
+            await manager.broadcast_agent_list()
+        elif op == "dashboards":
+            if header.get("present"):
+                self.peers_with_dashboards.add(worker_id)
+            else:
+                self.peers_with_dashboards.discard(worker_id)
+        elif op == "agent_up":
+            self.agents[device_id] = (worker_id, header.get("info") or {})
+            await manager.broadcast_agent_list()
+        elif op == "agent_down":
+            if self.owner(device_id) == worker_id:
+                del self.agents[device_id]
+                await manager.broadcast_agent_list()
+            if header.get("expired") and not manager.is_online(device_id):
+                manager.expire_agent(device_id, relay=False)
+        elif op == "to_agent":
+            await manager.send_to_agent(device_id, payload or header.get("message"), relay=False)
+        elif op == "agent_message":
+            await manager.route_agent_message(device_id, header.get("message"), relay=False)
+        elif op == "agent_frame":
+            await manager.route_agent_frame(device_id, read_frame_header(payload), payload, relay=False)
+        elif op == "session_message":
+            await manager.route_session_message(device_id, header.get("message"), relay=False)
+        elif op == "publish":
+            await manager.publish(device_id, header.get("message"), relay=False)
+        elif op == "publish_frame":
+            await manager.publish_frame(device_id, read_frame_header(payload), payload, relay=False)
+        elif op == "stats":
+            await manager.receive_stats(device_id, header.get("message"))
+        elif op == "call":
+            self._spawn(self._answer(worker_id, header))
+        elif op == "reply":
+            future = self.calls.get(header.get("call_id"))
+            if future and not future.done():
+                future.set_result(header.get("result"))
+
 # --- Connection Manager ---
 class ConnectionManager:
-    def __init__(self):
+    def __init__(self, bus: Optional[LocalBus] = None):
+        # Other workers' agents and dashboards, reached through the bus
+        self.bus = bus or LocalBus()
         # Active connections: device_id -> WebSocket
         self.active_agents: Dict[str, WebSocket] = {}
-        # Dashboard connections (React apps)
-        self.active_dashboards: List[WebSocket] = []
+        # Dashboard connections (React apps), each with its own outbound queue
+        self.active_dashboards: Dict[WebSocket, DashboardConnection] = {}
+        # Subscription index: (device_id | ANY, topic | ANY) -> dashboards
+        self.subscriptions: Dict[Tuple[str, str], Set[WebSocket]] = defaultdict(set)
+        # (device_id, server request id) -> originating dashboard
+        self.pending_requests: Dict[Tuple[str, int], PendingRequest] = {}
+        # Request ids carry the issuing worker in their high bits, so the worker holding
+        # the agent knows where to send the responses
+        self.request_ids = itertools.count((self.bus.worker_id << 32) + 1)
+        self.request_metrics = {"forwarded": 0, "completed": 0, "expired": 0, "failed": 0, "orphaned": 0}
+        self.sweeper_task: Optional[asyncio.Task] = None
+        # Latest full stats snapshot per device, rebuilt from keyframes and deltas
+        self.device_stats: Dict[str, dict] = {}
+        self.device_stats_seq: Dict[str, int] = {}
+        self.stats_resync_pending: Set[str] = set()
+        self.stats_history = StatsHistory(STATS_HISTORY_DB)
+        # (device_id, session_id) -> dashboard a PTY session was last opened or attached from
+        self.pty_owners: Dict[Tuple[str, str], WebSocket] = {}
+        # Registration details per agent (platform, tags) for fleet selectors
+        self.agent_info: Dict[str, dict] = {}
+        self.fleet_runs: Dict[str, FleetRun] = {}
+        # Session token per agent, and expiry timers of dropped agents that may still resume
+        self.agent_sessions: Dict[str, str] = {}
+        self.resume_timers: Dict[str, asyncio.TimerHandle] = {}
 
-    async def connect_agent(self, websocket: WebSocket, device_id: str):
+    async def connect_agent(self, websocket: WebSocket, device_id: str, info: Optional[dict] = None) -> bool:
+        """Register an agent; returns True when it resumed the session it had before a drop."""
         # Accept is done in endpoint, not here
+        session_id = (info or {}).get("session_id")
+        timer = self.resume_timers.pop(device_id, None)
+        if timer:
+            timer.cancel()
+        resumed = session_id is not None and self.agent_sessions.get(device_id) == session_id \
+            and (timer is not None or device_id in self.active_agents)
+        if not resumed and (timer is not None or device_id in self.active_agents):
+            # A restarted agent (new token): what the old one left behind is gone
+            self.expire_agent(device_id)
+
         self.active_agents[device_id] = websocket
-        print(f"Agent connected: {device_id}")
+        if session_id:
+            self.agent_sessions[device_id] = session_id
+        self.agent_info[device_id] = {
+            "platform": (info or {}).get("platform"),
+            "tags": [str(tag) for tag in (info or {}).get("tags") or []]
+        }
+        print(f"Agent {'resumed' if resumed else 'connected'}: {device_id}")
+        self.bus.broadcast({"op": "agent_up", "device_id": device_id, "info": self.agent_info[device_id]})
         await self.broadcast_agent_list()
+        return resumed
 
     async def connect_dashboard(self, websocket: WebSocket):
         await websocket.accept()  # Dashboards can accept here
-        self.active_dashboards.append(websocket)
+        connection = DashboardConnection(websocket, self.disconnect_dashboard)
+        self.active_dashboards[websocket] = connection
+        self.bus.dashboards_changed(len(self.active_dashboards))
+        for key in connection.subscriptions:
+            self.subscriptions[key].add(websocket)
         print("Dashboard connected")
+        await self.send_stats_snapshots(websocket)
 
-    def disconnect_agent(self, device_id: str):
+    def disconnect_agent(self, device_id: str, websocket: Optional[WebSocket] = None):
+        """Forget an agent's connection. One with a session token keeps its pending
+        requests and shells for AGENT_RESUME_WINDOW seconds in case it comes back."""
+        if websocket is not None and self.active_agents.get(device_id) is not websocket:
+            return  # Already replaced by the agent's newer connection
         if device_id in self.active_agents:
             del self.active_agents[device_id]
             print(f"Agent disconnected: {device_id}")
+            self.bus.broadcast({"op": "agent_down", "device_id": device_id})
+        if device_id in self.agent_sessions:
+            self.resume_timers[device_id] = asyncio.get_running_loop().call_later(
+                AGENT_RESUME_WINDOW, self.expire_agent, device_id)
+        else:
+            self.expire_agent(device_id)
+
+    def expire_agent(self, device_id: str, relay: bool = True):
+        """Drop everything held for an agent that is gone for good (on every worker,
+        unless ``relay`` is False)."""
+        if relay:
+            self.bus.broadcast({"op": "agent_down", "device_id": device_id, "expired": True})
+        self.resume_timers.pop(device_id, None)
+        self.agent_sessions.pop(device_id, None)
+        self.agent_info.pop(device_id, None)
+        self.fail_pending_requests(device_id, f"Agent {device_id} disconnected")
+        self.device_stats.pop(device_id, None)
+        self.device_stats_seq.pop(device_id, None)
+        self.stats_resync_pending.discard(device_id)
+        # The agent's shells end with its session
+        for key, owner in list(self.pty_owners.items()):
+            if key[0] == device_id:
+                del self.pty_owners[key]
+                connection = self.active_dashboards.get(owner)
+                if connection:
+                    connection.send({"type": "pty_exit", "device_id": device_id, "session_id": key[1],
+                                     "exit_code": None, "reason": "agent disconnected"})
 
     def disconnect_dashboard(self, websocket: WebSocket):
-        if websocket in self.active_dashboards:
-            self.active_dashboards.remove(websocket)
+        connection = self.active_dashboards.pop(websocket, None)
+        if connection:
+            self._remove_subscriptions(websocket, connection.subscriptions)
+            connection.close()
+            print("Dashboard removed")
+            self.bus.dashboards_changed(len(self.active_dashboards))
+        # Nobody is left to receive these responses
+        for key, pending in list(self.pending_requests.items()):
+            if pending.websocket is websocket:
+                del self.pending_requests[key]
+        for run in list(self.fleet_runs.values()):
+            if run.websocket is websocket:
+                run.cancel()
+        # Its shells keep running on the agent, detached, until re-attached or reaped
+        for key, owner in list(self.pty_owners.items()):
+            if owner is websocket:
+                del self.pty_owners[key]
+                device_id, session_id = key
+                if self.is_online(device_id):
+                    asyncio.create_task(self.send_direct_request(
+                        device_id, {"type": "pty_detach", "session_id": session_id}, quiet=True))
+
+    # --- Pending requests ---
+
+    def track_request(self, websocket: WebSocket, device_id: str, request_id, request_type: str,
+                      handler: Optional[Callable[[dict], None]] = None) -> int:
+        """Record who sent a request and return the id to forward to the agent instead."""
+        server_request_id = next(self.request_ids)
+        self.pending_requests[(device_id, server_request_id)] = PendingRequest(
+            websocket, device_id, request_id, request_type, handler)
+        self.request_metrics["forwarded"] += 1
+        if self.sweeper_task is None or self.sweeper_task.done():
+            self.sweeper_task = asyncio.create_task(self._sweep_pending_requests())
+        return server_request_id
+
+    def untrack_request(self, device_id: str, server_request_id: int):
+        self.pending_requests.pop((device_id, server_request_id), None)
+
+    def _request_worker(self, request_id) -> Optional[int]:
+        """Worker that issued a server request id, when it is another one."""
+        if not isinstance(request_id, int):
+            return None
+        worker_id = request_id >> 32
+        return worker_id if worker_id != self.bus.worker_id else None
+
+    async def route_agent_message(self, device_id: str, message: dict, relay: bool = True) -> bool:
+        """Unicast a message tied to a tracked request back to the dashboard that sent it.
+
+        The dashboard's original request_id is restored. A "response" completes the
+        request; other messages (progress, chunks) only keep it alive. A request issued
+        by another worker is passed on to it. Returns False when the message does not
+        belong to a tracked request.
+        """
+        key = (device_id, message.get("request_id"))
+        pending = self.pending_requests.get(key)
+        if pending is None:
+            worker_id = self._request_worker(message.get("request_id")) if relay else None
+            return worker_id is not None and self.bus.send(
+                worker_id, {"op": "agent_message", "device_id": device_id, "message": message})
+
+        if pending.handler is not None:
+            if message.get("type") == "response":
+                del self.pending_requests[key]
+                self.request_metrics["completed"] += 1
+            else:
+                pending.last_activity = time.monotonic()
+            pending.handler(message)
+            return True
+
+        if message.get("type") == "response":
+            del self.pending_requests[key]
+            self.request_metrics["completed"] += 1
+            # Opening (or attaching to) a PTY session makes the sender its owner
+            result = message.get("result")
+            if pending.request_type == "pty_open" and isinstance(result, dict) and result.get("session_id"):
+                self.pty_owners[(device_id, result["session_id"])] = pending.websocket
+        else:
+            pending.last_activity = time.monotonic()
+
+        message["request_id"] = pending.request_id
+        await self.send_to_dashboard(pending.websocket, message)
+        return True
+
+    async def route_session_message(self, device_id: str, message: dict, relay: bool = True):
+        """Unicast PTY output to the dashboard that owns the session; dropped without one.
+        A session owned by none of this worker's dashboards may be owned on another."""
+        key = (device_id, message.get("session_id"))
+        owner = self.pty_owners.get(key)
+        if message.get("type") == "pty_exit":
+            self.pty_owners.pop(key, None)
+        if owner is not None:
+            await self.send_to_dashboard(owner, message)
+        elif relay:
+            self.bus.broadcast({"op": "session_message", "device_id": device_id, "message": message},
+                               dashboards_only=True)
+
+    def owns_session(self, websocket: WebSocket, device_id: str, session_id) -> bool:
+        return self.pty_owners.get((device_id, session_id)) is websocket
+
+    async def route_agent_frame(self, device_id: str, header: dict, frame: bytes, relay: bool = True) -> bool:
+        """Unicast a binary frame of a tracked request back to the dashboard that sent it.
+
+        Same rules as route_agent_message: the dashboard's request_id is restored in
+        the header and a "response" frame completes the request. The payload is
+        passed through untouched.
+        """
+        key = (device_id, header.get("request_id"))
+        pending = self.pending_requests.get(key)
+        if pending is None:
+            worker_id = self._request_worker(header.get("request_id")) if relay else None
+            return worker_id is not None and self.bus.send(
+                worker_id, {"op": "agent_frame", "device_id": device_id}, frame)
+
+        if header.get("type") == "response":
+            del self.pending_requests[key]
+            self.request_metrics["completed"] += 1
+        else:
+            pending.last_activity = time.monotonic()
+
+        header["request_id"] = pending.request_id
+        await self.send_to_dashboard(pending.websocket, replace_frame_header(frame, header))
+        return True
+
+    def fail_pending_requests(self, device_id: str, reason: str):
+        """Answer every request still pending on a device with an error."""
+        for key, pending in list(self.pending_requests.items()):
+            if pending.device_id == device_id:
+                del self.pending_requests[key]
+                self.request_metrics["failed"] += 1
+                self._send_request_error(pending, reason)
+
+    def _send_request_error(self, pending: PendingRequest, reason: str):
+        if pending.handler is not None:
+            pending.handler({"type": "response", "device_id": pending.device_id, "result": {"error": reason}})
+            return
+        connection = self.active_dashboards.get(pending.websocket)
+        if connection:
+            connection.send({
+                "type": "response",
+                "device_id": pending.device_id,
+                "request_id": pending.request_id,
+                "request_type": pending.request_type,
+                "result": {"error": reason}
+            })
+
+    async def _sweep_pending_requests(self):
+        while self.pending_requests:
+            await asyncio.sleep(PENDING_SWEEP_INTERVAL)
+            now = time.monotonic()
+            for key, pending in list(self.pending_requests.items()):
+                if now - pending.last_activity > PENDING_REQUEST_TIMEOUT:
+                    del self.pending_requests[key]
+                    self.request_metrics["expired"] += 1
+                    self._send_request_error(pending, f"Request timed out after {PENDING_REQUEST_TIMEOUT:.0f}s")
+
+    # --- Fleet execution ---
+
+    def select_devices(self, devices=None, tags=None) -> List[str]:
+        """Devices a fleet selector names: ids (offline ones included, to be reported as
+        such) and/or connected agents carrying any of the tags; "*" is every agent."""
+        agents = self.online_agents()
+        if devices == ANY or tags == ANY:
+            return sorted(agents)
+        selected = list(dict.fromkeys(str(device) for device in (devices or [])))
+        if tags:
+            wanted = {tags} if isinstance(tags, str) else set(map(str, tags))
+            selected += [device_id for device_id in sorted(agents)
+                         if device_id not in selected and wanted & set(agents[device_id].get("tags", ()))]
+        return selected
+
+    async def start_fleet_run(self, websocket: WebSocket, cmd_data: dict):
+        """Start a fleet_command; errors are answered like any failed request."""
+        request_id = cmd_data.get("request_id")
+        devices = self.select_devices(cmd_data.get("devices"), cmd_data.get("tags"))
+        try:
+            parallelism = max(1, min(MAX_FLEET_PARALLELISM, int(cmd_data.get("parallelism", FLEET_PARALLELISM))))
+            timeout = min(MAX_FLEET_TIMEOUT, float(cmd_data.get("timeout", FLEET_TIMEOUT)))
+            error = None if cmd_data.get("cmd") else "Missing cmd"
+            if not error and not devices:
+                error = "No devices match the selector"
+            if not error and timeout <= 0:
+                error = "timeout must be positive"
+        except (TypeError, ValueError) as e:
+            error = str(e)
+        if error:
+            await self.send_to_dashboard(websocket, {
+                "type": "response",
+                "device_id": None,
+                "request_id": request_id,
+                "request_type": "fleet_command",
+                "result": {"error": error}
+            })
+            return
+
+        run = FleetRun(self, websocket, request_id, cmd_data["cmd"], devices, parallelism, timeout)
+        self.fleet_runs[run.fleet_id] = run
+        run.task = asyncio.create_task(run.run())
+        print(f"Fleet run {run.fleet_id}: {len(devices)} devices, parallelism {parallelism}")
+
+    def cancel_fleet_run(self, websocket: WebSocket, fleet_id: str):
+        run = self.fleet_runs.get(fleet_id)
+        if run and run.websocket is websocket:
+            run.cancel()
+
+    def request_stats(self) -> dict:
+        return {"in_flight": len(self.pending_requests), **self.request_metrics}
+
+    # --- Subscriptions ---
+
+    def _remove_subscriptions(self, websocket: WebSocket, keys: Iterable[Tuple[str, str]]):
+        for key in list(keys):
+            subscribers = self.subscriptions.get(key)
+            if subscribers is not None:
+                subscribers.discard(websocket)
+                if not subscribers:
+                    del self.subscriptions[key]
+
+    def subscribe(self, websocket: WebSocket, devices, topics) -> List[Tuple[str, str]]:
+        """Subscribe a dashboard to (device, topic) pairs; "*" matches anything.
+
+        The first explicit subscribe replaces the implicit receive-everything default.
+        Returns the pairs that were newly added.
+        """
+        connection = self.active_dashboards.get(websocket)
+        if not connection:
+            return []
+        if connection.implicit_subscription:
+            self._remove_subscriptions(websocket, connection.subscriptions)
+            connection.subscriptions.clear()
+            connection.implicit_subscription = False
+
+        added = []
+        for device_id in _as_list(devices):
+            for topic in _as_list(topics):
+                key = (device_id, "stats" if topic == "stats_delta" else topic)
+                if key not in connection.subscriptions:
+                    connection.subscriptions.add(key)
+                    self.subscriptions[key].add(websocket)
+                    added.append(key)
+        return added
+
+    def unsubscribe(self, websocket: WebSocket, devices=None, topics=None):
+        """Drop matching subscriptions; omitted devices/topics match all of the dashboard's."""
+        connection = self.active_dashboards.get(websocket)
+        if not connection:
+            return
+        device_filter = None if devices is None else set(_as_list(devices))
+        topic_filter = None if topics is None else set(_as_list(topics))
+        removed = {
+            (device_id, topic) for device_id, topic in connection.subscriptions
+            if (device_filter is None or device_id in device_filter)
+            and (topic_filter is None or topic in topic_filter)
+        }
+        connection.subscriptions -= removed
+        connection.implicit_subscription = False
+        self._remove_subscriptions(websocket, removed)
+
+    def subscribers(self, device_id: str, topic: str) -> List[DashboardConnection]:
+        """Dashboards subscribed to a device/topic, via the subscription index."""
+        sockets = set()
+        for key in ((device_id, topic), (device_id, ANY), (ANY, topic), (ANY, ANY)):
+            sockets |= self.subscriptions.get(key, set())
+        return [self.active_dashboards[ws] for ws in sockets if ws in self.active_dashboards]
+
+    async def publish(self, device_id: str, message: dict, relay: bool = True):
+        """Queue a must-deliver agent message for dashboards subscribed to it"""
+        if relay:
+            self.bus.broadcast({"op": "publish", "device_id": device_id, "message": message}, dashboards_only=True)
+        for connection in self.subscribers(device_id, message_topic(message)):
+            connection.send(message)
+
+    async def publish_frame(self, device_id: str, header: dict, frame: bytes, relay: bool = True):
+        """Forward an untracked binary frame, undecoded, to dashboards subscribed to its type.
+
+        Frames of a stream (live preview) are latest wins per dashboard, so a slow
+        browser skips frames instead of falling behind. Only keyframes can replace an
+        unsent frame: a tile delta builds on the frame before it, so when one cannot be
+        delivered the dashboard waits for the next keyframe, which is requested.
+        """
+        if relay:
+            self.bus.broadcast({"op": "publish_frame", "device_id": device_id}, frame, dashboards_only=True)
+        topic = message_topic(header)
+        stream_id = header.get("stream_id")
+        resync = False
+        for connection in self.subscribers(device_id, topic):
+            if stream_id is None:
+                connection.send(frame)
+                continue
+
+            key = (topic, device_id, stream_id)
+            if header.get("keyframe", True):
+                connection.synced_streams.add(key)
+                connection.stream_resync_at.pop(key, None)
+                connection.send_latest(key, frame)
+            elif key in connection.synced_streams and not connection.has_pending(key):
+                connection.send_latest(key, frame)
+            else:
+                connection.synced_streams.discard(key)
+                now = time.monotonic()
+                if now - connection.stream_resync_at.get(key, 0.0) >= STREAM_RESYNC_INTERVAL:
+                    connection.stream_resync_at[key] = now
+                    resync = True
+
+        if resync:
+            await self.send_direct_request(device_id, {"type": "live_preview_keyframe", "stream_id": stream_id},
+                                           quiet=True)
+
+    async def send_to_dashboard(self, websocket: WebSocket, message: Union[dict, bytes]) -> bool:
+        """Queue a must-deliver message for one dashboard"""
+        connection = self.active_dashboards.get(websocket)
+        return connection.send(message) if connection else False
 
     async def broadcast_to_dashboards(self, message: dict):
-        """Send live stats to all open web dashboards"""
-        for connection in self.active_dashboards:
-            try:
-                await connection.send_json(message)
-            except:
-                pass
+        """Queue a must-deliver message for all open web dashboards"""
+        for connection in list(self.active_dashboards.values()):
+            connection.send(message)
+
+    async def broadcast_stats(self, device_id: str, message: dict):
+        """Send live stats to all open web dashboards, latest wins per device.
+
+        A dashboard that still has an unsent sample for this device gets it replaced
+        by a keyframe built at write time, since dropping a delta would break its chain.
+        """
+        key = ("stats", device_id)
+        for connection in self.subscribers(device_id, "stats"):
+            if connection.has_pending(key):
+                connection.send_latest(key, lambda: self.stats_keyframe(device_id))
+            else:
+                connection.send_latest(key, message)
+
+    def stats_keyframe(self, device_id: str):
+        snapshot = self.device_stats.get(device_id)
+        if snapshot is None:
+            return None
+        return {
+            "type": "stats",
+            "device_id": device_id,
+            "seq": self.device_stats_seq.get(device_id),
+            "keyframe": True,
+            # Copy so later deltas don't mutate a message that is being serialized
+            "data": json.loads(json.dumps(snapshot))
+        }
+
+    def apply_stats(self, device_id: str, message: dict) -> bool:
+        """Fold a stats keyframe or delta into the device's full snapshot.
+
+        Returns False when a delta arrives out of sequence (or before any keyframe),
+        in which case the snapshot is stale until the agent sends a new keyframe.
+        """
+        seq = message.get("seq")
+        if message.get("type") == "stats":
+            # Keyframe, or a full snapshot from an agent without delta support
+            self.device_stats[device_id] = message.get("data", {})
+            self.device_stats_seq[device_id] = seq
+            self.stats_resync_pending.discard(device_id)
+            return True
+
+        last_seq = self.device_stats_seq.get(device_id)
+        snapshot = self.device_stats.get(device_id)
+        if snapshot is None or last_seq is None or seq != last_seq + 1:
+            self.device_stats_seq[device_id] = None
+            return False
+
+        merge_stats(snapshot, message.get("data", {}))
+        self.device_stats_seq[device_id] = seq
+        return True
+
+    async def receive_stats(self, device_id: str, message: dict) -> bool:
+        """Apply a stats keyframe or delta and pass it on to dashboards; on a gap, ask
+        the agent for a keyframe instead. Returns whether it was applied."""
+        if not self.apply_stats(device_id, message):
+            # Missed a delta: hold back until the agent resyncs with a keyframe
+            await self.request_stats_keyframe(device_id)
+            return False
+        await self.broadcast_stats(device_id, message)
+        return True
+
+    async def request_stats_keyframe(self, device_id: str):
+        """Ask an agent for a fresh keyframe, once per detected gap."""
+        if device_id in self.stats_resync_pending:
+            return
+        self.stats_resync_pending.add(device_id)
+        await self.send_direct_request(device_id, {"type": "request_keyframe"})
+
+    async def send_stats_snapshots(self, websocket: WebSocket):
+        """Bring a newly joined (or newly subscribed) dashboard up to date with full stats."""
+        connection = self.active_dashboards.get(websocket)
+        if not connection:
+            return
+        for device_id in list(self.device_stats):
+            if connection in self.subscribers(device_id, "stats"):
+                connection.send_latest(("stats", device_id),
+                                       lambda device_id=device_id: self.stats_keyframe(device_id))
+
+    async def send_to_agent(self, device_id: str, message: Union[dict, bytes], relay: bool = True) -> bool:
+        """Send a message (or binary frame) to an agent, on this worker or through the bus."""
+        ws = self.active_agents.get(device_id)
+        if ws is not None:
+            if isinstance(message, bytes):
+                await ws.send_bytes(message)
+            else:
+                await ws.send_json(message)
+            return True
+        worker_id = self.bus.owner(device_id) if relay else None
+        if worker_id is None:
+            return False
+        if isinstance(message, bytes):
+            return self.bus.send(worker_id, {"op": "to_agent", "device_id": device_id}, message)
+        return self.bus.send(worker_id, {"op": "to_agent", "device_id": device_id, "message": message})
 
     async def send_command(self, device_id: str, command: str):
         """Send a shell command to a specific agent"""
-        if device_id in self.active_agents:
-            ws = self.active_agents[device_id]
-            try:
-                await ws.send_json({"type": "execute", "cmd": command})
+        try:
+            if await self.send_to_agent(device_id, {"type": "execute", "cmd": command}):
                 print(f"Command sent to {device_id}: {command}")
                 return True
-            except Exception as e:
-                print(f"Failed to send command to {device_id}: {e}")
-                return False
-        else:
-            print(f"Device {device_id} not found in active agents: {list(self.active_agents.keys())}")
+        except Exception as e:
+            print(f"Failed to send command to {device_id}: {e}")
             return False
+        print(f"Device {device_id} not found in active agents: {list(self.online_agents())}")
+        return False
 
-    async def send_command_with_id(self, device_id: str, command: str, request_id: int):
+    async def send_command_with_id(self, device_id: str, command: str, request_id: int, options: dict = None):
         """Send a shell command with request ID tracking"""
-        if device_id in self.active_agents:
-            ws = self.active_agents[device_id]
-            try:
-                await ws.send_json({
-                    "type": "execute", 
-                    "cmd": command, 
-                    "request_id": request_id
-                })
+        try:
+            if await self.send_to_agent(device_id, {
+                "type": "execute", 
+                "cmd": command, 
+                "request_id": request_id,
+                **(options or {})
+            }):
                 print(f"Command sent to {device_id}: {command} (ID: {request_id})")
                 return True
-            except Exception as e:
-                print(f"Failed to send command to {device_id}: {e}")
-                return False
-        else:
-            print(f"Device {device_id} not found in active agents: {list(self.active_agents.keys())}")
+        except Exception as e:
+            print(f"Failed to send command to {device_id}: {e}")
+            return False
+        print(f"Device {device_id} not found in active agents: {list(self.online_agents())}")
+        return False
+
+    async def relay_frame(self, device_id: str, frame: bytes) -> bool:
+        """Pass a binary frame (e.g. an upload chunk) straight through to an agent"""
+        try:
+            return await self.send_to_agent(device_id, frame)
+        except Exception as e:
+            print(f"Failed to relay frame to {device_id}: {e}")
             return False
 
-    async def send_direct_request(self, device_id: str, request_data: dict):
+    async def send_direct_request(self, device_id: str, request_data: dict, quiet: bool = False):
         """Send a direct request to a specific agent"""
-        if device_id in self.active_agents:
-            ws = self.active_agents[device_id]
-            try:
-                await ws.send_json(request_data)
-                print(f"Direct request sent to {device_id}: {request_data.get('type')}")
+        try:
+            if await self.send_to_agent(device_id, request_data):
+                if not quiet:
+                    print(f"Direct request sent to {device_id}: {request_data.get('type')}")
                 return True
-            except Exception as e:
-                print(f"Failed to send direct request to {device_id}: {e}")
-                return False
-        else:
-            print(f"Device {device_id} not found for direct request")
+        except Exception as e:
+            print(f"Failed to send direct request to {device_id}: {e}")
             return False
+        print(f"Device {device_id} not found for direct request")
+        return False
+
+    def is_online(self, device_id: str) -> bool:
+        return device_id in self.active_agents or self.bus.owner(device_id) is not None
+
+    def online_agents(self) -> Dict[str, dict]:
+        """Agents connected to any worker, with their registration details."""
+        agents = self.bus.remote_agents()
+        agents.update((device_id, self.agent_info.get(device_id, {})) for device_id in self.active_agents)
+        return agents
 
     async def broadcast_agent_list(self):
         """Update dashboards with list of currently connected devices"""
-        agents_online = list(self.active_agents.keys())
-        await self.broadcast_to_dashboards({
-            "type": "device_list",
-            "devices": agents_online
-        })
+        agents_online = list(self.online_agents())
+        # Only the newest device list matters to a dashboard that is behind
+        for connection in list(self.active_dashboards.values()):
+            connection.send_latest("device_list", {
+                "type": "device_list",
+                "devices": agents_online
+            })
 
-manager = ConnectionManager()
+manager = ConnectionManager(UnixSocketBus(BUS_DIRECTORY) if BUS_DIRECTORY else LocalBus())
 
 # --- WebSocket endpoints ---
 
@@ -130,29 +1672,72 @@ async def websocket_agent_endpoint(websocket: WebSocket):
             # Fallback for direct device_id
             device_id = init_data.get("device_id", "unknown")
 
-        await manager.connect_agent(websocket, device_id)
+        resumed = await manager.connect_agent(websocket, device_id, init_data)
+        await websocket.send_json({"type": "registered", "session_id": init_data.get("session_id"),
+                                   "resumed": resumed})
 
         try:
             while True:
-                # Listen for stats or command results
-                data = await websocket.receive_text()
-                msg = json.loads(data)
+                # Listen for stats, command results and binary frames
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(message.get("code", 1000))
+
+                if message.get("bytes") is not None:
+                    # Binary frames are routed on their header alone; payloads are never decoded
+                    frame = message["bytes"]
+                    header = read_frame_header(frame)
+                    if header.get("request_id") is not None:
+                        if not await manager.route_agent_frame(device_id, header, frame) \
+                                and header.get("type") == "response":
+                            manager.request_metrics["orphaned"] += 1
+                        continue
+                    await manager.publish_frame(device_id, header, frame)
+                    continue
+
+                msg = json.loads(message["text"])
                 
-                print(f"Received from {device_id}: {msg.get('type', 'unknown')}")
+                msg_type = msg.get("type", "unknown")
+                print(f"Received from {device_id}: {msg_type}")
+
+                if msg_type in PTY_MESSAGE_TYPES:
+                    await manager.route_session_message(device_id, msg)
+                    continue
+
+                if msg_type == "stats_backfill":
+                    manager.stats_history.backfill(device_id, msg.get("fields") or [], msg.get("samples") or [])
+                    continue
+
+                if msg_type in ("stats", "stats_delta"):
+                    # Workers with dashboards keep their own snapshot of every agent's stats
+                    manager.bus.broadcast({"op": "stats", "device_id": device_id, "message": msg},
+                                          dashboards_only=True)
+                    if await manager.receive_stats(device_id, msg):
+                        manager.stats_history.record(device_id, manager.device_stats[device_id])
+                    continue
 
-                # Forward everything to the dashboard for viewing
-                await manager.broadcast_to_dashboards(msg)
+                # Responses go back to the dashboard that asked; everything else goes
+                # to the dashboards subscribed to it
+                if msg.get("request_id") is not None:
+                    if await manager.route_agent_message(device_id, msg):
+                        continue
+                    if msg_type == "response":
+                        # Expired, or its dashboard has gone away
+                        manager.request_metrics["orphaned"] += 1
+                        continue
+
+                await manager.publish(device_id, msg)
 
         except WebSocketDisconnect:
             print(f"Agent {device_id} disconnected normally")
             if device_id:
-                manager.disconnect_agent(device_id)
+                manager.disconnect_agent(device_id, websocket)
                 await manager.broadcast_agent_list()
 
     except Exception as e:
         print(f"Agent Error: {e}")
         if device_id:
-            manager.disconnect_agent(device_id)
+            manager.disconnect_agent(device_id, websocket)
             await manager.broadcast_agent_list()
 
 
@@ -165,11 +1750,29 @@ async def websocket_dashboard_endpoint(websocket: WebSocket):
         await manager.broadcast_agent_list()
 
         while True:
-            # Listen for commands from the frontend dashboard
-            data = await websocket.receive_text()
-            cmd_data = json.loads(data)
+            # Listen for commands (and upload chunk frames) from the frontend dashboard
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+
+            if message.get("bytes") is not None:
+                # Relayed chunk by chunk, so a large upload is never held here in full
+                frame = message["bytes"]
+                header = read_frame_header(frame)
+                target_id = header.get("target")
+                if not target_id or not await manager.relay_frame(target_id, frame):
+                    await manager.send_to_dashboard(websocket, {
+                        "type": "error",
+                        "message": f"Failed to relay {header.get('type')} to {target_id}",
+                        "target": target_id
+                    })
+                continue
+
+            cmd_data = json.loads(message["text"])
             
-            print(f"Dashboard command received: {cmd_data}")
+            if cmd_data.get("type") not in ("transfer_ack", "live_preview_keepalive", "live_preview_keyframe",
+                                            "pty_input", "pty_resize"):
+                print(f"Dashboard command received: {cmd_data}")
 
             if cmd_data.get("type") == "command":
                 target_id = cmd_data.get("target")
@@ -177,9 +1780,12 @@ async def websocket_dashboard_endpoint(websocket: WebSocket):
                 req_id = cmd_data.get("request_id")
                 
                 if target_id and cmd:
-                    success = await manager.send_command_with_id(target_id, cmd, req_id)
+                    server_req_id = manager.track_request(websocket, target_id, req_id, "execute")
+                    options = {key: cmd_data[key] for key in COMMAND_OPTIONS if key in cmd_data}
+                    success = await manager.send_command_with_id(target_id, cmd, server_req_id, options)
                     if not success:
-                        await websocket.send_json({
+                        manager.untrack_request(target_id, server_req_id)
+                        await manager.send_to_dashboard(websocket, {
                             "type": "error",
                             "message": f"Failed to send command to {target_id}",
                             "target": target_id
@@ -187,16 +1793,57 @@ async def websocket_dashboard_endpoint(websocket: WebSocket):
                 else:
                     print("Invalid command data - missing target or cmd")
                     
+            elif cmd_data.get("type") in CONTROL_TYPES:
+                # Flow control for streaming transfers and previews; relayed as-is, no response expected
+                target_id = cmd_data.pop("target", None)
+                if target_id:
+                    await manager.send_direct_request(target_id, cmd_data, quiet=True)
+
+            elif cmd_data.get("type") in PTY_CONTROL_TYPES:
+                # Keystrokes reach a shell only from the dashboard that owns it
+                target_id = cmd_data.pop("target", None)
+                if target_id and manager.owns_session(websocket, target_id, cmd_data.get("session_id")):
+                    await manager.send_direct_request(target_id, cmd_data, quiet=True)
+
+            elif cmd_data.get("type") == "fleet_command":
+                # {"type": "fleet_command", "cmd": ..., "devices": [...] | "*", "tags": [...],
+                #  "parallelism": n, "timeout": seconds}
+                await manager.start_fleet_run(websocket, cmd_data)
+
+            elif cmd_data.get("type") == "fleet_cancel":
+                manager.cancel_fleet_run(websocket, cmd_data.get("fleet_id"))
+
+            elif cmd_data.get("type") == "subscribe":
+                # {"type": "subscribe", "devices": [...] | "*", "topics": [...] | "*"}
+                manager.subscribe(websocket, cmd_data.get("devices", ANY), cmd_data.get("topics", ANY))
+                await manager.send_stats_snapshots(websocket)
+                await manager.send_to_dashboard(websocket, {
+                    "type": "subscriptions",
+                    "subscriptions": sorted(manager.active_dashboards[websocket].subscriptions)
+                })
+
+            elif cmd_data.get("type") == "unsubscribe":
+                manager.unsubscribe(websocket, cmd_data.get("devices"), cmd_data.get("topics"))
+                await manager.send_to_dashboard(websocket, {
+                    "type": "subscriptions",
+                    "subscriptions": sorted(manager.active_dashboards[websocket].subscriptions)
+                })
+
+            elif cmd_data.get("type") == "stats_history":
+                # {"type": "stats_history", "device_id": ..., "start": ..., "end": ..., "points": ..., "series": [...]}
+                await manager.send_to_dashboard(websocket, await stats_history_response(cmd_data))
+
             elif cmd_data.get("type") == "request":
                 target_id = cmd_data.get("target")
                 req_type = cmd_data.get("request_type")
                 req_id = cmd_data.get("request_id")
                 
                 if target_id and req_type:
-                    # Forward the request directly to the agent
+                    # Forward the request directly to the agent, under a server-assigned id
+                    server_req_id = manager.track_request(websocket, target_id, req_id, req_type)
                     request_msg = {
                         "type": req_type,
-                        "request_id": req_id
+                        "request_id": server_req_id
                     }
                     # Include any additional parameters
                     for key, value in cmd_data.items():
@@ -205,7 +1852,8 @@ async def websocket_dashboard_endpoint(websocket: WebSocket):
                     
                     success = await manager.send_direct_request(target_id, request_msg)
                     if not success:
-                        await websocket.send_json({
+                        manager.untrack_request(target_id, server_req_id)
+                        await manager.send_to_dashboard(websocket, {
                             "type": "error",
                             "message": f"Failed to send request to {target_id}",
                             "target": target_id
@@ -219,6 +1867,59 @@ async def websocket_dashboard_endpoint(websocket: WebSocket):
         manager.disconnect_dashboard(websocket)
 
 
+async def stats_history_response(query: dict, relay: bool = True) -> dict:
+    """Answer a history query; start and end default to the last 24 hours. Recent
+    samples are in memory on the worker holding the agent, so it answers for it."""
+    worker_id = manager.bus.owner(query.get("device_id")) if relay else None
+    if worker_id is not None:
+        try:
+            return await manager.bus.call(worker_id, "stats_history", query)
+        except (ConnectionError, asyncio.TimeoutError):
+            pass  # Rollups on disk are shared, so this worker can still answer
+    end = query.get("end") or time.time()
+    start = query.get("start") or end - 86400
+    series = query.get("series")
+    if isinstance(series, str):
+        series = series.split(",")
+    try:
+        history = await manager.stats_history.query(
+            query.get("device_id"), float(start), float(end),
+            query.get("points") or STATS_HISTORY_POINTS, series)
+    except (TypeError, ValueError) as e:
+        return {"type": "stats_history", "request_id": query.get("request_id"), "error": str(e)}
+    return {"type": "stats_history", "request_id": query.get("request_id"), **history}
+
+
 @app.get("/")
 def home():
-    return {"status": "System Online", "agents": list(manager.active_agents.keys())}
+    return {"status": "System Online", "agents": list(manager.online_agents())}
+
+
+@app.get("/history/{device_id}")
+async def stats_history(device_id: str, start: Optional[float] = None, end: Optional[float] = None,
+                        points: int = STATS_HISTORY_POINTS, series: Optional[str] = None):
+    return await stats_history_response({"device_id": device_id, "start": start, "end": end,
+                                         "points": points, "series": series})
+
+
+@app.on_event("startup")
+async def start_bus():
+    manager.bus.register("stats_history", lambda query: stats_history_response(query, relay=False))
+    await manager.bus.start(manager)
+
+
+@app.on_event("shutdown")
+async def flush_stats_history():
+    await manager.stats_history.flush(include_open=True)
+    await manager.bus.close()
+
+
+@app.get("/metrics")
+def metrics():
+    return {
+        "agents": len(manager.online_agents()),
+        "local_agents": len(manager.active_agents),
+        "dashboards": len(manager.active_dashboards),
+        "requests": manager.request_stats(),
+        "fleet_runs": len(manager.fleet_runs)
+    }
@@ -0,0 +1,105 @@
+import asyncio
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from server import ConnectionManager, UnixSocketBus  # noqa: E402
+
+
+class FakeManager:
+    """The parts of ConnectionManager the bus calls, recording what reaches them."""
+
+    def __init__(self):
+        self.agent_info = {}
+        self.active_agents = {}
+        self.events = asyncio.Queue()
+
+    def is_online(self, device_id):
+        return device_id in self.active_agents
+
+    def expire_agent(self, device_id, relay=True):
+        self.events.put_nowait(("expire", device_id))
+
+    async def broadcast_agent_list(self):
+        pass
+
+    async def send_to_agent(self, device_id, message, relay=True):
+        await self.events.put(("to_agent", device_id, message))
+
+    async def route_agent_message(self, device_id, message, relay=True):
+        await self.events.put(("agent_message", device_id, message))
+
+
+async def wait_for(condition, timeout=5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+async def next_event(manager):
+    return await asyncio.wait_for(manager.events.get(), 5.0)
+
+
+def test_two_workers_share_agents_requests_and_calls():
+    async def scenario(directory):
+        first, second = UnixSocketBus(directory), UnixSocketBus(directory)
+        assert (first.worker_id, second.worker_id) == (1, 2)
+        first_manager, second_manager = FakeManager(), FakeManager()
+        try:
+            await first.start(first_manager)
+            await second.start(second_manager)
+            await wait_for(lambda: 2 in first.peers and 1 in second.peers)
+
+            # Only the higher-numbered worker dials, so another scan adds no connection
+            connection = first.peers[2]
+            await first._discover()
+            await second._discover()
+            assert first.peers[2] is connection
+
+            # An agent connecting to the first worker becomes known to the second
+            first_manager.active_agents["host"] = object()
+            first.broadcast({"op": "agent_up", "device_id": "host", "info": {"tags": ["web"]}})
+            await wait_for(lambda: second.owner("host") == 1)
+            assert second.remote_agents() == {"host": {"tags": ["web"]}}
+
+            # A request from the second worker reaches the agent on the first
+            assert second.send(1, {"op": "to_agent", "device_id": "host", "message": {"type": "ping"}})
+            assert await next_event(first_manager) == ("to_agent", "host", {"type": "ping"})
+
+            # and the agent's reply is relayed back to the second
+            assert first.send(2, {"op": "agent_message", "device_id": "host", "message": {"type": "pong"}})
+            assert await next_event(second_manager) == ("agent_message", "host", {"type": "pong"})
+
+            async def history(args):
+                return {"device_id": args["device_id"], "points": 3}
+
+            first.register("stats_history", history)
+            assert await second.call(1, "stats_history", {"device_id": "host"}) == {"device_id": "host", "points": 3}
+            assert "error" in await second.call(1, "unknown", {})
+        finally:
+            await second.close()
+            await first.close()
+
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(scenario(directory))
+
+
+def test_worker_slots_are_reused_and_keep_request_ids_exact():
+    with tempfile.TemporaryDirectory() as directory:
+        first = UnixSocketBus(directory)
+        second = UnixSocketBus(directory, worker_id=7)
+        assert (first.worker_id, second.worker_id) == (1, 7)
+        asyncio.run(first.close())
+        # A slot is free again once its worker is gone
+        third = UnixSocketBus(directory)
+        assert third.worker_id == 1
+
+        manager = ConnectionManager(second)
+        request_id = next(manager.request_ids)
+        assert request_id < 2 ** 53
+        assert request_id >> 32 == 7
+        asyncio.run(second.close())
+        asyncio.run(third.close())